@@ -1,5 +1,12 @@
 const socket = io(window.location.origin);
 
+// (Re)joindre la room de la session à chaque connexion
+socket.on("connect", () => {
+    socket.emit("join_session", { session_id: sessionId });
+    // Une resynchronisation des sous-titres coupée par la déconnexion est relancée au prochain delta
+    captions.syncing = false;
+});
+
 
 let currentAudio = null;
 
@@ -8,7 +15,7 @@ const button2 = document.getElementById("button2");
 
 document.addEventListener("DOMContentLoaded", () => {
     const savedAudio = localStorage.getItem("lastAudio");
-    if (savedAudio) {
+    if (savedAudio && localStorage.getItem("lastAudioSession") === sessionId) {
         setupAudio(savedAudio);
         playBtn.style.display = "flex";
     }
@@ -16,7 +23,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
 
 function setupAudio(filename) {
-    currentAudio = new Audio(`${baseURL}/get-audio/${filename}`);
+    currentAudio = new Audio(`${baseURL}/get-audio/${filename}?session_id=${sessionId}`);
     currentAudio.crossOrigin = "anonymous";
 
     currentAudio.onended = () => {
@@ -25,6 +32,15 @@ function setupAudio(filename) {
     };
 }
 
+// Sous-titres du cours en direct (affichés pendant l'enregistrement)
+socket.on("transcript_delta", (data) => {
+    applyTranscriptDelta(
+        data,
+        (offset, callback) => socket.emit("transcript_sync", { session_id: sessionId, offset: offset }, callback),
+        () => isRecording
+    );
+});
+
 socket.on("new_audio", (data) => {
     console.log("Nouvel audio reçu :", data.filename);
     setCustomText("Bonjour !");
@@ -32,6 +48,7 @@ socket.on("new_audio", (data) => {
 
     playBtn.style.display = "flex";
     localStorage.setItem("lastAudio", data.filename);
+    localStorage.setItem("lastAudioSession", sessionId);
 });
 
 playBtn.addEventListener("click", () => {
@@ -63,7 +80,7 @@ button2.addEventListener("click", () => {
 let responseAudio=null
 
 socket.on("new_response_audio", (data) => {
-    responseAudio = new Audio(`${baseURL}/get-response-audio/${data.filename}`);
+    responseAudio = new Audio(`${baseURL}/get-response-audio/${data.filename}?session_id=${sessionId}`);
     responseAudio.crossOrigin = "anonymous";
     if (!audioContext) {
         audioContext = new (window.AudioContext || window.webkitAudioContext)();
@@ -85,6 +102,89 @@ socket.on("new_response_audio", (data) => {
     };
 });
 
+// Réponse en streaming : les segments arrivent phrase par phrase et sont joués dans l'ordre
+let segmentResponseId = null;
+let pendingSegments = {};
+let nextSegmentIndex = 0;
+let segmentCount = null;
+let segmentPlaying = false;
+let cancelledResponseId = null;
+
+function resetSegments(responseId) {
+    segmentResponseId = responseId;
+    pendingSegments = {};
+    nextSegmentIndex = 0;
+    segmentCount = null;
+    segmentPlaying = false;
+}
+
+function playNextSegment() {
+    if (segmentPlaying) return;
+
+    const filename = pendingSegments[nextSegmentIndex];
+    if (!filename) {
+        if (segmentCount !== null && nextSegmentIndex >= segmentCount) {
+            setCustomText("Bonjour !");
+        }
+        return;
+    }
+    delete pendingSegments[nextSegmentIndex];
+    nextSegmentIndex++;
+
+    responseAudio = new Audio(`${baseURL}/get-response-audio/${filename}?session_id=${sessionId}`);
+    responseAudio.crossOrigin = "anonymous";
+    if (!audioContext) {
+        audioContext = new (window.AudioContext || window.webkitAudioContext)();
+        analyser = audioContext.createAnalyser();
+        analyser.fftSize = 256;
+        dataArray = new Uint8Array(analyser.frequencyBinCount);
+    }
+    if (source) source.disconnect();
+    source = audioContext.createMediaElementSource(responseAudio);
+    source.connect(analyser);
+    analyser.connect(audioContext.destination);
+
+    segmentPlaying = true;
+    responseAudio.onended = () => {
+        segmentPlaying = false;
+        playNextSegment();
+    };
+    responseAudio.play();
+}
+
+socket.on("new_response_segment", (data) => {
+    if (data.response_id === cancelledResponseId) return;
+    if (data.response_id !== segmentResponseId) {
+        resetSegments(data.response_id);
+        setCustomText("Je parle...");
+    }
+    console.log("Nouveau segment reçu :", data.index, data.filename);
+    pendingSegments[data.index] = data.filename;
+    playNextSegment();
+});
+
+socket.on("response_segments_end", (data) => {
+    if (data.response_id !== segmentResponseId) return;
+    segmentCount = data.count;
+    playNextSegment();
+});
+
+// Question abandonnée par le serveur (saturé) : l'interface revient à l'état d'attente
+const RESPONSE_ERROR_DISPLAY_MS = 4000;
+
+socket.on("response_error", (data) => {
+    console.warn("Réponse impossible :", data.reason);
+    resetSegments(null);
+    setCustomText(data.reason === "busy"
+        ? "Je suis débordée, repose ta question dans un instant !"
+        : "Oups, je n'ai pas pu répondre. Tu peux reposer ta question ?");
+    const errorTextId = typingId;
+    setTimeout(() => {
+        // Pas d'écrasement si un autre message a été affiché entre-temps
+        if (typingId === errorTextId) setCustomText("Bonjour !");
+    }, RESPONSE_ERROR_DISPLAY_MS);
+});
+
 
 const button1 = document.getElementById("button1");
 
@@ -98,6 +198,8 @@ button1.addEventListener("click", () => {
         responseAudio.pause();
         responseAudio.currentTime = 0;
     }
+    cancelledResponseId = segmentResponseId;
+    resetSegments(null);
     playBtn.style.display = "none";
     setCustomText("Bonjour !");
 });
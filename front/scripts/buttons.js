@@ -12,8 +12,30 @@ let isRecording = false;
 let mediaRecorder;
 let audioChunks = [];
 let chunkInterval = null;
+// Position du chunk dans l'enregistrement (le serveur remet les chunks dans cet ordre, même après un 503)
+let chunkIndex = 0;
 const CHUNK_DURATION = 1 * 10 * 1000;
 
+// Identifiant de session (un par onglet) : isole les fichiers et les évènements côté serveur
+const sessionId = sessionStorage.getItem("miloSessionId")
+  || Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+sessionStorage.setItem("miloSessionId", sessionId);
+
+// Serveur saturé (503) : nouvel essai après le délai Retry-After
+const MAX_UPLOAD_RETRIES = 5;
+
+async function postWithRetry(url, formData) {
+  for (let attempt = 0; ; attempt++) {
+    const response = await fetch(url, { method: "POST", body: formData });
+    if (response.status !== 503 || attempt >= MAX_UPLOAD_RETRIES) {
+      return response;
+    }
+    const retryAfter = parseFloat(response.headers.get("Retry-After")) || 2;
+    console.warn(`[upload] Serveur occupé, nouvel essai dans ${retryAfter}s`);
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+  }
+}
+
 // ========================================
 // BOUTON 2 - ENREGISTREMENT PAR CHUNKS
 // ========================================
@@ -25,8 +47,11 @@ btn2.addEventListener("click", async (e) => {
   if (!isRecording) {
     // Démarrer l'enregistrement
     try {
+      const startForm = new FormData();
+      startForm.append("session_id", sessionId);
       const startResponse = await fetch(`${baseURL}/start-recording`, {
-        method: "POST"
+        method: "POST",
+        body: startForm
       });
       const startData = await startResponse.json();
       console.log("Start recording response:", startData);
@@ -42,6 +67,7 @@ btn2.addEventListener("click", async (e) => {
     
     const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
     mediaRecorder = new MediaRecorder(stream);
+    chunkIndex = 0;
     
     mediaRecorder.ondataavailable = async (event) => {
       if (event.data && event.data.size > 0) {
@@ -52,12 +78,11 @@ btn2.addEventListener("click", async (e) => {
         
         const isLastChunk = !isRecording;
         formData.append("last_chunk", isLastChunk);
+        formData.append("chunk_index", chunkIndex++);
+        formData.append("session_id", sessionId);
         
         try {
-          const response = await fetch(`${baseURL}/upload-audio`, {
-            method: "POST",
-            body: formData
-          });
+          const response = await postWithRetry(`${baseURL}/upload-audio`, formData);
           const data = await response.json();
           console.log("Backend response:", data);
         } catch (err) {
@@ -123,12 +148,10 @@ btn3.addEventListener("click", async (e) => {
       const formData = new FormData();
       const timestamp = new Date().toISOString().replace(/[:.]/g, "-");
       formData.append("file", audioBlob, `full_${timestamp}.webm`);
+      formData.append("session_id", sessionId);
       
       try {
-        const response = await fetch(`${baseURL}/upload-question`, {
-          method: "POST",
-          body: formData
-        });
+        const response = await postWithRetry(`${baseURL}/upload-question`, formData);
         const data = await response.json();
         console.log("Backend response (full record):", data);
       } catch (err) {
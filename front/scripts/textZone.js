@@ -27,3 +27,81 @@ function setCustomText(newText) {
 
     typeLetter();
 }
+
+// ========================================
+// SOUS-TITRES EN DIRECT (transcript_delta)
+// ========================================
+const MAX_CAPTION_CHARS = 220;
+
+// Texte stabilisé du cours, position suivante dans le journal du serveur et hypothèse provisoire
+let captions = { run: null, next: null, text: "", partial: "", syncing: false };
+
+function resetCaptions(run) {
+    captions = { run: run, next: null, text: "", partial: "", syncing: false };
+}
+
+function captionText(segments) {
+    return segments.map((segment) => segment[2]).join(" ");
+}
+
+function appendCaptions(segments) {
+    const added = captionText(segments);
+    if (added) {
+        // Seule la fin du cours est affichée : on ne garde pas tout le transcript en mémoire
+        captions.text = `${captions.text} ${added}`.trim().slice(-4 * MAX_CAPTION_CHARS);
+    }
+}
+
+function renderCaptions() {
+    const textElement = document.getElementById("milo_text");
+    // Arrête une éventuelle animation de setCustomText
+    typingId++;
+    if (typingTimeout) {
+        clearTimeout(typingTimeout);
+        typingTimeout = null;
+    }
+
+    let stable = captions.text;
+    let partial = captions.partial;
+    const overflow = stable.length + partial.length + 1 - MAX_CAPTION_CHARS;
+    if (overflow > 0) {
+        stable = "…" + stable.slice(Math.min(overflow, stable.length));
+    }
+
+    const partialElement = document.createElement("span");
+    partialElement.className = "caption-partial";
+    partialElement.textContent = partial ? ` ${partial}` : "";
+    textElement.replaceChildren(document.createTextNode(stable), partialElement);
+}
+
+// Applique un delta du serveur ; requestSync(offset, callback) redemande les segments manquants
+function applyTranscriptDelta(data, requestSync, display) {
+    if (data.run !== captions.run) {
+        resetCaptions(data.run);
+    }
+    if (captions.syncing || (captions.next !== null && data.from < captions.next)) {
+        return;  // Déjà couvert par la resynchronisation en cours ou par un delta précédent
+    }
+
+    if (captions.next === null || data.from !== captions.next) {
+        // Premier delta reçu (page ouverte en cours de route) ou delta manqué : rattrapage depuis notre position
+        captions.syncing = true;
+        const run = captions.run;
+        requestSync(captions.next || 0, (reply) => {
+            if (captions.run !== run) return;
+            captions.syncing = false;
+            if (!reply || reply.status !== "ok") return;
+            if (captions.next === null) captions.text = "";
+            appendCaptions(reply.segments);
+            captions.next = reply.next;
+            captions.partial = captionText(reply.partial);
+            if (display()) renderCaptions();
+        });
+        return;
+    }
+
+    appendCaptions(data.segments);
+    captions.next = data.next;
+    captions.partial = captionText(data.partial);
+    if (display()) renderCaptions();
+}
@@ -2,22 +2,197 @@
 Module d'evaluation des reponses de Qwen3 par ChatGPT (IA Juge)
 """
 
+import hashlib
 import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
 from pathlib import Path
-from openai import OpenAI
-from .config import OPENAI_API_KEY, OPENAI_MODEL
+
+from lib import file_manager
+from lib.tracing import myTracer
 
 # Chemin vers le prompt du juge
 PROMPT_PATH = Path(__file__).parent / "prompts" / "judge_prompt.txt"
 
-# Client OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Cache disque des evaluations deja faites (hors de src/, un fichier par evaluation)
+CACHE_DIR = Path(os.environ.get("MILO_JUDGE_CACHE_DIR", file_manager.project_root_dir / "synthetiser" / "judge_cache"))
+# Au-dela, les evaluations les plus anciennes sont supprimees ; une evaluation trop vieille est refaite
+CACHE_MAX_ENTRIES = 2000
+CACHE_TTL_S = 7 * 24 * 60 * 60
+
+# File d'evaluation en arriere-plan
+JUDGE_WORKERS = 2
+BATCH_SIZE = 4
+BATCH_WAIT_S = 2.0
+
+CRITERIA_KEYS = [
+    "TUTOIEMENT_VOUVOIEMENT",
+    "CLARTE_SYNTHESE",
+    "AUTO_REFLEXION",
+    "SENS_EMOTIONNEL",
+    "HORS_CONTEXTE",
+    "PERTINENCE",
+    "NATUREL_HUMAIN",
+]
+
+# Client OpenAI (cree a la premiere evaluation ; None = pas de cle / pas d'openai -> juge local)
+_client = None
+_client_checked = False
+_client_lock = threading.Lock()
+
+_prompt_cache = {"mtime": None, "text": None}
+
+
+def _get_client():
+    global _client, _client_checked
+    with _client_lock:
+        if not _client_checked:
+            _client_checked = True
+            try:
+                from openai import OpenAI
+                from .config import OPENAI_API_KEY
+                if not OPENAI_API_KEY:
+                    raise ValueError("OPENAI_API_KEY vide")
+                _client = OpenAI(api_key=OPENAI_API_KEY)
+            except Exception as e:
+                # openai absent, pas de config, cle vide ou refusee par le constructeur (OpenAIError)
+                print(f"[JUDGE] Juge distant indisponible ({e}), utilisation du juge local")
+        return _client
+
+
+def _get_model():
+    from .config import OPENAI_MODEL
+    return OPENAI_MODEL
 
 
 def load_judge_prompt() -> str:
-    """Recharge le prompt du juge depuis le fichier (permet de modifier sans redemarrer)."""
-    with open(PROMPT_PATH, "r", encoding="utf-8") as f:
-        return f.read()
+    """Recharge le prompt du juge depuis le fichier seulement s'il a ete modifie (permet de modifier sans redemarrer)."""
+    mtime = PROMPT_PATH.stat().st_mtime_ns
+    if _prompt_cache["mtime"] != mtime:
+        with open(PROMPT_PATH, "r", encoding="utf-8") as f:
+            _prompt_cache["text"] = f.read()
+        _prompt_cache["mtime"] = mtime
+    return _prompt_cache["text"]
+
+
+def _judge_name(client) -> str:
+    """Juge qui produit les evaluations : une evaluation locale n'est jamais reprise pour le juge distant."""
+    return f"openai:{_get_model()}" if client is not None else "local"
+
+
+def _cache_key(judge: str, judge_prompt: str, preprompt: str, question: str, response: str) -> str:
+    prompt_hash = hashlib.sha256((judge_prompt + "\0" + preprompt).encode("utf-8")).hexdigest()
+    return hashlib.sha256("\0".join([judge, prompt_hash, question, response]).encode("utf-8")).hexdigest()
+
+
+def _cache_get(key: str):
+    path = CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL_S:
+            path.unlink(missing_ok=True)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _cache_put(key: str, evaluation: dict):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / f"{key}.json", "w", encoding="utf-8") as f:
+        json.dump(evaluation, f, ensure_ascii=False)
+    _cache_evict()
+
+
+def _cache_evict():
+    """Garde au plus CACHE_MAX_ENTRIES evaluations de moins de CACHE_TTL_S (les plus anciennes partent d'abord)."""
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".json"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+    entries.sort(reverse=True)
+    now = time.time()
+    for i, (mtime, path) in enumerate(entries):
+        if i >= CACHE_MAX_ENTRIES or now - mtime > CACHE_TTL_S:
+            Path(path).unlink(missing_ok=True)
+
+
+def _user_message(preprompt: str, question: str, response: str) -> str:
+    return f"""## PREPROMPT DE MILO (Qwen3)
+{preprompt}
+
+## QUESTION DE L'UTILISATEUR
+{question}
+
+## REPONSE DE MILO
+{response}
+
+Analyse et evalue cette reponse selon les criteres definis."""
+
+
+def evaluate_response_local(preprompt: str, question: str, response: str) -> dict:
+    """
+    Juge local (hors ligne) : heuristiques simples sur les memes criteres que le juge ChatGPT.
+    Sert quand l'API n'est pas configuree, pour les tests et les runs sans reseau.
+    """
+    text = response.lower()
+    words = re.findall(r"\w+", text)
+    word_count = len(words)
+
+    uses_tu = any(w in words for w in ["tu", "toi", "te", "ton", "ta", "tes"])
+    uses_vous = any(w in words for w in ["vous", "votre", "vos"])
+    professor = "professeur" in question.lower() or "prof" in question.lower().split()
+    if uses_tu and uses_vous:
+        tutoiement = 5
+    elif professor and uses_tu:
+        tutoiement = 0
+    else:
+        tutoiement = 10
+
+    if word_count == 0:
+        clarte = 0
+    elif 20 <= word_count <= 60:
+        clarte = 10
+    else:
+        clarte = 5
+
+    asks_ai = any(marker in question.lower() for marker in ["humain", "robot", "ia ", "intelligence artificielle"])
+    if "je suis humaine" in text or "je ne suis pas une ia" in text:
+        auto_reflexion = 0
+    elif asks_ai:
+        auto_reflexion = 10 if ("ia" in words or "intelligence artificielle" in text) else 5
+    else:
+        auto_reflexion = 5
+
+    empathy_markers = ["comprends", "courage", "super", "bien sur", "avec plaisir", "n'hesite", "n'hésite", "t'inquiete", "t'inquiète"]
+    sens_emotionnel = min(10, 5 + 2 * sum(1 for marker in empathy_markers if marker in text))
+
+    question_words = {w for w in re.findall(r"\w+", question.lower()) if len(w) > 3}
+    overlap = len(question_words & set(words)) / len(question_words) if question_words else 1.0
+    pertinence = round(10 * min(1.0, 0.4 + overlap), 1) if word_count else 0
+
+    unique_ratio = len(set(words)) / word_count if word_count else 0
+    naturel = round(10 * min(1.0, unique_ratio + 0.2), 1)
+
+    evaluation = {
+        "TUTOIEMENT_VOUVOIEMENT": tutoiement,
+        "CLARTE_SYNTHESE": clarte,
+        "AUTO_REFLEXION": auto_reflexion,
+        "SENS_EMOTIONNEL": sens_emotionnel,
+        "HORS_CONTEXTE": 5,  # impossible a verifier sans modele
+        "PERTINENCE": pertinence,
+        "NATUREL_HUMAIN": naturel,
+    }
+    evaluation["NOTE_GLOBALE"] = round(sum(evaluation.values()) / len(evaluation), 1)
+    evaluation["COMMENTAIRE"] = "Evaluation locale heuristique (juge distant indisponible)."
+    return evaluation
 
 
 def evaluate_response(preprompt: str, question: str, response: str) -> dict:
@@ -32,27 +207,61 @@ def evaluate_response(preprompt: str, question: str, response: str) -> dict:
     Returns:
         dict: Evaluation avec notes par critere et note globale
     """
+    return evaluate_batch([(preprompt, question, response)])[0]
 
-    user_message = f"""## PREPROMPT DE MILO (Qwen3)
-{preprompt}
-
-## QUESTION DE L'UTILISATEUR
-{question}
-
-## REPONSE DE MILO
-{response}
 
-Analyse et evalue cette reponse selon les criteres definis."""
+def evaluate_batch(items: list) -> list:
+    """
+    Evalue plusieurs (preprompt, question, reponse) en un minimum d'appels :
+    - les evaluations deja en cache disque sont reprises telles quelles
+    - les autres sont envoyees au juge en une seule requete par preprompt
+    - sans client OpenAI, le juge local est utilise
 
+    Returns:
+        list: Une evaluation (ou None en cas d'echec) par element, dans l'ordre
+    """
+    judge_prompt = load_judge_prompt()
+    client = _get_client()
+    judge = _judge_name(client)
+    keys = [_cache_key(judge, judge_prompt, *item) for item in items]
+    results = [_cache_get(key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    if client is None:
+        for i in missing:
+            results[i] = evaluate_response_local(*items[i])
+            _cache_put(keys[i], results[i])
+        return results
+
+    # Un seul appel par preprompt (le preprompt, tres long, n'est envoye qu'une fois)
+    by_preprompt = {}
+    for i in missing:
+        by_preprompt.setdefault(items[i][0], []).append(i)
+
+    for preprompt, indexes in by_preprompt.items():
+        if len(indexes) == 1:
+            evaluations = [_judge_single(client, judge_prompt, *items[indexes[0]])]
+        else:
+            evaluations = _judge_many(client, judge_prompt, preprompt, [items[i] for i in indexes])
+        for i, evaluation in zip(indexes, evaluations):
+            results[i] = evaluation
+            if evaluation is not None:
+                _cache_put(keys[i], evaluation)
+
+    return results
+
+
+def _judge_single(client, judge_prompt: str, preprompt: str, question: str, response: str):
+    result_text = ""
     try:
-        # Recharger le prompt a chaque evaluation (permet de modifier sans redemarrer)
-        judge_prompt = load_judge_prompt()
-
         completion = client.chat.completions.create(
-            model=OPENAI_MODEL,
+            model=_get_model(),
             messages=[
                 {"role": "system", "content": judge_prompt},
-                {"role": "user", "content": user_message}
+                {"role": "user", "content": _user_message(preprompt, question, response)}
             ],
             temperature=0.3,  # Basse temperature pour des evaluations coherentes
             max_tokens=500
@@ -74,6 +283,105 @@ Analyse et evalue cette reponse selon les criteres definis."""
         return None
 
 
+def _judge_many(client, judge_prompt: str, preprompt: str, items: list) -> list:
+    sections = [f"## PREPROMPT DE MILO (Qwen3)\n{preprompt}\n"]
+    for n, (_, question, response) in enumerate(items, 1):
+        sections.append(f"## ECHANGE {n}\n### QUESTION DE L'UTILISATEUR\n{question}\n\n### REPONSE DE MILO\n{response}\n")
+    sections.append(
+        f"Analyse et evalue chacune des {len(items)} reponses selon les criteres definis. "
+        "Reponds UNIQUEMENT avec un tableau JSON contenant une evaluation au format demande par echange, dans l'ordre."
+    )
+
+    result_text = ""
+    try:
+        completion = client.chat.completions.create(
+            model=_get_model(),
+            messages=[
+                {"role": "system", "content": judge_prompt},
+                {"role": "user", "content": "\n".join(sections)}
+            ],
+            temperature=0.3,
+            max_tokens=500 * len(items)
+        )
+        result_text = completion.choices[0].message.content.strip()
+        evaluations = json.loads(result_text)
+        if isinstance(evaluations, list) and len(evaluations) == len(items):
+            return evaluations
+        print(f"[JUDGE ERROR] Lot de {len(items)} evaluations mal forme, evaluation une par une")
+    except json.JSONDecodeError as e:
+        print(f"[JUDGE ERROR] Impossible de parser le lot JSON: {e}")
+        print(f"[JUDGE ERROR] Reponse brute: {result_text}")
+    except Exception as e:
+        print(f"[JUDGE ERROR] Erreur lors de l'evaluation du lot: {e}")
+
+    return [_judge_single(client, judge_prompt, preprompt, question, response) for _, question, response in items]
+
+
+class JudgeQueue:
+    """
+    File d'evaluation en arriere-plan : submit() rend la main tout de suite,
+    des workers regroupent les demandes par lots (BATCH_SIZE, ou ce qui est arrive en BATCH_WAIT_S).
+    """
+
+    def __init__(self, workers: int = JUDGE_WORKERS, batch_size: int = BATCH_SIZE, batch_wait_s: float = BATCH_WAIT_S):
+        self._queue = queue.Queue()
+        self._batch_size = batch_size
+        self._batch_wait_s = batch_wait_s
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, preprompt: str, question: str, response: str) -> Future:
+        future = Future()
+        # La trace de la question suit l'evaluation jusqu'au worker
+        self._queue.put(((preprompt, question, response), future, myTracer.current()))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self._batch_wait_s
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            start = time.time()
+            try:
+                evaluations = evaluate_batch([item for item, _, _ in batch])
+            except Exception as e:
+                print(f"[JUDGE ERROR] Erreur lors de l'evaluation du lot: {e}")
+                evaluations = [None] * len(batch)
+            end = time.time()
+
+            for ((preprompt, question, response), future, trace_id), evaluation in zip(batch, evaluations):
+                myTracer.record("judge", start, end, trace_id, batch_size=len(batch))
+                print_evaluation(evaluation, question, response)
+                future.set_result(evaluation)
+
+
+_judge_queue = None
+_judge_queue_lock = threading.Lock()
+
+
+def submit_evaluation(preprompt: str, question: str, response: str) -> Future:
+    """Met l'evaluation en file et rend la main tout de suite (le resultat est affiche quand il arrive)."""
+    global _judge_queue
+    with _judge_queue_lock:
+        if _judge_queue is None:
+            _judge_queue = JudgeQueue()
+    return _judge_queue.submit(preprompt, question, response)
+
+
 def print_evaluation(evaluation: dict, question: str = None, response: str = None):
     """
     Affiche l'evaluation dans le terminal de maniere formatee.
@@ -0,0 +1,414 @@
+"""
+Serveur asynchrone (ASGI) de Milo : mêmes routes et évènements Socket.IO que back_launcher.py,
+mais les requêtes et l'envoi des évènements tournent sur une boucle asyncio (uvicorn).
+
+Les étapes lourdes du pipeline (décodage, Whisper, LLM, TTS) ont chacune leur pool de threads
+borné : quand une étape est saturée, l'upload est refusé (503 + Retry-After) au lieu de
+s'empiler. Les chunks du cours passent toujours par le bus (Audio_topic, groupe de consommateurs).
+
+Lancement :
+    cd src
+    python asgi_launcher.py
+"""
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import socketio
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from werkzeug.utils import secure_filename
+
+import back_launcher
+from lib import transcriber, subsynthetizer, file_manager, webm_to_wav_converter, tts
+from lib import message_queue, response_cache, storage_manager
+from lib.tracing import myTracer
+
+HOST = "0.0.0.0"
+PORT = int(os.environ.get("MILO_PORT", "5001"))
+
+# (threads, travaux en attente max) par étape du pipeline des questions
+STAGES = {
+    "decode": (4, 16),
+    "whisper": (1, 8),
+    # Les générations concurrentes sont regroupées par le moteur de batching (BATCHED_INFERENCE)
+    "llm": (8, 8),
+    "tts": (2, 16),
+    "io": (4, 64),
+}
+# Questions traitées en même temps au maximum (au-delà : 503)
+MAX_QUESTIONS_IN_FLIGHT = 8
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedStage:
+    """Pool de threads d'une étape, avec une limite de travaux en cours (exécutés + en attente)."""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"milo-{name}")
+        self.capacity = workers + max_queue
+        self.in_flight = 0
+        self.stats = {"completed": 0, "rejected": 0, "busy_s": 0.0}
+
+    def has_capacity(self):
+        return self.in_flight < self.capacity
+
+    async def run(self, fn, *args):
+        # in_flight n'est modifié que depuis la boucle asyncio : pas besoin de verrou
+        if not self.has_capacity():
+            self.stats["rejected"] += 1
+            raise Overloaded(self.name)
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            # Le contexte (trace courante) suit le travail dans le thread du pool
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.stats["completed"] += 1
+            self.stats["busy_s"] += time.perf_counter() - start
+
+    def get_stats(self):
+        return dict(self.stats, in_flight=self.in_flight, capacity=self.capacity)
+
+
+class AsyncEmitter:
+    """Envoi des évènements du pipeline (threads des listeners du bus) via la boucle asyncio."""
+
+    def __init__(self, sio, loop):
+        self.sio = sio
+        self.loop = loop
+
+    def emit(self, event, data, to=None):
+        asyncio.run_coroutine_threadsafe(self.sio.emit(event, data, to=to), self.loop)
+
+
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", ping_timeout=120, ping_interval=25)
+stages = {name: BoundedStage(name, workers, max_queue) for name, (workers, max_queue) in STAGES.items()}
+# Tâches des questions en cours (référence gardée jusqu'à la fin de la tâche)
+question_tasks = set()
+
+
+async def emit_event(event, data, session_id):
+    with myTracer.span("emit", event=event):
+        await sio.emit(event, data, to=session_id)
+
+
+def busy_response(reason):
+    retry_after = back_launcher.RETRY_AFTER_S
+    return JSONResponse({"error": "busy", "reason": reason, "retry_after": retry_after}, 503, {"Retry-After": str(retry_after)})
+
+
+async def request_session(request, form=None):
+    session_id = (form or {}).get("session_id") or request.query_params.get("session_id") or request.headers.get("X-Session-Id")
+    return file_manager.get_session(session_id)
+
+
+async def save_upload(upload, directory):
+    filename = secure_filename(upload.filename)
+    data = await upload.read()
+    await stages["io"].run(_write_file, Path(directory) / filename, data)
+    return filename
+
+
+def _write_file(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@sio.on("join_session")
+async def join_session(sid, data):
+    try:
+        workspace = file_manager.get_session((data or {}).get("session_id"))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    await sio.enter_room(sid, workspace.session_id)
+    return {"status": "ok", "session_id": workspace.session_id}
+
+
+@sio.on("transcript_sync")
+async def transcript_sync(sid, data):
+    try:
+        workspace = file_manager.get_session((data or {}).get("session_id"))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    return await stages["io"].run(back_launcher.transcript_since, workspace, int((data or {}).get("offset") or 0))
+
+
+async def upload_audio(request):
+    form = await request.form()
+    try:
+        workspace = await request_session(request, form)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+    file = form.get("file")
+    if file is None or not getattr(file, "filename", ""):
+        return JSONResponse({"error": "No file"}, 400)
+
+    chunk_index = back_launcher.parse_chunk_index(form.get("chunk_index"))
+    if chunk_index is None:
+        return JSONResponse({"error": "Invalid chunk_index"}, 400)
+
+    last_chunk = str(form.get("last_chunk", "false")).lower() == "true"
+    if not last_chunk:
+        backlog = await stages["io"].run(back_launcher.audio_backlog)
+        if backlog >= back_launcher.MAX_AUDIO_BACKLOG:
+            return busy_response("audio_backlog")
+
+    with myTracer.activate(myTracer.start_trace("chunk", workspace.session_id)), myTracer.span("upload"):
+        filename = await save_upload(file, workspace.webm_dir)
+        await stages["io"].run(back_launcher.publish_audio_chunk, workspace, filename, last_chunk, chunk_index)
+    return JSONResponse({"status": "ok", "saved_as": str(workspace.webm_dir / filename), "last_chunk": last_chunk})
+
+
+async def start_recording(request):
+    form = await request.form()
+    try:
+        workspace = await request_session(request, form)
+        await stages["io"].run(back_launcher.begin_recording, workspace)
+        return JSONResponse({"status": "ok", "session_id": workspace.session_id})
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+
+async def upload_question(request):
+    form = await request.form()
+    try:
+        workspace = await request_session(request, form)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 400)
+
+    file = form.get("file")
+    if file is None or not getattr(file, "filename", ""):
+        return JSONResponse({"error": "No file"}, 400)
+    if len(question_tasks) >= MAX_QUESTIONS_IN_FLIGHT or not (stages["whisper"].has_capacity() and stages["llm"].has_capacity()):
+        return busy_response("questions")
+
+    await stages["io"].run(workspace.clear_question)
+    trace_id = myTracer.start_trace("question", workspace.session_id)
+    try:
+        with myTracer.activate(trace_id), myTracer.span("upload"):
+            filename = await save_upload(file, workspace.milo_webm_question_dir)
+    except Exception:
+        myTracer.end_trace(trace_id, status="error")
+        raise
+
+    task = asyncio.create_task(process_question(filename, workspace, trace_id))
+    question_tasks.add(task)
+    task.add_done_callback(question_tasks.discard)
+    return JSONResponse({"status": "ok", "session_id": workspace.session_id})
+
+
+async def transcribe_question(filename, workspace):
+    transcript_path = None
+    if webm_to_wav_converter.DECODE_IN_MEMORY:
+        try:
+            audio = await stages["decode"].run(webm_to_wav_converter.decode_to_array, workspace.milo_webm_question_dir, filename)
+            transcript_path = await stages["whisper"].run(transcriber.myTranscrib.transcribe_audio, audio, Path(filename).stem, workspace.question_transcript_dir)
+        except Overloaded:
+            raise
+        except Exception as e:
+            print(f"[decode] In-memory decoding failed for {filename} ({e}), fallback to WAV file")
+
+    if transcript_path is None:
+        wav_file = await stages["decode"].run(webm_to_wav_converter.convert_to_wav, workspace.milo_webm_question_dir, workspace.milo_wav_question_dir, filename)
+        transcript_path = await stages["whisper"].run(transcriber.myTranscrib.transcribe_file, Path(wav_file), workspace.question_transcript_dir)
+
+    # Transcript écrit : l'audio de la question ne sert plus
+    await stages["io"].run(
+        storage_manager.myStorage.ack,
+        workspace.milo_webm_question_dir / filename,
+        workspace.milo_wav_question_dir / f"{Path(filename).stem}.wav",
+    )
+    return transcript_path
+
+
+async def process_question(filename, workspace, trace_id=None):
+    trace_id = trace_id or myTracer.start_trace("question", workspace.session_id)
+    with myTracer.activate(trace_id):
+        try:
+            await _process_question(filename, workspace)
+        finally:
+            myTracer.end_trace(trace_id)
+
+
+async def _process_question(filename, workspace):
+    synth = subsynthetizer.mySynthetizer
+    try:
+        print(f"Processing question: {filename} (session {workspace.session_id})")
+        transcript_file = workspace.question_transcript_dir / await transcribe_question(filename, workspace)
+
+        if back_launcher.RESPONSE_CACHE:
+            question = await stages["io"].run(synth.question_text, transcript_file)
+            context = await stages["io"].run(synth.context_fingerprint, workspace, question)
+            if await stages["io"].run(back_launcher.send_cached_response, transcript_file, question, context, workspace):
+                return
+
+        if back_launcher.STREAM_RESPONSES:
+            sentences, segment_wavs = await stream_question_response(transcript_file, workspace)
+            text = " ".join(sentences)
+        else:
+            output_name = await stages["llm"].run(synth.generate_from_file, transcript_file, True, workspace.milo_response_dir, workspace)
+            response_wav = await stages["tts"].run(tts.myTTS.text_to_speech, workspace.milo_response_dir / output_name, workspace.milo_wav_question_response_dir)
+            await emit_event("new_response_audio", {"filename": os.path.basename(response_wav)}, workspace.session_id)
+            text = (workspace.milo_response_dir / output_name).read_text(encoding="utf-8")
+            segment_wavs = [response_wav]
+
+        if back_launcher.RESPONSE_CACHE:
+            await stages["io"].run(response_cache.myResponseCache.put, question, context, text, segment_wavs)
+    except Overloaded as e:
+        print(f"[ASGI] Etape {e} saturée, question {filename} abandonnée")
+        await emit_event("response_error", {"reason": "busy"}, workspace.session_id)
+    except Exception as e:
+        print(f"Error processing question: {e}")
+        traceback.print_exc()
+
+
+async def stream_question_response(transcript_path, workspace):
+    """
+    Les phrases générées (pool llm) arrivent dans une file asyncio ; chacune est synthétisée (pool tts)
+    et envoyée dès qu'elle est prête, pendant que la génération continue.
+    """
+    loop = asyncio.get_running_loop()
+    sentences_queue = asyncio.Queue()
+    response_id = transcript_path.stem
+    workspace.milo_wav_question_response_dir.mkdir(parents=True, exist_ok=True)
+
+    def produce():
+        try:
+            for sentence in subsynthetizer.mySynthetizer.stream_from_file(transcript_path, True, workspace.milo_response_dir, workspace):
+                loop.call_soon_threadsafe(sentences_queue.put_nowait, sentence)
+        finally:
+            loop.call_soon_threadsafe(sentences_queue.put_nowait, None)
+
+    start_time = time.time()
+    producer = asyncio.ensure_future(stages["llm"].run(produce))
+    sentences = []
+    segment_wavs = []
+    while (sentence := await sentences_queue.get()) is not None:
+        count = len(sentences)
+        segment_wav = await stages["tts"].run(
+            tts.myTTS.sentence_to_speech,
+            sentence,
+            workspace.milo_wav_question_response_dir / f"{response_id}_{count:03d}.wav"
+        )
+        sentences.append(sentence)
+        segment_wavs.append(segment_wav)
+        await emit_event("new_response_segment", {
+            "response_id": response_id,
+            "index": count,
+            "filename": os.path.basename(segment_wav),
+        }, workspace.session_id)
+        if count == 0:
+            myTracer.record("first_segment", start_time, time.time())
+            print(f"First segment sent in {time.time() - start_time:.2f} seconds")
+    await producer
+
+    await emit_event("response_segments_end", {"response_id": response_id, "count": len(sentences)}, workspace.session_id)
+    print(f"Streamed response sent to frontend ({len(sentences)} segments)")
+    return sentences, segment_wavs
+
+
+async def get_audio(request):
+    return await send_session_file(request, "milo_webm_response_dir")
+
+
+async def get_response_audio(request):
+    return await send_session_file(request, "milo_wav_question_response_dir")
+
+
+async def send_session_file(request, dir_name):
+    filename = secure_filename(request.path_params["filename"])
+    try:
+        workspace = await request_session(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    path = getattr(workspace, dir_name) / filename
+    if not path.is_file():
+        return JSONResponse({"error": "Not found"}, 404)
+    return FileResponse(path)
+
+
+async def ready(request):
+    status = back_launcher.ready_status()
+    return JSONResponse(status, 200 if status["ready"] else 503)
+
+
+async def bus_metrics(request):
+    return JSONResponse(await stages["io"].run(message_queue.message_queue_handler.get_metrics))
+
+
+async def metrics(request):
+    lines = await stages["io"].run(back_launcher.metrics_lines)
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+async def traces(request):
+    params = request.query_params
+    return JSONResponse(myTracer.list_traces(params.get("session_id"), params.get("kind"), int(params.get("limit", 50))))
+
+
+async def trace_detail(request):
+    trace = myTracer.get_trace(request.path_params["trace_id"])
+    if trace is None:
+        return JSONResponse({"error": "Unknown trace"}, 404)
+    return JSONResponse(trace)
+
+
+async def inference_metrics(request):
+    status = back_launcher.inference_status()
+    status["stages"] = {name: stage.get_stats() for name, stage in stages.items()}
+    status["questions_in_flight"] = len(question_tasks)
+    return JSONResponse(status)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    back_launcher.emitter = AsyncEmitter(sio, loop)
+    await loop.run_in_executor(None, back_launcher.init_backend)
+    yield
+    message_queue.message_queue_handler.stop()
+
+
+routes = [
+    Route("/upload-audio", upload_audio, methods=["POST"]),
+    Route("/start-recording", start_recording, methods=["POST"]),
+    Route("/upload-question", upload_question, methods=["POST"]),
+    Route("/get-audio/{filename}", get_audio),
+    Route("/get-response-audio/{filename}", get_response_audio),
+    Route("/ready", ready),
+    Route("/bus-metrics", bus_metrics),
+    Route("/inference-metrics", inference_metrics),
+    Route("/metrics", metrics),
+    Route("/traces", traces),
+    Route("/traces/{trace_id}", trace_detail),
+    Mount("/", StaticFiles(directory=back_launcher.FRONT_DIR, html=True)),
+]
+
+starlette_app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
+app = socketio.ASGIApp(sio, other_asgi_app=starlette_app)
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=HOST, port=PORT)
@@ -1,5 +1,5 @@
 from flask import Flask, request, jsonify, send_from_directory
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from pathlib import Path
@@ -7,9 +7,11 @@ import os
 import threading
 import time
 import shutil
+import wave
 
 from lib import transcriber, subsynthetizer, file_manager, webm_to_wav_converter, tts
-from lib import message_queue
+from lib import message_queue, response_cache, retrieval, storage_manager, transcoder, vad
+from lib.tracing import myTracer, prometheus_gauge
 
 app = Flask(__name__)
 CORS(app)
@@ -17,6 +19,78 @@ socketio = SocketIO(app, cors_allowed_origins="*",ping_timeout=120,
     ping_interval=25)
 last_chunk_event = threading.Event()
 
+# Envoi des évènements Socket.IO (remplacé par le serveur asynchrone d'asgi_launcher.py)
+emitter = socketio
+
+def emit(event, data, session_id):
+    with myTracer.span("emit", event=event):
+        emitter.emit(event, data, to=session_id)
+
+def publish(topic, message):
+    """Publie sur le bus en propageant la trace courante (trace_id + heure de publication)."""
+    trace_id = myTracer.current()
+    if trace_id:
+        message = dict(message, trace_id=trace_id, published_at=str(time.time()))
+    message_queue.message_queue_handler.publish(topic, message)
+
+def traced_callback(topic, callback):
+    """Listener du bus exécuté dans la trace du message : attente dans la file puis traitement."""
+    def wrapper(msg):
+        with myTracer.activate(msg.get("trace_id")):
+            if msg.get("published_at"):
+                myTracer.record(f"queue:{topic}", float(msg["published_at"]), time.time())
+            try:
+                with myTracer.span(f"handle:{topic}"):
+                    return callback(msg)
+            except Exception:
+                # Sinon la trace reste ouverte (duration_ms null dans /traces)
+                myTracer.end_trace(status="error")
+                raise
+    return wrapper
+
+# Réponses aux questions envoyées phrase par phrase (False = fichier complet puis new_response_audio)
+STREAM_RESPONSES = True
+
+# Transcription incrémentale des chunks du cours (buffer glissant + contexte, timestamps globaux), un flux par session
+STREAMING_TRANSCRIPTION = True
+
+# Sous-titres en direct : les segments de chaque chunk sont envoyés au front (transcript_delta)
+LIVE_CAPTIONS = True
+
+# Résumé map-reduce calculé pendant le cours (nécessite STREAMING_TRANSCRIPTION)
+INCREMENTAL_SUMMARY = True
+
+# Réponses déjà générées rejouées directement (même question, ou très proche, dans le même contexte de cours)
+RESPONSE_CACHE = True
+
+# Questions et résumés concurrents générés ensemble par le moteur de batching (voir /inference-metrics)
+BATCHED_INFERENCE = True
+
+# Décodage spéculatif quand le batching est désactivé : None, "prompt_lookup" (n-grammes du prompt : résumé,
+# extraits) ou "draft" (petit modèle DRAFT_MODEL, même tokenizer que Qwen3). Gain et taux d'acceptation sur /inference-metrics
+SPECULATIVE_DECODING = None
+DRAFT_MODEL = "Qwen/Qwen3-0.6B"
+
+# Workers par partition d'Audio_topic (voir message_queue.AUDIO_PARTITIONS : une partition n'est lue
+# que par un process, les chunks d'un même cours sont décodés en parallèle puis remis dans l'ordre)
+AUDIO_WORKERS = 2
+# Attente max d'un chunk manquant avant de passer au suivant (au-delà de la transcription la plus lente d'un chunk)
+CHUNK_ORDER_TIMEOUT_S = float(os.environ.get("MILO_CHUNK_ORDER_TIMEOUT_S", "300"))
+chunk_gate = message_queue.SequenceGate(CHUNK_ORDER_TIMEOUT_S)
+# Au-delà de ce nombre de chunks en attente sur Audio_topic, les uploads sont refusés (503 + Retry-After)
+MAX_AUDIO_BACKLOG = 32
+RETRY_AFTER_S = 2
+# Borne de chunk_index (un cours de 10 h en chunks de 10 s en compte 3600)
+MAX_CHUNK_INDEX = 100000
+
+# Run et horloge audio de l'enregistrement en cours : dans l'espace de la session (partagés entre process).
+# Ici seulement le dernier run vu par ce process, pour remettre à zéro son état local quand il change
+local_runs = {}
+local_runs_lock = threading.Lock()
+
+# Nettoyage des sessions inactives (voir file_manager.SESSION_TTL_S)
+SESSION_CLEANUP_INTERVAL_S = 10 * 60
+
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 FRONT_DIR = BASE_DIR / "front"
@@ -30,8 +104,84 @@ def serve_front(path):
         return send_from_directory(FRONT_DIR, "index.html")
 
 
+def request_session():
+    """Session de la requête (champ de formulaire, paramètre d'URL ou en-tête X-Session-Id)."""
+    session_id = request.form.get("session_id") or request.args.get("session_id") or request.headers.get("X-Session-Id")
+    return file_manager.get_session(session_id)
+
+def reset_local_session(session_id):
+    """Etat en mémoire de ce process pour la session (buffer de transcription, résumé incrémental, index)."""
+    transcriber.myStreamingTranscrib.reset(session_id)
+    subsynthetizer.get_summarizer(session_id).reset()
+    retrieval.myRetriever.reset_scope(session_id)
+    chunk_gate.reset(session_id)
+
+def sync_local_run(workspace, run):
+    """Premier chunk d'un nouveau run dans ce process (/start-recording a pu être servi par un autre)."""
+    with local_runs_lock:
+        if local_runs.get(workspace.session_id) == run:
+            return
+        local_runs[workspace.session_id] = run
+    workspace.drop_cached_state()
+    reset_local_session(workspace.session_id)
+
+@socketio.on("join_session")
+def join_session(data):
+    """Le front rejoint la room de sa session : les évènements de la session ne sont envoyés qu'à elle."""
+    try:
+        workspace = file_manager.get_session((data or {}).get("session_id"))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    join_room(workspace.session_id)
+    return {"status": "ok", "session_id": workspace.session_id}
+
+@socketio.on("transcript_sync")
+def transcript_sync(data):
+    """Segments du cours depuis une position du journal (rattrapage des sous-titres après un trou ou une reconnexion)."""
+    try:
+        workspace = file_manager.get_session((data or {}).get("session_id"))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    return transcript_since(workspace, int((data or {}).get("offset") or 0))
+
+def caption_rows(segments):
+    """Segments au format compact des sous-titres : [start, end, texte], timestamps globaux au centième."""
+    return [[round(s.start, 2), round(s.end, 2), s.text] for s in segments]
+
+def transcript_since(workspace, offset):
+    segments, next_offset = workspace.segment_store().read_from(offset)
+    return {
+        "status": "ok",
+        "run": workspace.current_run(),
+        "segments": caption_rows(segments),
+        "next": next_offset,
+        "partial": caption_rows(transcriber.myStreamingTranscrib.partial(workspace.session_id)) if STREAMING_TRANSCRIPTION else [],
+    }
+
+def emit_transcript_delta(workspace, run, from_offset, segments, partial):
+    """
+    Sous-titres en direct : seulement les nouveaux segments stabilisés (from = position du journal avant
+    eux, next = après) et l'hypothèse provisoire de la fin du buffer, qui remplace la précédente.
+    Un front dont la position ne correspond pas à from redemande la suite avec transcript_sync.
+    Envoyé à chaque chunk, même vide : l'hypothèse provisoire précédente doit être effacée.
+    """
+    if not LIVE_CAPTIONS:
+        return
+    emit("transcript_delta", {
+        "run": run,
+        "from": from_offset,
+        "next": workspace.segment_store().end_offset,
+        "segments": caption_rows(segments),
+        "partial": caption_rows(partial),
+    }, workspace.session_id)
+
 @app.route("/upload-audio", methods=["POST"])
 def upload_audio():
+    try:
+        workspace = request_session()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     if "file" not in request.files:
         return jsonify({"error": "No file"}), 400
 
@@ -39,56 +189,147 @@ def upload_audio():
     if file.filename == "":
         return jsonify({"error": "Empty filename"}), 400
 
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(file_manager.webm_dir, filename)
-    file.save(filepath)
+    chunk_index = parse_chunk_index(request.form.get("chunk_index"))
+    if chunk_index is None:
+        return jsonify({"error": "Invalid chunk_index"}), 400
 
     last_chunk = request.form.get("last_chunk", "false").lower() == "true"
+    # Le dernier chunk est toujours accepté : il déclenche le résumé final
+    if not last_chunk and audio_backlog() >= MAX_AUDIO_BACKLOG:
+        return jsonify({"error": "busy", "retry_after": RETRY_AFTER_S}), 503, {"Retry-After": str(RETRY_AFTER_S)}
+
+    with myTracer.activate(myTracer.start_trace("chunk", workspace.session_id)), myTracer.span("upload"):
+        filename = secure_filename(file.filename)
+        filepath = os.path.join(workspace.webm_dir, filename)
+        file.save(filepath)
+        publish_audio_chunk(workspace, filename, last_chunk, chunk_index)
+
+    return jsonify({"status": "ok", "saved_as": filepath, "last_chunk": last_chunk})
+
+def audio_backlog():
+    """Chunks du cours publiés mais pas encore traités (en cours + pas encore lus) sur les partitions d'Audio_topic."""
+    metrics = message_queue.message_queue_handler.get_metrics()
+    backlog = 0
+    for topic in message_queue.audio_topics():
+        stats = metrics.get(topic, {})
+        backlog += (stats.get("pending") or 0) + (stats.get("lag") or 0)
+    return backlog
+
+def parse_chunk_index(value):
+    """Position du chunk dans l'enregistrement, envoyée par le front (None si absente ou invalide)."""
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+    return index if 0 <= index <= MAX_CHUNK_INDEX else None
 
+def publish_audio_chunk(workspace, filename, last_chunk, chunk_index):
     if last_chunk:
         last_chunk_event.set()
 
-    message_queue.message_queue_handler.publish(
-        "Audio_topic", {"filename": filename, "last_chunk": str(last_chunk)}
+    # seq = position dans l'enregistrement (pas l'ordre d'arrivée : un chunk réessayé après un 503 garde sa place)
+    publish(
+        message_queue.audio_topic(workspace.session_id), {
+            "filename": filename,
+            "last_chunk": str(last_chunk),
+            "seq": str(chunk_index),
+            "run": workspace.current_run(),
+            "session_id": workspace.session_id,
+        }
     )
 
-    return jsonify({"status": "ok", "saved_as": filepath, "last_chunk": last_chunk})
+def analyze_chunk(audio, filename):
+    """Zones de parole du chunk décodé par le worker Audio (None : VAD désactivé ou en échec, chunk transcrit tel quel)."""
+    if not vad.VAD_ENABLED or audio is None or isinstance(audio, str):
+        return None
+    start = time.time()
+    try:
+        speech = vad.myVad.analyze(audio)
+    except Exception as e:
+        print(f"[VAD] Analysis failed for {filename}: {e}")
+        return None
+    myTracer.record("vad", start, time.time(), speech_ratio=speech.speech_ratio)
+    print(f"[VAD] {filename} : {speech.speech_ratio:.0%} de parole sur {speech.duration:.1f}s ({speech.backend})")
+    return speech
+
+def chunk_turn(workspace, run, msg):
+    """Tour du chunk dans l'ordre du cours ; le curseur est repris de l'espace de session si ce process ne le connaît pas."""
+    return chunk_gate.turn(workspace.session_id, int(msg.get("seq", 0)), start=lambda: workspace.audio_clock(run)["next_seq"])
+
+def save_chunk_cursor(workspace, run, seq):
+    """Chunk seq traité (appelé sous chunk_gate) : un autre process reprendrait au suivant."""
+    clock = workspace.audio_clock(run)
+    clock["next_seq"] = max(clock["next_seq"], seq + 1)
+    workspace.save_audio_clock(clock)
+
+def advance_audio_clock(workspace, run, duration):
+    """Début du chunk en temps global (appelé dans l'ordre des chunks, sous chunk_gate)."""
+    clock = workspace.audio_clock(run)
+    offset = clock["audio_s"]
+    clock["audio_s"] = offset + duration
+    workspace.save_audio_clock(clock)
+    return offset
 
 @app.route("/get-audio/<filename>")
 def get_audio(filename):
     filename = secure_filename(filename)
-    return send_from_directory(file_manager.milo_webm_response_dir, filename)
+    try:
+        workspace = request_session()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return send_from_directory(workspace.milo_webm_response_dir, filename)
 
 @app.route("/get-response-audio/<filename>")
 def get_response_audio(filename):
     filename = secure_filename(filename)
-    return send_from_directory(file_manager.milo_wav_question_response_dir, filename)
+    try:
+        workspace = request_session()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return send_from_directory(workspace.milo_wav_question_response_dir, filename)
+
+@app.route("/ready")
+def ready():
+    status = ready_status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+def ready_status():
+    from lib.model_registry import whisper_registry
+
+    status = {
+        "whisper_ready": transcriber.myTranscrib.is_ready(),
+        "llm_ready": subsynthetizer.mySynthetizer._hf_model is not None or subsynthetizer.mySynthetizer.provider != "transformers",
+        "whisper": whisper_registry.status(),
+    }
+    status["ready"] = status["whisper_ready"] and status["llm_ready"]
+    return status
 
 @app.route("/start-recording", methods=["POST"])
 def start_recording():
     try:
-        file_manager.clearDirectory(file_manager.webm_dir)
-        file_manager.clearDirectory(file_manager.wav_dir)
-        file_manager.clearDirectory(file_manager.milo_wav_response_dir)
-        file_manager.clearDirectory(file_manager.milo_webm_response_dir)
-        file_manager.clearDirectory(file_manager.sub_resume_dir)
-        file_manager.clearDirectory(file_manager.transcript_dir)
-        file_manager.create_final_transcript()
-        message_queue.clearAllStreams()
-        last_chunk_event.clear()
-        return {"status": "ok"}, 200
+        workspace = request_session()
+        begin_recording(workspace)
+        return {"status": "ok", "session_id": workspace.session_id}, 200
     except Exception as e:
         return {"status": "error", "message": str(e)}, 500
 
+def begin_recording(workspace):
+    session_id = workspace.session_id
+    # Seuls les dossiers de cette session sont vidés ; les chunks encore en file
+    # pour un enregistrement précédent sont ignorés grâce au nouveau run
+    workspace.clear_lecture()
+    workspace.create_final_transcript()
+    run = workspace.start_run()
+    with local_runs_lock:
+        local_runs[session_id] = run
+    reset_local_session(session_id)
+    last_chunk_event.clear()
+
 @app.route("/upload-question", methods=["POST"])
 def upload_question():
     try:
-        file_manager.clearDirectory(file_manager.milo_wav_question_dir)
-        file_manager.clearDirectory(file_manager.milo_webm_question_dir)
-        file_manager.clearDirectory(file_manager.milo_wav_question_response_dir)
-        file_manager.clearDirectory(file_manager.milo_webm_question_response_dir)
-        file_manager.clearDirectory(file_manager.question_transcript_dir)
-        file_manager.clearDirectory(file_manager.milo_response_dir)
+        workspace = request_session()
+        workspace.clear_question()
 
         if "file" not in request.files:
             return jsonify({"error": "No file"}), 400
@@ -96,56 +337,86 @@ def upload_question():
         if file.filename == "":
             return jsonify({"error": "Empty filename"}), 400
 
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(file_manager.milo_webm_question_dir, filename)
-        file.save(filepath)
+        # Trace ouverte dès l'upload, comme celle des chunks du cours (mêmes étapes, comparables)
+        trace_id = myTracer.start_trace("question", workspace.session_id)
+        try:
+            with myTracer.activate(trace_id), myTracer.span("upload"):
+                filename = secure_filename(file.filename)
+                filepath = os.path.join(workspace.milo_webm_question_dir, filename)
+                file.save(filepath)
+        except Exception:
+            myTracer.end_trace(trace_id, status="error")
+            raise
 
         # Process directly without Redis
-        threading.Thread(target=process_question_direct, args=(filename,), daemon=True).start()
+        threading.Thread(target=process_question_direct, args=(filename, workspace, trace_id), daemon=True).start()
 
-        return {"status": "ok"}, 200
+        return {"status": "ok", "session_id": workspace.session_id}, 200
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
     except Exception as e:
         print(f"Error in upload_question: {e}")
         import traceback
         traceback.print_exc()
         return {"status": "error", "message": str(e)}, 500
 
-def process_question_direct(filename):
+def process_question_direct(filename, workspace, trace_id=None):
     """Process question directly without Redis"""
+    trace_id = trace_id or myTracer.start_trace("question", workspace.session_id)
+    with myTracer.activate(trace_id):
+        try:
+            _process_question(filename, workspace)
+        finally:
+            myTracer.end_trace(trace_id)
+
+def _process_question(filename, workspace):
     try:
-        print(f"Processing question: {filename}")
-        # Convert to WAV
-        wav_file = webm_to_wav_converter.convert_to_wav(
-            file_manager.milo_webm_question_dir,
-            file_manager.milo_wav_question_dir,
-            filename
-        )
-        print(f"Converted to WAV: {wav_file}")
-
-        # Transcribe
-        transcript_path = transcriber.myTranscrib.transcribe_file(
-            Path(wav_file),
-            file_manager.question_transcript_dir
+        print(f"Processing question: {filename} (session {workspace.session_id})")
+        # Decode + Transcribe
+        transcript_path = transcribe_webm(
+            transcriber.myTranscrib,
+            workspace.milo_webm_question_dir,
+            workspace.milo_wav_question_dir,
+            filename,
+            workspace.question_transcript_dir
         )
         print(f"Transcribed: {transcript_path}")
+        transcript_file = Path(workspace.question_transcript_dir / transcript_path)
+
+        if RESPONSE_CACHE:
+            question = subsynthetizer.mySynthetizer.question_text(transcript_file)
+            context = subsynthetizer.mySynthetizer.context_fingerprint(workspace, question)
+            if send_cached_response(transcript_file, question, context, workspace):
+                return
+
+        if STREAM_RESPONSES:
+            sentences, segment_wavs = stream_question_response(transcript_file, workspace)
+            if RESPONSE_CACHE:
+                response_cache.myResponseCache.put(question, context, " ".join(sentences), segment_wavs)
+            return
 
         # Generate response with Qwen3
         output_name = subsynthetizer.mySynthetizer.generate_from_file(
-            Path(file_manager.question_transcript_dir / transcript_path),
+            Path(workspace.question_transcript_dir / transcript_path),
             True,
-            file_manager.milo_response_dir
+            workspace.milo_response_dir,
+            workspace
         )
         print(f"Generated response: {output_name}")
 
         # Convert to speech
         milo_response_wav = tts.myTTS.text_to_speech(
-            file_manager.milo_response_dir / output_name,
-            file_manager.milo_wav_question_response_dir
+            workspace.milo_response_dir / output_name,
+            workspace.milo_wav_question_response_dir
         )
         print(f"TTS completed: {milo_response_wav}")
 
+        if RESPONSE_CACHE:
+            with open(workspace.milo_response_dir / output_name, "r", encoding="utf-8") as f:
+                response_cache.myResponseCache.put(question, context, f.read(), [milo_response_wav])
+
         # Emit to frontend
-        socketio.emit("new_response_audio", {"filename": os.path.basename(milo_response_wav)})
+        emit("new_response_audio", {"filename": os.path.basename(milo_response_wav)}, workspace.session_id)
         print("Response sent to frontend")
 
     except Exception as e:
@@ -153,76 +424,340 @@ def process_question_direct(filename):
         import traceback
         traceback.print_exc()
 
+def transcribe_webm(ObjTranscriber, webm_dir, wav_dir, filename, output_dir=None):
+    """
+    Décode le webm en mémoire pour Whisper ; en cas d'échec, repasse par un WAV sur disque (ffmpeg).
+    Une fois le transcript écrit, le webm et le WAV ne servent plus et sont supprimés.
+    """
+    transcript_path = None
+    if webm_to_wav_converter.DECODE_IN_MEMORY:
+        try:
+            audio = webm_to_wav_converter.decode_to_array(webm_dir, filename)
+            transcript_path = ObjTranscriber.transcribe_audio(audio, Path(filename).stem, output_dir)
+        except Exception as e:
+            print(f"[decode] In-memory decoding failed for {filename} ({e}), fallback to WAV file")
+
+    if transcript_path is None:
+        wav_file = webm_to_wav_converter.convert_to_wav(webm_dir, wav_dir, filename)
+        print(f"Converted to WAV: {wav_file}")
+        transcript_path = ObjTranscriber.transcribe_file(Path(wav_file), output_dir)
+
+    storage_manager.myStorage.ack(Path(webm_dir) / filename, Path(wav_dir) / f"{Path(filename).stem}.wav")
+    return transcript_path
+
+def send_cached_response(transcript_path, question, context, workspace):
+    """Rejoue une réponse du cache (texte + audio) ; retourne False si la question n'y est pas."""
+    start_time = time.time()
+    entry = response_cache.myResponseCache.get(question, context)
+    if entry is None:
+        return False
+
+    workspace.milo_response_dir.mkdir(parents=True, exist_ok=True)
+    workspace.milo_wav_question_response_dir.mkdir(parents=True, exist_ok=True)
+    with open(workspace.milo_response_dir / f"{transcript_path.stem}_questions.txt", "w", encoding="utf-8") as out:
+        out.write(entry["text"])
+    response_wav = workspace.milo_wav_question_response_dir / f"{transcript_path.stem}_cached.wav"
+    shutil.copy2(entry["wav"], response_wav)
+
+    emit("new_response_audio", {"filename": response_wav.name}, workspace.session_id)
+    print(f"Cached response sent in {time.time() - start_time:.3f} seconds (similarity {entry['similarity']})")
+    return True
+
+def decode_chunk(workspace, filename):
+    """Audio d'un chunk du cours pour Whisper (buffer en mémoire, sinon WAV sur disque) et sa durée en secondes."""
+    if webm_to_wav_converter.DECODE_IN_MEMORY:
+        try:
+            audio = webm_to_wav_converter.decode_to_array(workspace.webm_dir, filename)
+            return audio, len(audio) / webm_to_wav_converter.WHISPER_SAMPLE_RATE
+        except Exception as e:
+            print(f"[decode] In-memory decoding failed for {filename} ({e}), fallback to WAV file")
+
+    try:
+        wav_file = webm_to_wav_converter.convert_to_wav(workspace.webm_dir, workspace.wav_dir, filename)
+        with wave.open(str(wav_file), "rb") as wav:
+            return str(wav_file), wav.getnframes() / wav.getframerate()
+    except Exception as e:
+        print(f"[decode] Could not decode {filename}: {e}")
+        return None, 0.0
+
+def stream_question_response(transcript_path, workspace):
+    """
+    Génère la réponse en streaming : chaque phrase est synthétisée puis envoyée au front dès qu'elle est prête.
+    Retourne les phrases et les WAV envoyés.
+    """
+    response_id = transcript_path.stem
+    start_time = time.time()
+    count = 0
+    sentences = []
+    segment_wavs = []
+    workspace.milo_wav_question_response_dir.mkdir(parents=True, exist_ok=True)
+
+    for sentence in subsynthetizer.mySynthetizer.stream_from_file(transcript_path, True, workspace.milo_response_dir, workspace):
+        segment_wav = tts.myTTS.sentence_to_speech(
+            sentence,
+            workspace.milo_wav_question_response_dir / f"{response_id}_{count:03d}.wav"
+        )
+        sentences.append(sentence)
+        segment_wavs.append(segment_wav)
+        emit("new_response_segment", {
+            "response_id": response_id,
+            "index": count,
+            "filename": os.path.basename(segment_wav),
+        }, workspace.session_id)
+        if count == 0:
+            myTracer.record("first_segment", start_time, time.time())
+            print(f"First segment sent in {time.time() - start_time:.2f} seconds")
+        count += 1
+
+    emit("response_segments_end", {"response_id": response_id, "count": count}, workspace.session_id)
+    print(f"Streamed response sent to frontend ({count} segments)")
+    return sentences, segment_wavs
+
 def handle_new_audio_file(msg, ObjTranscriber):
     filename = msg["filename"]
     last_chunk = msg.get("last_chunk", "False") == "True"
-    wav_file = webm_to_wav_converter.convert_to_wav(
-        file_manager.webm_dir,
-        file_manager.wav_dir,
-        filename
-        )
-    transcript_file = ObjTranscriber.transcribe_file(Path(wav_file))
-    file_manager.append_and_delete_transcript(transcript_file)
-
-    if last_chunk:
-        print("Tous les chunks reçus, génération finale...")
-        message_queue.message_queue_handler.publish("Transcriber_topic", {"filepath": f"{file_manager.transcript_dir}/transcript_final.txt"})
+    workspace = file_manager.get_session(msg.get("session_id"))
+    session_id = workspace.session_id
+    run = msg.get("run", "")
+    # Run lu dans l'espace de la session : le même pour tous les process, quel que soit celui qui a servi /start-recording
+    if run != workspace.current_run():
+        print(f"[Audio] Chunk {filename} d'un enregistrement précédent ignoré (session {session_id})")
+        storage_manager.myStorage.ack(workspace.webm_dir / filename)
+        myTracer.end_trace(status="stale")
+        return
+    sync_local_run(workspace, run)
+
+    # Le chunk n'est décodé qu'une fois, ici : le VAD travaille sur le même buffer que Whisper
+    silent = False
+    if STREAMING_TRANSCRIPTION and webm_to_wav_converter.DECODE_IN_MEMORY:
+        try:
+            audio = webm_to_wav_converter.decode_to_array(workspace.webm_dir, filename)
+        except Exception as e:
+            # Chunk illisible : on le saute, mais le dernier chunk doit quand même vider le buffer
+            print(f"[decode] Could not decode {filename}: {e}")
+            audio = []
+        speech = analyze_chunk(audio, filename) if len(audio) else None
+        silent = speech is not None and not speech.regions and not last_chunk
+        # Le décodage se fait en parallèle, la transcription incrémentale dans l'ordre des chunks
+        with chunk_turn(workspace, run, msg) as in_order:
+            offset = None
+            if in_order and speech is not None:
+                # Silences du début et de la fin retirés ; le trou dans le temps est signalé par l'offset
+                offset = advance_audio_clock(workspace, run, speech.duration)
+                start_s, end_s = (speech.regions[0][0], speech.regions[-1][1]) if speech.regions else (0.0, 0.0)
+                audio = audio[int(start_s * vad.SAMPLE_RATE):int(end_s * vad.SAMPLE_RATE)]
+                offset += start_s
+            if in_order and not silent:
+                segments = transcriber.myStreamingTranscrib.feed(session_id, audio, final=last_chunk, offset=offset)
+                from_offset = workspace.segment_store().end_offset
+                workspace.segment_store().append(segments)
+                emit_transcript_delta(workspace, run, from_offset, segments, transcriber.myStreamingTranscrib.partial(session_id))
+                retrieval.myRetriever.add_segments(session_id, segments)
+                if INCREMENTAL_SUMMARY:
+                    subsynthetizer.get_summarizer(session_id).add_segments(segments)
+            if in_order:
+                save_chunk_cursor(workspace, run, int(msg.get("seq", 0)))
+    else:
+        # Transcription du chunk seul (en parallèle), puis décalage en temps global dans l'ordre des chunks
+        audio, duration = decode_chunk(workspace, filename)
+        speech = analyze_chunk(audio, filename)
+        silent = speech is not None and not speech.regions and not last_chunk
+        if audio is None or silent:
+            segments = []
+        elif speech is not None:
+            # Whisper ne voit que la parole ; les timestamps sont ramenés sur l'audio d'origine
+            regions = speech.regions
+            segments = ObjTranscriber.transcribe_segments(vad.trim(audio, regions), filename) if regions else []
+            segments = [transcriber.TranscriptSegment(vad.to_original(s.start, regions), vad.to_original(s.end, regions), s.text) for s in segments]
+        else:
+            segments = ObjTranscriber.transcribe_segments(audio, filename)
+        with chunk_turn(workspace, run, msg) as in_order:
+            if in_order:
+                offset = advance_audio_clock(workspace, run, duration)
+            if in_order and not silent:
+                segments = [transcriber.TranscriptSegment(offset + s.start, offset + s.end, s.text) for s in segments]
+                from_offset = workspace.segment_store().end_offset
+                workspace.segment_store().append(segments)
+                emit_transcript_delta(workspace, run, from_offset, segments, [])
+                retrieval.myRetriever.add_segments(session_id, segments)
+            if in_order:
+                save_chunk_cursor(workspace, run, int(msg.get("seq", 0)))
+
+    # Segments écrits dans le journal : le chunk et son éventuel WAV ne servent plus
+    storage_manager.myStorage.ack(workspace.webm_dir / filename, workspace.wav_dir / f"{Path(filename).stem}.wav")
+
+    if not in_order:
+        # Doublon (relivraison) ou chunk arrivé après son tour : déjà traité ou abandonné, rien à publier
+        myTracer.end_trace(status="out_of_order")
+    elif last_chunk:
+        print(f"Tous les chunks reçus, génération finale (session {session_id})...")
+        # Version texte lisible du journal (sauvegarde, outils)
+        workspace.segment_store().export_text(workspace.FINAL_TRANSCRIPT)
+        publish("Transcriber_topic", {"filepath": str(workspace.FINAL_TRANSCRIPT), "session_id": session_id})
+    elif silent:
+        print(f"[VAD] {filename} : silence, non transcrit (session {session_id})")
+        myTracer.end_trace(status="silent")
+    else:
+        myTracer.end_trace()
 
 def handle_new_transcript(msg, ObjLlama):
     file_path = msg["filepath"]
-    ObjLlama.generate_from_file(Path(file_path))
-
-    backup_dir= file_manager.backup_transcript
-    backup_dir.mkdir(exist_ok=True, parents=True)
-
-    for src_dir in [file_manager.transcript_dir, file_manager.sub_resume_dir]:
-        for item in src_dir.iterdir():
-            dest = backup_dir / item.name
-            shutil.copy2(item, dest)
-
-    milo_wav = tts.myTTS.text_to_speech(file_manager.sub_resume_dir / "transcript_final_resume.txt", file_manager.milo_wav_response_dir)
-    milo_webm = webm_to_wav_converter.convert_to_webm(
-        milo_wav,
-        file_manager.milo_webm_response_dir
+    workspace = file_manager.get_session(msg.get("session_id"))
+    summarizer = subsynthetizer.get_summarizer(workspace.session_id)
+    store = workspace.segment_store()
+    if INCREMENTAL_SUMMARY and summarizer.has_content():
+        summarizer.finalize(Path(file_path), output_dir=workspace.sub_resume_dir)
+    elif len(store):
+        # Transcript lu directement depuis le journal en mémoire (pas de relecture ni de parsing du fichier)
+        ObjLlama.generate_from_text(store.text(), Path(file_path), output_dir=workspace.sub_resume_dir)
+    else:
+        ObjLlama.generate_from_file(Path(file_path), output_dir=workspace.sub_resume_dir)
+
+    summary_path = workspace.sub_resume_dir / "transcript_final_resume.txt"
+    if summary_path.exists():
+        retrieval.myRetriever.add_document(summary_path.read_text(encoding="utf-8"), workspace.session_id, "resume")
+
+    # Sauvegarde du cours : archive compressée et horodatée (backup_transcripts/<session>/)
+    storage_manager.myStorage.archive_lecture(workspace)
+    storage_manager.myStorage.enforce_quota()
+
+    # Le PCM de Piper est encodé directement en Opus par le pool de transcodage (pas de WAV intermédiaire)
+    summary_pcm = tts.myTTS.synthesize_pcm(summary_path.read_text(encoding="utf-8"))
+    milo_webm = webm_to_wav_converter.pcm_to_webm(
+        summary_pcm,
+        tts.myTTS.sample_rate,
+        workspace.milo_webm_response_dir / f"out_{int(time.time() * 1000)}.webm"
     )
-    socketio.emit("new_audio", {"filename": os.path.basename(milo_webm)})
+    emit("new_audio", {"filename": os.path.basename(milo_webm)}, workspace.session_id)
+    myTracer.end_trace()
 
 def handle_new_question(msg, ObjTranscriber):
     print(f"NEW Question :{msg}")
     filename = msg["filename"]
-    wav_file = webm_to_wav_converter.convert_to_wav(
-        file_manager.milo_webm_question_dir,
-        file_manager.milo_wav_question_dir,
-        filename
-        )
-    transcript_path=ObjTranscriber.transcribe_file(Path(wav_file),file_manager.question_transcript_dir)
-    message_queue.message_queue_handler.publish("Response_topic",{"filepath": f"{file_manager.question_transcript_dir}/{transcript_path}"})
+    workspace = file_manager.get_session(msg.get("session_id"))
+    transcript_path=transcribe_webm(ObjTranscriber, workspace.milo_webm_question_dir, workspace.milo_wav_question_dir, filename, workspace.question_transcript_dir)
+    publish("Response_topic",{"filepath": f"{workspace.question_transcript_dir}/{transcript_path}", "session_id": workspace.session_id})
 
 def handle_new_response(msg, ObjLlama):
     file_path = msg["filepath"]
-    output_name=ObjLlama.generate_from_file(Path(file_path),True,file_manager.milo_response_dir)
-    milo_response_wav = tts.myTTS.text_to_speech(file_manager.milo_response_dir / output_name, file_manager.milo_wav_question_response_dir)
+    workspace = file_manager.get_session(msg.get("session_id"))
+    output_name=ObjLlama.generate_from_file(Path(file_path),True,workspace.milo_response_dir,workspace)
+    milo_response_wav = tts.myTTS.text_to_speech(workspace.milo_response_dir / output_name, workspace.milo_wav_question_response_dir)
     #milo_response_webm = webm_to_wav_converter.convert_to_webm(
     #    milo_response_wav,
-    #    file_manager.milo_webm_question_response_dir
+    #    workspace.milo_webm_question_response_dir
     #)
-    socketio.emit("new_response_audio", {"filename": os.path.basename(milo_response_wav)})
+    emit("new_response_audio", {"filename": os.path.basename(milo_response_wav)}, workspace.session_id)
+    myTracer.end_trace()
+
+def cleanup_sessions_loop():
+    """Supprime périodiquement les sessions inactives et l'état en mémoire qui leur est associé."""
+    while True:
+        time.sleep(SESSION_CLEANUP_INTERVAL_S)
+        try:
+            for session_id in file_manager.cleanup_expired_sessions():
+                transcriber.myStreamingTranscrib.reset(session_id)
+                subsynthetizer.drop_summarizer(session_id)
+                retrieval.myRetriever.reset_scope(session_id)
+                chunk_gate.reset(session_id)
+                with local_runs_lock:
+                    local_runs.pop(session_id, None)
+        except Exception as e:
+            print(f"[Sessions] Erreur lors du nettoyage : {e}")
+
+def storage_quota_loop():
+    """Vérifie périodiquement le quota disque (sessions et archives)."""
+    while True:
+        try:
+            storage_manager.myStorage.enforce_quota()
+        except Exception as e:
+            print(f"[Storage] Erreur lors du contrôle du quota : {e}")
+        time.sleep(storage_manager.QUOTA_CHECK_INTERVAL_S)
 
 def setup_listeners():
-    message_queue.message_queue_handler.subscribe("Audio_topic", "Audio_listener", callback=lambda msg: handle_new_audio_file(msg, transcriber.myTranscrib))
-    message_queue.message_queue_handler.subscribe("Transcriber_topic", "Transcriber_listener", callback=lambda msg: handle_new_transcript(msg, subsynthetizer.mySynthetizer))
-    message_queue.message_queue_handler.subscribe("Question_topic", "Question_listener", callback=lambda msg: handle_new_question(msg, transcriber.myTranscrib))
-    message_queue.message_queue_handler.subscribe("Response_topic", "Response_listener", callback=lambda msg: handle_new_response(msg, subsynthetizer.mySynthetizer))
-
-if __name__ == "__main__":
+    group = message_queue.CONSUMER_GROUP
+    # Une partition n'est lue que par un process à la fois : les chunks d'une session ne sont pas répartis entre process
+    for topic in message_queue.audio_topics():
+        message_queue.message_queue_handler.subscribe(topic, f"Audio_listener_{topic.rsplit(':', 1)[1]}", callback=traced_callback(topic, lambda msg: handle_new_audio_file(msg, transcriber.myTranscrib)), group=group, workers=AUDIO_WORKERS, exclusive=True)
+    message_queue.message_queue_handler.subscribe("Transcriber_topic", "Transcriber_listener", callback=traced_callback("Transcriber_topic", lambda msg: handle_new_transcript(msg, subsynthetizer.mySynthetizer)), group=group)
+    message_queue.message_queue_handler.subscribe("Question_topic", "Question_listener", callback=traced_callback("Question_topic", lambda msg: handle_new_question(msg, transcriber.myTranscrib)), group=group)
+    message_queue.message_queue_handler.subscribe("Response_topic", "Response_listener", callback=traced_callback("Response_topic", lambda msg: handle_new_response(msg, subsynthetizer.mySynthetizer)), group=group)
+
+@app.route("/bus-metrics")
+def bus_metrics():
+    return jsonify(message_queue.message_queue_handler.get_metrics())
+
+@app.route("/inference-metrics")
+def inference_metrics():
+    return jsonify(inference_status())
+
+@app.route("/metrics")
+def metrics():
+    """Histogrammes des étapes et des traces + état du bus, au format texte Prometheus."""
+    return "\n".join(metrics_lines()) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def metrics_lines():
+    bus = message_queue.message_queue_handler.get_metrics()
+    lines = myTracer.prometheus()
+    lines += prometheus_gauge("milo_bus_pending", "Messages en cours de traitement par topic", "topic", {t: m.get("pending") for t, m in bus.items()})
+    lines += prometheus_gauge("milo_bus_lag", "Messages pas encore lus par topic", "topic", {t: m.get("lag") for t, m in bus.items()})
+    vad_stats = vad.myVad.get_stats()
+    lines += prometheus_gauge("milo_vad_seconds", "Audio reçu et parole transcrite (s)", "kind", {"audio": vad_stats["audio_s"], "speech": vad_stats["speech_s"]})
+    lines += prometheus_gauge("milo_vad_chunks", "Chunks analysés par le VAD", "kind", {"all": vad_stats["chunks"], "silent": vad_stats["silent_chunks"]})
+    transcoder_stats = transcoder.myTranscoder.get_stats()
+    lines += prometheus_gauge("milo_transcoder_jobs", "Jobs du pool de transcodage", "kind", {k: transcoder_stats[k] for k in ("in_flight", "jobs", "errors")})
+    storage = storage_manager.myStorage.get_stats()
+    lines += prometheus_gauge("milo_storage_bytes", "Occupation disque (sessions et archives) et quota", "kind", {"usage": storage["usage_bytes"], "quota": storage["quota_bytes"]})
+    speculative = subsynthetizer.mySynthetizer.get_speculative_stats()
+    if speculative is not None:
+        lines += prometheus_gauge("milo_speculative_tokens", "Tokens du décodage spéculatif", "kind", {k: speculative[k] for k in ("drafted", "accepted", "tokens")})
+    return lines
+
+@app.route("/traces")
+def traces():
+    """Dump JSON des traces récentes (?session_id=, ?kind=, ?limit=)."""
+    return jsonify(myTracer.list_traces(request.args.get("session_id"), request.args.get("kind"), int(request.args.get("limit", 50))))
+
+@app.route("/traces/<trace_id>")
+def trace_detail(trace_id):
+    trace = myTracer.get_trace(trace_id)
+    if trace is None:
+        return jsonify({"error": "Unknown trace"}), 404
+    return jsonify(trace)
+
+def inference_status():
+    synth = subsynthetizer.mySynthetizer
+    return {
+        "batching": synth.batching,
+        "scheduler": synth.get_scheduler().stats() if synth.batching else None,
+        "prefix_cache": synth.get_prefix_cache_stats(),
+        "runtime": synth.get_runtime_stats(),
+        "speculative": synth.get_speculative_stats(),
+        "response_cache": response_cache.myResponseCache.get_stats(),
+        "retrieval": retrieval.myRetriever.get_stats(),
+        "vad": vad.myVad.get_stats(),
+        "chunk_order": dict(chunk_gate.stats),
+        "transcoder": transcoder.myTranscoder.get_stats(),
+        "storage": storage_manager.myStorage.get_stats(),
+    }
+
+def init_backend():
+    """Dossiers, streams, listeners du bus et chargement des modèles (commun aux deux serveurs)."""
     file_manager.clearAllDirectories()
     message_queue.clearAllStreams()
     file_manager.create_final_transcript()
     setup_listeners()
+    threading.Thread(target=cleanup_sessions_loop, daemon=True).start()
+    threading.Thread(target=storage_quota_loop, daemon=True).start()
 
-    # Pre-load models to avoid threading issues
-    print("Loading Whisper model...")
-    transcriber.myTranscrib.load_model()
+    # Whisper se charge en arrière-plan (une seule instance partagée), voir /ready
+    print("Loading Whisper model in background...")
+    transcriber.myTranscrib.warm_up()
+    transcoder.myTranscoder.warm_up()
+
+    subsynthetizer.mySynthetizer.batching = BATCHED_INFERENCE and subsynthetizer.mySynthetizer.provider == "transformers"
+    subsynthetizer.mySynthetizer.speculative = SPECULATIVE_DECODING
+    subsynthetizer.mySynthetizer.draft_model = DRAFT_MODEL
 
     print("Pre-loading Qwen3 model...")
     try:
@@ -231,6 +766,8 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"Warning: Could not pre-load Qwen3 model: {e}")
 
+if __name__ == "__main__":
+    init_backend()
     socketio.run(app, host="0.0.0.0", port=5001, debug=True, use_reloader=False)
 
 
@@ -0,0 +1,427 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional
+
+# Attente max d'un token en streaming : au-delà, la requête est annulée (scheduler bloqué)
+STREAM_TIMEOUT_S = 120
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _cache_pairs(cache):
+    """(keys, values) de chaque couche d'un DynamicCache (API transformers 5.x puis 4.x)."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _make_cache(pairs):
+    from transformers import DynamicCache
+    return DynamicCache(pairs)
+
+
+def resolve_do_sample(model, do_sample):
+    """do_sample=None : valeur de la generation_config du modèle (comme generate())."""
+    if do_sample is None:
+        return bool(getattr(model.generation_config, "do_sample", False))
+    return do_sample
+
+
+def sampling_params(model, do_sample, temperature, top_p, top_k):
+    """
+    (sampling ?, temperature, top_p, top_k) appliqués par tous les chemins de génération (generate(),
+    batching, décodage spéculatif) : avec do_sample, les paramètres de la requête ; sinon le choix vient
+    de la generation_config du modèle, avec les paramètres neutres 1.0 / 1.0 / 50.
+    """
+    if do_sample:
+        return True, temperature, top_p, top_k
+    return resolve_do_sample(model, do_sample), 1.0, 1.0, 50
+
+
+def sampling_logits(logits, temperature, top_k, top_p):
+    """Logits après température, top-k et top-p (les tokens exclus sont à -inf)."""
+    import torch
+
+    logits = logits.float() / temperature
+    if top_k and top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        remove = cumulative - torch.softmax(sorted_logits, dim=-1) > top_p
+        logits[sorted_idx[remove]] = float("-inf")
+    return logits
+
+
+def incremental_text(tokenizer, token_ids):
+    """Texte produit au fil des token ids (les caractères multi-tokens ne sont émis qu'une fois complets)."""
+    seen = []
+    text = ""
+    for token_id in token_ids:
+        seen.append(token_id)
+        full = tokenizer.decode(seen, skip_special_tokens=True)
+        if len(full) > len(text) and not full.endswith("\ufffd"):
+            yield full[len(text):]
+            text = full
+
+
+class GenerationRequest:
+    def __init__(self, prompt, isQuestion, system_prompt, temperature, top_p, top_k, do_sample, max_new_tokens, stream):
+        self.prompt = prompt
+        self.isQuestion = isQuestion
+        self.system_prompt = system_prompt
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.do_sample = do_sample
+        self.max_new_tokens = max_new_tokens
+        self.tokens = []
+        self.future = Future()
+        # File de token ids pour le streaming (None = fin)
+        self.stream = queue.Queue() if stream else None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.first_token_at = None
+        # Consommateur parti (générateur de stream() fermé) : la ligne quitte le batch au pas suivant
+        self.cancelled = False
+
+    def add_token(self, token_id):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.tokens.append(token_id)
+        if self.stream is not None:
+            self.stream.put(token_id)
+
+
+class BatchScheduler:
+    """
+    Moteur de génération partagé devant le provider transformers (continuous batching) :
+    - les requêtes en attente rejoignent le batch en cours entre deux pas de décodage (prefill individuel,
+      avec le cache KV du prompt systeme, puis fusion dans le batch avec padding à gauche)
+    - chaque requête garde ses paramètres de sampling et son max_new_tokens
+    - une requête terminée (EOS ou max_new_tokens) quitte le batch tout de suite
+    Un seul thread utilise le modèle ; stats() donne latences p50/p95 et débit.
+    """
+
+    def __init__(self, synthesizer, max_batch_size: int = 8, stats_window: int = 200):
+        self._synth = synthesizer
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # Requêtes du batch en cours (terminées en erreur si la boucle plante)
+        self._rows = []
+
+        self._completed = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._generated_tokens = 0
+        self._decode_s = 0.0
+
+    def _ensure_started(self):
+        with self._thread_lock:
+            # Relancé s'il est mort : sinon toutes les requêtes suivantes attendraient indéfiniment
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name="batch-scheduler")
+                self._thread.start()
+
+    def in_scheduler_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(
+        self,
+        prompt: str,
+        isQuestion: bool = False,
+        system_prompt: Optional[str] = None,
+        temperature: float = 0.3,
+        top_p: float = 0.85,
+        top_k: int = 40,
+        do_sample: bool = None,
+        max_new_tokens: int = 256,
+        stream: bool = False,
+    ) -> GenerationRequest:
+        request = GenerationRequest(prompt, isQuestion, system_prompt, temperature, top_p, top_k, do_sample, max_new_tokens, stream)
+        self._ensure_started()
+        self._queue.put(request)
+        return request
+
+    def generate(self, prompt: str, isQuestion: bool = False, **kwargs) -> str:
+        """Comme run_transformers : retourne le texte généré (nettoyé pour le TTS)."""
+        return self.submit(prompt, isQuestion, **kwargs).future.result()
+
+    def stream(self, prompt: str, isQuestion: bool = False, **kwargs):
+        """Comme stream_transformers : produit le texte brut au fil des tokens."""
+        request = self.submit(prompt, isQuestion, stream=True, **kwargs)
+        try:
+            yield from incremental_text(self._synth._hf_tokenizer, self._stream_tokens(request))
+            # Propage une éventuelle erreur du scheduler
+            request.future.result()
+        finally:
+            # Générateur fermé avant la fin (client parti, erreur en aval) : plus de tokens à produire
+            if not request.future.done():
+                request.cancelled = True
+
+    @staticmethod
+    def _stream_tokens(request):
+        while True:
+            try:
+                token_id = request.stream.get(timeout=STREAM_TIMEOUT_S)
+            except queue.Empty:
+                raise TimeoutError(f"No token from the batch scheduler for {STREAM_TIMEOUT_S}s")
+            if token_id is None:
+                return
+            yield token_id
+
+    # --- boucle de génération ---
+
+    def _stop_ids(self):
+        tokenizer = self._synth._hf_tokenizer
+        model = self._synth._hf_model
+        stop_ids = set()
+        if tokenizer.eos_token_id is not None:
+            stop_ids.add(tokenizer.eos_token_id)
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        if isinstance(eos, int):
+            stop_ids.add(eos)
+        elif eos:
+            stop_ids.update(eos)
+        return stop_ids
+
+    def _sample(self, logits, request):
+        import torch
+
+        sample, temperature, top_p, top_k = sampling_params(
+            self._synth._hf_model, request.do_sample, request.temperature, request.top_p, request.top_k
+        )
+        if not sample or temperature <= 0:
+            return int(torch.argmax(logits))
+
+        logits = sampling_logits(logits, temperature, top_k, top_p)
+        return int(torch.multinomial(torch.softmax(logits, dim=-1), 1))
+
+    def _prefill(self, request):
+        """Prefill d'une requête seule : retourne (paires KV de la ligne, premier token)."""
+        import torch
+        from transformers import DynamicCache
+
+        synth = self._synth
+        request.started_at = time.time()
+        inputs, past_key_values = synth._prepare_transformers_inputs(request.prompt, request.isQuestion, request.system_prompt)
+        input_ids = inputs["input_ids"]
+        if past_key_values is not None:
+            input_ids = input_ids[:, past_key_values.get_seq_length():]
+        else:
+            past_key_values = DynamicCache()
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = synth._hf_model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+        synth._record_prefill(time.perf_counter() - start, input_ids.shape[1] != inputs["input_ids"].shape[1])
+        return _cache_pairs(outputs.past_key_values), self._sample(outputs.logits[0, -1], request)
+
+    def _finish(self, request, error=None):
+        if request.stream is not None:
+            request.stream.put(None)
+        if request.future.done():
+            return
+        if request.cancelled:
+            request.future.cancel()
+            return
+        if error is not None:
+            request.future.set_exception(error)
+            return
+
+        text = self._synth._hf_tokenizer.decode(request.tokens, skip_special_tokens=True)
+        request.future.set_result(self._synth.clean_text_for_tts(text))
+        # Du prefill au dernier token (l'attente dans la file n'est pas du temps de génération)
+        self._synth._record_generation(len(request.tokens), time.time() - (request.started_at or request.submitted_at))
+        self._completed.append({
+            "done_at": time.time(),
+            "latency_s": time.time() - request.submitted_at,
+            "first_token_s": (request.first_token_at or time.time()) - request.submitted_at,
+            "tokens": len(request.tokens),
+        })
+
+    def _is_done(self, request, token_id, stop_ids):
+        return token_id in stop_ids or len(request.tokens) >= request.max_new_tokens
+
+    def _run(self):
+        """Thread du scheduler : une erreur inattendue termine les requêtes du batch en cours, puis la boucle repart."""
+        while True:
+            try:
+                self._loop()
+            except Exception as e:
+                print(f"[BatchScheduler] Erreur inattendue, batch abandonné : {e}")
+                for request in self._rows:
+                    self._finish(request, e)
+                self._rows.clear()
+
+    def _loop(self):
+        import torch
+
+        rows = self._rows   # requêtes actives, dans l'ordre des lignes du batch (modifiée sur place)
+        rows.clear()
+        pairs = None        # KV du batch par couche : (B, heads, T, dim)
+        attention = None    # masque (B, T), 0 = padding à gauche
+        last_tokens = []    # dernier token de chaque ligne
+        stop_ids = None
+
+        while True:
+            # 1) Admission : les requêtes en attente rejoignent le batch (sans attendre s'il tourne déjà)
+            while len(rows) < self.max_batch_size:
+                try:
+                    request = self._queue.get(block=not rows, timeout=None)
+                except queue.Empty:
+                    break
+                if request.cancelled:
+                    self._finish(request)
+                    continue
+                try:
+                    self._synth._ensure_hf_model_loaded()
+                    if stop_ids is None:
+                        stop_ids = self._stop_ids()
+                    row_pairs, token_id = self._prefill(request)
+                    request.add_token(token_id)
+                    if self._is_done(request, token_id, stop_ids):
+                        self._finish(request)
+                        continue
+                    # Le batch n'est remplacé qu'une fois la fusion réussie
+                    pairs, attention = self._merge_row(pairs, attention, row_pairs)
+                except Exception as e:
+                    print(f"[BatchScheduler] Erreur lors de l'admission : {e}")
+                    self._finish(request, e)
+                    continue
+
+                rows.append(request)
+                last_tokens.append(token_id)
+
+            if not rows:
+                continue
+
+            # 2) Un pas de décodage pour tout le batch
+            self._batch_sizes.append(len(rows))
+            start = time.perf_counter()
+            try:
+                device = attention.device
+                attention = torch.cat([attention, torch.ones((len(rows), 1), dtype=attention.dtype, device=device)], dim=1)
+                position_ids = attention.sum(dim=1, keepdim=True) - 1
+                cache = _make_cache(pairs)
+                with torch.no_grad():
+                    outputs = self._synth._hf_model(
+                        input_ids=torch.tensor([[t] for t in last_tokens], device=device),
+                        attention_mask=attention,
+                        position_ids=position_ids,
+                        past_key_values=cache,
+                        use_cache=True,
+                    )
+                pairs = _cache_pairs(outputs.past_key_values)
+            except Exception as e:
+                print(f"[BatchScheduler] Erreur pendant le décodage : {e}")
+                for request in rows:
+                    self._finish(request, e)
+                rows.clear()
+                pairs, attention, last_tokens = None, None, []
+                continue
+
+            keep = []
+            for i, request in enumerate(rows):
+                if request.cancelled:
+                    self._finish(request)
+                    continue
+                try:
+                    token_id = self._sample(outputs.logits[i, -1], request)
+                except Exception as e:
+                    # Ex: paramètres de sampling invalides (probabilités NaN) : seule cette requête échoue
+                    print(f"[BatchScheduler] Erreur lors du sampling : {e}")
+                    self._finish(request, e)
+                    continue
+                request.add_token(token_id)
+                last_tokens[i] = token_id
+                if self._is_done(request, token_id, stop_ids):
+                    self._finish(request)
+                else:
+                    keep.append(i)
+            self._generated_tokens += len(rows)
+            self._decode_s += time.perf_counter() - start
+
+            # 3) Les requêtes terminées quittent le batch
+            if len(keep) != len(rows):
+                if not keep:
+                    rows.clear()
+                    pairs, attention, last_tokens = None, None, []
+                    continue
+                index = torch.tensor(keep, device=attention.device)
+                rows[:] = [rows[i] for i in keep]
+                last_tokens = [last_tokens[i] for i in keep]
+                attention = attention.index_select(0, index)
+                pairs = [(k.index_select(0, index), v.index_select(0, index)) for k, v in pairs]
+                pairs, attention = self._trim_padding(pairs, attention)
+
+    @staticmethod
+    def _merge_row(pairs, attention, row_pairs):
+        """Ajoute une ligne au batch en alignant les longueurs par padding à gauche (masqué)."""
+        import torch
+        import torch.nn.functional as F
+
+        row_len = row_pairs[0][0].shape[2]
+        device = row_pairs[0][0].device
+        if pairs is None:
+            return row_pairs, torch.ones((1, row_len), dtype=torch.long, device=device)
+
+        batch_len = attention.shape[1]
+        length = max(batch_len, row_len)
+
+        def left_pad(t, n):
+            return F.pad(t, (0, 0, n, 0)) if n else t
+
+        merged = []
+        for (k, v), (rk, rv) in zip(pairs, row_pairs):
+            merged.append((
+                torch.cat([left_pad(k, length - batch_len), left_pad(rk, length - row_len)], dim=0),
+                torch.cat([left_pad(v, length - batch_len), left_pad(rv, length - row_len)], dim=0),
+            ))
+        row_attention = torch.ones((1, row_len), dtype=attention.dtype, device=device)
+        attention = torch.cat([
+            F.pad(attention, (length - batch_len, 0)),
+            F.pad(row_attention, (length - row_len, 0)),
+        ], dim=0)
+        return merged, attention
+
+    @staticmethod
+    def _trim_padding(pairs, attention):
+        """Retire les colonnes de padding communes à toutes les lignes restantes."""
+        start = int(attention.any(dim=0).int().argmax())
+        if start == 0:
+            return pairs, attention
+        return [(k[:, :, start:], v[:, :, start:]) for k, v in pairs], attention[:, start:]
+
+    def stats(self) -> dict:
+        """Latences p50/p95 (s), débit en questions/minute et tokens/s sur la fenêtre récente."""
+        completed = list(self._completed)
+        latencies = [c["latency_s"] for c in completed]
+        first_tokens = [c["first_token_s"] for c in completed]
+        throughput = None
+        if len(completed) >= 2:
+            span = completed[-1]["done_at"] - min(c["done_at"] - c["latency_s"] for c in completed)
+            throughput = 60 * len(completed) / span if span > 0 else None
+
+        return {
+            "completed": len(completed),
+            "queued": self._queue.qsize(),
+            "latency_p50_s": _percentile(latencies, 50),
+            "latency_p95_s": _percentile(latencies, 95),
+            "first_token_p50_s": _percentile(first_tokens, 50),
+            "first_token_p95_s": _percentile(first_tokens, 95),
+            "questions_per_min": throughput,
+            "avg_batch_size": sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else None,
+            "decode_tokens_per_s": self._generated_tokens / self._decode_s if self._decode_s else None,
+        }
@@ -0,0 +1,129 @@
+import copy
+import gc
+import os
+import time
+
+# Runtime CPU du modèle Qwen : "auto" (le plus rapide mesuré), "fp32", "bf16" ou "int8"
+CPU_RUNTIME = os.environ.get("MILO_CPU_RUNTIME", "auto")
+# Nombre de threads torch (0 = nombre de coeurs physiques)
+CPU_THREADS = int(os.environ.get("MILO_CPU_THREADS", "0"))
+# torch.compile du forward (long au premier appel, à activer sur les machines de prod)
+TORCH_COMPILE = os.environ.get("MILO_TORCH_COMPILE", "0") == "1"
+
+BENCH_PROMPT = "Bonjour, peux-tu me parler de l'ECE Paris ?"
+BENCH_TOKENS = 16
+
+
+def configure_threads():
+    import torch
+
+    threads = CPU_THREADS
+    if threads <= 0:
+        try:
+            import psutil
+            threads = psutil.cpu_count(logical=False) or 0
+        except ImportError:
+            threads = 0
+    if threads > 0:
+        torch.set_num_threads(threads)
+    return torch.get_num_threads()
+
+
+def bf16_supported():
+    import torch
+
+    try:
+        return bool(torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported())
+    except AttributeError:
+        return False
+
+
+def int8_supported():
+    import torch
+
+    return any(engine != "none" for engine in torch.backends.quantized.supported_engines)
+
+
+def available_runtimes():
+    runtimes = ["fp32"]
+    if bf16_supported():
+        runtimes.append("bf16")
+    if int8_supported():
+        runtimes.append("int8")
+    return runtimes
+
+
+def apply_runtime(model, runtime, keep_original=False):
+    """Retourne le modèle converti pour ce runtime (keep_original : ne pas convertir le modèle fp32 en place)."""
+    import torch
+
+    if runtime == "fp32":
+        return model.float()
+    if runtime == "bf16":
+        return (copy.deepcopy(model) if keep_original else model).to(torch.bfloat16)
+    if runtime == "int8":
+        # Poids des couches linéaires en int8, activations quantifiées à la volée
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=not keep_original)
+    raise ValueError(f"Unknown CPU runtime: {runtime}")
+
+
+def measure_tokens_per_s(model, tokenizer, new_tokens=BENCH_TOKENS):
+    """Débit de génération (greedy, nombre de tokens fixe) sur un prompt court."""
+    import torch
+
+    inputs = tokenizer(BENCH_PROMPT, return_tensors="pt")
+    kwargs = {"do_sample": False, "pad_token_id": tokenizer.pad_token_id}
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=2, min_new_tokens=2, **kwargs)
+        start = time.perf_counter()
+        model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, **kwargs)
+    return new_tokens / (time.perf_counter() - start)
+
+
+def select_runtime(model, tokenizer, preferred=CPU_RUNTIME):
+    """
+    Prépare le modèle pour le CPU : threads, puis runtime demandé, ou en "auto"
+    le plus rapide des runtimes disponibles (mesuré en tokens/s).
+    Retourne (modèle, rapport).
+    """
+    report = {"threads": configure_threads(), "available": available_runtimes(), "tokens_per_s": {}}
+
+    candidates = report["available"] if preferred == "auto" else [preferred]
+    if len(candidates) > 1:
+        # Chaque candidat est mesuré puis libéré avant le suivant : une seule copie en plus du modèle fp32
+        speeds = {}
+        for runtime in candidates:
+            try:
+                candidate = apply_runtime(model, runtime, keep_original=True)
+                speeds[runtime] = measure_tokens_per_s(candidate, tokenizer)
+            except Exception as e:
+                print(f"[CPU RUNTIME] {runtime} indisponible : {e}")
+                continue
+            finally:
+                candidate = None
+                gc.collect()
+            report["tokens_per_s"][runtime] = round(speeds[runtime], 2)
+            print(f"[CPU RUNTIME] {runtime} : {speeds[runtime]:.1f} tokens/s")
+        best_runtime = max(speeds, key=speeds.get) if speeds else "fp32"
+    else:
+        best_runtime = candidates[0]
+
+    # Le runtime retenu est appliqué au modèle d'origine (converti en place quand c'est possible)
+    try:
+        best_model = apply_runtime(model, best_runtime)
+    except Exception as e:
+        print(f"[CPU RUNTIME] {best_runtime} indisponible : {e}")
+        best_model, best_runtime = model.float(), "fp32"
+
+    if TORCH_COMPILE:
+        try:
+            import torch
+            best_model.forward = torch.compile(best_model.forward, dynamic=True)
+            report["compiled"] = True
+        except Exception as e:
+            print(f"[CPU RUNTIME] torch.compile impossible : {e}")
+            report["compiled"] = False
+
+    report["runtime"] = best_runtime
+    print(f"[CPU RUNTIME] Runtime retenu : {best_runtime} ({report['threads']} threads)")
+    return best_model, report
@@ -1,3 +1,9 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
 from pathlib import Path
 
 project_root_dir = Path(__file__).resolve().parent.parent.parent
@@ -25,6 +31,18 @@ backup_transcript = project_root_dir / "backup_transcripts"
 
 FINAL_TRANSCRIPT = transcript_dir / "transcript_final.txt"
 
+# Espaces de travail par session (une salle de cours / un navigateur = une session)
+sessions_dir = project_root_dir / "sessions"
+DEFAULT_SESSION = "default"
+SESSION_TTL_S = 2 * 60 * 60
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def _write_atomic(path, text):
+    """Ecrit à côté puis renomme : un autre process ne lit jamais un fichier à moitié écrit."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
 def clearDirectory(path):
     if not path.exists():
             print(f"Folder {path} don't exist.")
@@ -55,27 +73,173 @@ def clearAllDirectories():
     clearDirectory(question_transcript_dir)
     clearDirectory(milo_response_dir)
 
-def create_final_transcript():
-    transcript_dir.mkdir(parents=True, exist_ok=True)
-    if not FINAL_TRANSCRIPT.exists():
-        FINAL_TRANSCRIPT.touch()
-        print(f"{FINAL_TRANSCRIPT} créé.")
+def create_final_transcript(final_transcript=None):
+    final_transcript = final_transcript or FINAL_TRANSCRIPT
+    final_transcript.parent.mkdir(parents=True, exist_ok=True)
+    if not final_transcript.exists():
+        final_transcript.touch()
+        print(f"{final_transcript} créé.")
     else:
-        print(f"{FINAL_TRANSCRIPT} existe déjà.")
-
-
-def append_and_delete_transcript(filename):
-
-    file_path = transcript_dir / filename
-    if not file_path.exists():
-        print(f"Le fichier {file_path} n'existe pas.")
-        return
-
-    with file_path.open("r", encoding="utf-8") as f_src, FINAL_TRANSCRIPT.open("a", encoding="utf-8") as f_dest:
-        f_dest.write(f_src.read())
+        print(f"{final_transcript} existe déjà.")
+
+
+class SessionWorkspace:
+    """
+    Dossiers d'une session, avec les mêmes noms que les dossiers globaux du module
+    (webm_dir, transcript_dir, FINAL_TRANSCRIPT...), sous sessions/<session_id>/.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.root = sessions_dir / session_id
+
+        self.wav_dir = self.root / "recorder" / "wav"
+        self.webm_dir = self.root / "recorder" / "webm"
+
+        self.milo_wav_response_dir = self.root / "milo_audio" / "wav"
+        self.milo_webm_response_dir = self.root / "milo_audio" / "webm"
 
-    try:
-        file_path.unlink()
-        print(f"{file_path} a été concaténé dans {FINAL_TRANSCRIPT} et supprimé.")
-    except Exception as e:
-        print(f"Erreur lors de la suppression de {file_path}: {e}")
\ No newline at end of file
+        self.milo_wav_question_dir = self.root / "milo_question" / "wav"
+        self.milo_webm_question_dir = self.root / "milo_question" / "webm"
+
+        self.milo_webm_question_response_dir = self.root / "milo_response" / "webm"
+        self.milo_wav_question_response_dir = self.root / "milo_response" / "wav"
+
+        self.transcript_dir = self.root / "transcripts"
+        self.question_transcript_dir = self.root / "question_transcripts"
+        self.milo_response_dir = self.root / "response"
+        self.sub_resume_dir = self.root / "sub_resumes"
+
+        self.backup_transcript = backup_transcript / session_id
+
+        self.FINAL_TRANSCRIPT = self.transcript_dir / "transcript_final.txt"
+        # Journal append-only des segments du cours (voir lib/segment_store.py)
+        self.SEGMENT_STORE = self.transcript_dir / "transcript_final.seg"
+        self._segment_store = None
+
+        # Enregistrement en cours, partagé entre les process (l'upload et le worker Audio ne sont pas
+        # forcément dans le même) : run courant et horloge audio du worker qui transcrit les chunks
+        self.RECORDING_RUN = self.root / "recording_run"
+        self.AUDIO_CLOCK = self.root / "audio_clock.json"
+
+    def lecture_dirs(self):
+        return [self.webm_dir, self.wav_dir, self.milo_wav_response_dir, self.milo_webm_response_dir,
+                self.sub_resume_dir, self.transcript_dir]
+
+    def question_dirs(self):
+        return [self.milo_wav_question_dir, self.milo_webm_question_dir, self.milo_wav_question_response_dir,
+                self.milo_webm_question_response_dir, self.question_transcript_dir, self.milo_response_dir]
+
+    def create(self):
+        for path in self.lecture_dirs() + self.question_dirs():
+            path.mkdir(parents=True, exist_ok=True)
+        self.touch()
+        return self
+
+    def clear_lecture(self):
+        for path in self.lecture_dirs():
+            clearDirectory(path)
+        self.drop_cached_state()
+
+    def drop_cached_state(self):
+        """Oublie l'état gardé en mémoire par ce process (journal des segments, relu au prochain accès)."""
+        self._segment_store = None
+
+    def segment_store(self):
+        """Journal des segments du cours (rouvert et récupéré depuis le disque au premier accès)."""
+        if self._segment_store is None:
+            from lib.segment_store import SegmentStore
+            self._segment_store = SegmentStore(self.SEGMENT_STORE)
+        return self._segment_store
+
+    def start_run(self):
+        """Nouvel enregistrement : les chunks d'un run précédent encore en file seront ignorés."""
+        run = f"{time.time_ns():x}"
+        _write_atomic(self.RECORDING_RUN, run)
+        return run
+
+    def current_run(self):
+        try:
+            return self.RECORDING_RUN.read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return ""
+
+    def audio_clock(self, run):
+        """Horloge audio du run (secondes de cours transcrites, prochain chunk attendu), à zéro pour un nouveau run."""
+        try:
+            clock = json.loads(self.AUDIO_CLOCK.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            clock = {}
+        if clock.get("run") != run:
+            return {"run": run, "audio_s": 0.0, "next_seq": 0}
+        return clock
+
+    def save_audio_clock(self, clock):
+        _write_atomic(self.AUDIO_CLOCK, json.dumps(clock))
+
+    def clear_question(self):
+        for path in self.question_dirs():
+            clearDirectory(path)
+
+    def create_final_transcript(self):
+        create_final_transcript(self.FINAL_TRANSCRIPT)
+
+    def touch(self):
+        """Marque la session comme active (repousse son expiration)."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / ".last_seen").touch()
+
+    def last_seen(self):
+        marker = self.root / ".last_seen"
+        return marker.stat().st_mtime if marker.exists() else None
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def normalize_session_id(session_id):
+    """Valide l'identifiant de session (utilisé tel quel comme nom de dossier et de room Socket.IO)."""
+    if not session_id:
+        return DEFAULT_SESSION
+    session_id = str(session_id)
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise ValueError(f"Invalid session id: {session_id!r}")
+    return session_id
+
+
+def get_session(session_id=None):
+    """Retourne (et crée au besoin) l'espace de travail de la session."""
+    session_id = normalize_session_id(session_id)
+    with _sessions_lock:
+        workspace = _sessions.get(session_id)
+        if workspace is None:
+            workspace = SessionWorkspace(session_id).create()
+            _sessions[session_id] = workspace
+    workspace.touch()
+    return workspace
+
+
+def cleanup_expired_sessions(ttl_s=SESSION_TTL_S):
+    """Supprime les sessions inactives depuis plus de ttl_s secondes ; retourne leurs identifiants."""
+    if not sessions_dir.exists():
+        return []
+
+    now = time.time()
+    expired = []
+    for root in sessions_dir.iterdir():
+        if not root.is_dir():
+            continue
+        workspace = _sessions.get(root.name) or SessionWorkspace(root.name)
+        last_seen = workspace.last_seen()
+        if last_seen is None:
+            last_seen = root.stat().st_mtime
+        if now - last_seen < ttl_s:
+            continue
+
+        with _sessions_lock:
+            _sessions.pop(root.name, None)
+        shutil.rmtree(root, ignore_errors=True)
+        expired.append(root.name)
+        print(f"Session {root.name} expirée, dossier supprimé.")
+    return expired
@@ -1,18 +1,164 @@
-import redis
+import os
+import socket
 import threading
 import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Groupe de consommateurs partagé par tous les process/machines qui traitent les mêmes topics
+CONSUMER_GROUP = "milo_workers"
+
+# "redis" : bus distribué (plusieurs process/machines) | "memory" : bus en process, sans Redis
+EVENT_BUS_BACKEND = os.environ.get("MILO_EVENT_BUS", "redis")
+REDIS_URL = os.environ.get("MILO_REDIS_URL", "redis://localhost:6379/0")
+
+# Chunks du cours répartis par session sur AUDIO_PARTITIONS streams (Audio_topic:<n>). Chaque partition
+# n'est lue que par un process à la fois (bail Redis, voir subscribe(exclusive=True)) : tous les chunks
+# d'une session passent par le même process, qui les remet dans l'ordre avec son SequenceGate.
+# Limite : au plus AUDIO_PARTITIONS process transcrivent des cours en parallèle, les autres sont en secours
+AUDIO_TOPIC = "Audio_topic"
+AUDIO_PARTITIONS = int(os.environ.get("MILO_AUDIO_PARTITIONS", "4"))
+# Durée du bail d'une partition, renouvelé à chaque tour de boucle du listener ; à sa mort un autre process reprend
+PARTITION_LEASE_MS = 10000
+
+# Pose ou renouvelle le bail (KEYS[1]) si personne d'autre ne le tient
+_LEASE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then return 1 end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+def audio_topic(session_id):
+    """Partition d'Audio_topic de la session (stable d'un process à l'autre)."""
+    return f"{AUDIO_TOPIC}:{zlib.crc32(session_id.encode('utf-8')) % AUDIO_PARTITIONS}"
+
+def audio_topics():
+    return [f"{AUDIO_TOPIC}:{partition}" for partition in range(AUDIO_PARTITIONS)]
+
+class TopicMetrics:
+    def __init__(self, window_s=60):
+        self.window_s = window_s
+        self.processed = 0
+        self.errors = 0
+        self.claimed = 0
+        self.dead_letters = 0
+        self.busy_s = 0.0
+        self._done = deque()
+        self._lock = threading.Lock()
+
+    def record(self, duration_s, ok=True):
+        now = time.time()
+        with self._lock:
+            if ok:
+                self.processed += 1
+            else:
+                self.errors += 1
+            self.busy_s += duration_s
+            self._done.append(now)
+            while self._done and self._done[0] < now - self.window_s:
+                self._done.popleft()
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            while self._done and self._done[0] < now - self.window_s:
+                self._done.popleft()
+            handled = self.processed + self.errors
+            return {
+                "processed": self.processed,
+                "errors": self.errors,
+                "claimed": self.claimed,
+                "dead_letters": self.dead_letters,
+                "throughput_per_s": len(self._done) / self.window_s,
+                "avg_processing_s": self.busy_s / handled if handled else 0.0,
+            }
+
+class SequenceGate:
+    """
+    Remet dans l'ordre des messages traités par plusieurs workers : le message n°seq d'une clé
+    n'entre dans la section critique qu'après le n°seq-1 (ou après timeout_s s'il s'est perdu).
+    turn() rend False pour un message dont le tour est déjà passé (relivré par XAUTOCLAIM après
+    traitement, ou arrivé après le timeout) : l'appelant l'ignore plutôt que de casser l'ordre.
+    Le curseur est local au process : tous les messages d'une clé doivent passer par le même
+    (partitions exclusives) ; start permet de le reprendre là où un autre process l'a laissé.
+    """
+
+    def __init__(self, timeout_s=30):
+        self.timeout_s = timeout_s
+        self._next = {}
+        self._active = {}
+        self._cond = threading.Condition()
+        self.stats = {"timeouts": 0, "skipped": 0}
+
+    def reset(self, key=None):
+        with self._cond:
+            if key is None:
+                self._next.clear()
+            else:
+                self._next.pop(key, None)
+            self._cond.notify_all()
+
+    @contextmanager
+    def turn(self, key, seq, start=None):
+        """start : callable appelé si la clé est inconnue, position de départ (0 par défaut)."""
+        with self._cond:
+            if key not in self._next:
+                self._next[key] = start() if start is not None else 0
+            # Un doublon du message en cours attend sa fin (puis est ignoré)
+            ready = lambda: self._next.get(key, 0) >= seq and seq not in self._active.get(key, ())
+            if not self._cond.wait_for(ready, timeout=self.timeout_s):
+                self.stats["timeouts"] += 1
+                print(f"[SequenceGate] {key}: message {self._next.get(key, 0)} missing after {self.timeout_s}s, "
+                      f"order broken, continuing with {seq}")
+                self._cond.wait_for(lambda: seq not in self._active.get(key, ()))
+            if seq < self._next.get(key, 0):
+                self.stats["skipped"] += 1
+                print(f"[SequenceGate] {key}: message {seq} already passed (redelivery or late after timeout), skipped")
+                in_order = False
+            else:
+                self._active.setdefault(key, set()).add(seq)
+                in_order = True
+        try:
+            yield in_order
+        finally:
+            if in_order:
+                with self._cond:
+                    self._active[key].discard(seq)
+                    if not self._active[key]:
+                        del self._active[key]
+                    self._next[key] = max(self._next.get(key, 0), seq + 1)
+                    self._cond.notify_all()
 
 class RedisEventBus:
-    def __init__(self, redis_url="redis://localhost:6379/0"):
+    def __init__(self, redis_url=REDIS_URL):
+        import redis
+
         self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
         self.listeners = {}
         self.running = True
+        self.metrics = {}
+        self._groups = {}
+        self._executors = []
 
     def publish(self, stream_name, message_dict):
         print(f"[Producer] {stream_name} -> {message_dict}")
         self.redis.xadd(stream_name, message_dict)
 
-    def subscribe(self, stream_name, listener_name, callback, last_id="0-0"):
+    def subscribe(self, stream_name, listener_name, callback, last_id="0-0", group=None, workers=1, claim_idle_ms=60000, max_deliveries=3, exclusive=False):
+        """
+        Sans group : un thread lit le stream avec XREAD depuis last_id (comportement historique).
+        Avec group : mode groupe de consommateurs (XREADGROUP/XACK/XAUTOCLAIM), les messages sont
+        répartis entre tous les consommateurs du groupe et traités par un pool de workers threads.
+        exclusive : un seul consommateur du groupe lit le stream à la fois (bail Redis), les autres attendent.
+        """
+        if group is not None:
+            return self._subscribe_group(stream_name, listener_name, callback, group, workers, claim_idle_ms, max_deliveries, exclusive)
+
         def listener():
             current_id = last_id
             while self.running:
@@ -33,11 +179,146 @@ class RedisEventBus:
         t.start()
         self.listeners[listener_name] = t
 
+    def _ensure_group(self, stream_name, group):
+        import redis
+
+        try:
+            self.redis.xgroup_create(stream_name, group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _hold_lease(self, stream_name, group, consumer):
+        return bool(self.redis.eval(_LEASE_SCRIPT, 1, f"{stream_name}:{group}:owner", consumer, PARTITION_LEASE_MS))
+
+    def _subscribe_group(self, stream_name, listener_name, callback, group, workers, claim_idle_ms, max_deliveries, exclusive=False):
+        consumer = f"{socket.gethostname()}-{os.getpid()}-{listener_name}"
+        metrics = self.metrics.setdefault(stream_name, TopicMetrics())
+        self._groups[stream_name] = group
+        self._ensure_group(stream_name, group)
+
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=listener_name)
+        self._executors.append(executor)
+        # Un slot par worker : on ne lit dans Redis que ce qu'on peut traiter tout de suite
+        slots = threading.Semaphore(workers)
+        failures = {}
+
+        def handle(message_id, message):
+            start_time = time.time()
+            try:
+                print(f"[{listener_name}] Received on {stream_name}: {message}")
+                callback(message)
+                self.redis.xack(stream_name, group, message_id)
+                failures.pop(message_id, None)
+                metrics.record(time.time() - start_time)
+            except Exception as e:
+                # Pas d'ACK : le message reste en attente et sera repris par XAUTOCLAIM
+                metrics.record(time.time() - start_time, ok=False)
+                failures[message_id] = failures.get(message_id, 0) + 1
+                print(f"[{listener_name}] Error on {message_id} (attempt {failures[message_id]}): {e}")
+                if failures[message_id] >= max_deliveries:
+                    self._dead_letter(stream_name, group, message_id, message, metrics)
+                    failures.pop(message_id, None)
+            finally:
+                slots.release()
+
+        def claim_stale(count, min_idle_ms=claim_idle_ms):
+            # Messages délivrés à un consommateur (crashé ou bloqué) mais jamais acquittés
+            result = self.redis.xautoclaim(stream_name, group, consumer, min_idle_time=min_idle_ms, start_id="0-0", count=count)
+            messages = []
+            for message_id, message in result[1]:
+                if message is None:
+                    # Entrée supprimée du stream entre temps
+                    self.redis.xack(stream_name, group, message_id)
+                    continue
+                messages.append((message_id, message))
+            metrics.claimed += len(messages)
+            return messages
+
+        def listener():
+            last_claim = 0.0
+            owner = not exclusive
+            takeover = False
+            while self.running:
+                if exclusive:
+                    try:
+                        owned = self._hold_lease(stream_name, group, consumer)
+                    except Exception as e:
+                        print(f"[{listener_name}] Lease error: {e}")
+                        owned = False
+                    if owned != owner:
+                        owner = owned
+                        print(f"[{listener_name}] {'Now' if owner else 'No longer'} owner of {stream_name}")
+                        # Nouveau propriétaire : les messages laissés par l'ancien (bail expiré) sont repris avant les nouveaux
+                        takeover = owner
+                    if not owner:
+                        time.sleep(1)
+                        continue
+                if not slots.acquire(timeout=1):
+                    continue
+                free = 1
+                while free < workers and slots.acquire(blocking=False):
+                    free += 1
+                try:
+                    messages = []
+                    if takeover:
+                        messages = claim_stale(free, PARTITION_LEASE_MS)
+                        takeover = bool(messages)
+                    elif time.time() - last_claim > claim_idle_ms / 1000:
+                        last_claim = time.time()
+                        messages = claim_stale(free)
+                    if not messages:
+                        resp = self.redis.xreadgroup(group, consumer, {stream_name: ">"}, count=free, block=1000)
+                        messages = resp[0][1] if resp else []
+                    for message_id, message in messages:
+                        executor.submit(handle, message_id, message)
+                        free -= 1
+                except Exception as e:
+                    print(f"[{listener_name}] Error: {e}")
+                    if "NOGROUP" in str(e):
+                        # Stream supprimé (clearAllStreams) : on recrée le groupe
+                        self._ensure_group(stream_name, group)
+                    else:
+                        time.sleep(1)  # attendre avant retry
+                finally:
+                    for _ in range(free):
+                        slots.release()
+
+        t = threading.Thread(target=listener, daemon=True)
+        t.start()
+        self.listeners[listener_name] = t
+
+    def _dead_letter(self, stream_name, group, message_id, message, metrics):
+        print(f"[RedisEventBus] {message_id} failed too many times, moved to {stream_name}:dead")
+        try:
+            self.redis.xadd(f"{stream_name}:dead", {**message, "original_id": message_id})
+            self.redis.xack(stream_name, group, message_id)
+            metrics.dead_letters += 1
+        except Exception as e:
+            print(f"[RedisEventBus] Error while moving {message_id} to dead letters: {e}")
+
+    def get_metrics(self):
+        """Débit, erreurs et retard (lag / messages en attente) par topic en mode groupe."""
+        result = {}
+        for stream_name, metrics in self.metrics.items():
+            stats = metrics.snapshot()
+            try:
+                for info in self.redis.xinfo_groups(stream_name):
+                    if info.get("name") == self._groups.get(stream_name):
+                        stats["pending"] = info.get("pending")
+                        stats["lag"] = info.get("lag")  # Redis >= 7
+            except Exception as e:
+                stats["lag_error"] = str(e)
+            result[stream_name] = stats
+        return result
+
     def stop(self):
         self.running = False
         print("Stopping all Redis listeners...")
         for name, t in self.listeners.items():
             t.join(timeout=1)
+        for executor in self._executors:
+            executor.shutdown(wait=False)
     def clear_stream(self, stream_name):
         try:
             self.redis.delete(stream_name)
@@ -46,10 +327,166 @@ class RedisEventBus:
             print(f"[RedisEventBus] Error clearing stream {stream_name}: {e}")
 
 
-message_queue_handler = RedisEventBus()
+class _MemoryStream:
+    """Log borné d'un topic : chaque message a un numéro croissant, comme un ID de stream Redis."""
+
+    def __init__(self, maxlen):
+        self.messages = deque(maxlen=maxlen)
+        self.first_seq = 0
+        self.next_seq = 0
+        self.group_cursors = {}
+        self.in_flight = {}
+        self.cond = threading.Condition()
+
+    def append(self, message):
+        with self.cond:
+            if len(self.messages) == self.messages.maxlen:
+                self.first_seq += 1
+            self.messages.append(message)
+            self.next_seq += 1
+            self.cond.notify_all()
+            return f"{self.next_seq - 1}-0"
+
+    def get(self, seq):
+        # Appelé sous self.cond ; un lecteur en retard saute les messages sortis du log
+        seq = max(seq, self.first_seq)
+        return seq, self.messages[seq - self.first_seq]
+
+    def clear(self):
+        with self.cond:
+            self.messages.clear()
+            self.first_seq = self.next_seq
+            for group in self.group_cursors:
+                self.group_cursors[group] = self.next_seq
+
+
+class InMemoryEventBus:
+    """
+    Même API que RedisEventBus (publish / subscribe / clear_stream / stop / get_metrics),
+    mais les messages restent dans le process : pas de Redis à lancer, pas de sérialisation
+    réseau à chaque étape. Pour un seul noeud ou pour faire tourner le pipeline hors ligne.
+    Pas de persistance : un crash perd les messages non traités.
+    """
+
+    def __init__(self, maxlen=10000):
+        self._maxlen = maxlen
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.listeners = {}
+        self.running = True
+        self.metrics = {}
+
+    def _stream(self, stream_name):
+        with self._lock:
+            stream = self._streams.get(stream_name)
+            if stream is None:
+                stream = self._streams[stream_name] = _MemoryStream(self._maxlen)
+            return stream
+
+    def publish(self, stream_name, message_dict):
+        print(f"[Producer] {stream_name} -> {message_dict}")
+        # Comme Redis, les valeurs sont transmises en chaînes
+        return self._stream(stream_name).append({k: str(v) for k, v in message_dict.items()})
+
+    def subscribe(self, stream_name, listener_name, callback, last_id="0-0", group=None, workers=1, **kwargs):
+        stream = self._stream(stream_name)
+
+        if group is None:
+            def listener():
+                with stream.cond:
+                    cursor = stream.next_seq if last_id == "$" else int(str(last_id).split("-")[0])
+                while self.running:
+                    with stream.cond:
+                        if not stream.cond.wait_for(lambda: cursor < stream.next_seq or not self.running, timeout=1):
+                            continue
+                        if not self.running:
+                            break
+                        seq, message = stream.get(cursor)
+                        cursor = seq + 1
+                    try:
+                        print(f"[{listener_name}] Received on {stream_name}: {message}")
+                        callback(message)
+                    except Exception as e:
+                        print(f"[{listener_name}] Error: {e}")
+
+            t = threading.Thread(target=listener, daemon=True)
+            t.start()
+            self.listeners[listener_name] = t
+            return
+
+        metrics = self.metrics.setdefault(stream_name, TopicMetrics())
+        with stream.cond:
+            stream.group_cursors.setdefault(group, stream.first_seq)
+            stream.in_flight.setdefault(group, 0)
+
+        def worker():
+            while self.running:
+                with stream.cond:
+                    if not stream.cond.wait_for(lambda: stream.group_cursors[group] < stream.next_seq or not self.running, timeout=1):
+                        continue
+                    if not self.running:
+                        break
+                    # Le curseur est partagé par le groupe : chaque message va à un seul worker
+                    seq, message = stream.get(stream.group_cursors[group])
+                    stream.group_cursors[group] = seq + 1
+                    stream.in_flight[group] += 1
+
+                start_time = time.time()
+                try:
+                    print(f"[{listener_name}] Received on {stream_name}: {message}")
+                    callback(message)
+                    metrics.record(time.time() - start_time)
+                except Exception as e:
+                    metrics.record(time.time() - start_time, ok=False)
+                    print(f"[{listener_name}] Error: {e}")
+                finally:
+                    with stream.cond:
+                        stream.in_flight[group] -= 1
+
+        for i in range(workers):
+            t = threading.Thread(target=worker, daemon=True)
+            t.start()
+            self.listeners[f"{listener_name}-{i}"] = t
+
+    def get_metrics(self):
+        result = {}
+        for stream_name, metrics in self.metrics.items():
+            stats = metrics.snapshot()
+            stream = self._stream(stream_name)
+            with stream.cond:
+                stats["pending"] = sum(stream.in_flight.values())
+                stats["lag"] = sum(stream.next_seq - cursor for cursor in stream.group_cursors.values())
+            result[stream_name] = stats
+        return result
+
+    def stop(self):
+        self.running = False
+        print("Stopping all in-memory listeners...")
+        for stream in list(self._streams.values()):
+            with stream.cond:
+                stream.cond.notify_all()
+        for name, t in self.listeners.items():
+            t.join(timeout=1)
+
+    def clear_stream(self, stream_name):
+        self._stream(stream_name).clear()
+        print(f"[InMemoryEventBus] Cleared stream: {stream_name}")
+
+
+def create_event_bus(backend=EVENT_BUS_BACKEND):
+    if backend == "memory":
+        return InMemoryEventBus()
+    if backend == "redis":
+        return RedisEventBus()
+    raise ValueError(f"Unknown event bus backend: {backend}")
+
+
+message_queue_handler = create_event_bus()
 
 def clearAllStreams():
-    message_queue_handler.clear_stream("Audio_topic")
+    message_queue_handler.clear_stream(AUDIO_TOPIC)
+    for topic in audio_topics():
+        message_queue_handler.clear_stream(topic)
     message_queue_handler.clear_stream("Transcriber_topic")
     message_queue_handler.clear_stream("Question_topic")
-    message_queue_handler.clear_stream("Response_topic")
\ No newline at end of file
+    message_queue_handler.clear_stream("Response_topic")
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+
+
+def resident_memory_mb():
+    """Mémoire résidente du process en Mo (None si on ne sait pas la mesurer sur cette plateforme)."""
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+
+class WhisperModelRegistry:
+    """
+    Charge chaque modèle Whisper (taille, device, compute_type) une seule fois, à la demande,
+    et le partage entre tous les Transcriber (cours et questions).
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._warmups = {}
+
+    @staticmethod
+    def _key(model_size, device, compute_type):
+        return (str(model_size), device, compute_type)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, model_size, device, compute_type):
+        key = self._key(model_size, device, compute_type)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        # Un seul chargement par clé, même si plusieurs workers le demandent en même temps
+        with self._key_lock(key):
+            model = self._models.get(key)
+            if model is None:
+                model = self._load(key)
+        return model
+
+    def _load(self, key):
+        from faster_whisper import WhisperModel
+
+        model_size, device, compute_type = key
+        print(f"[ModelRegistry] Loading Whisper {model_size} ({device}, {compute_type})...")
+        rss_before = resident_memory_mb()
+        start_time = time.time()
+
+        model = WhisperModel(model_size, device=device, compute_type=compute_type)
+
+        load_s = time.time() - start_time
+        rss_after = resident_memory_mb()
+        self._stats[key] = {
+            "load_s": round(load_s, 2),
+            "rss_mb": round(rss_after, 1) if rss_after is not None else None,
+            "rss_delta_mb": round(rss_after - rss_before, 1) if rss_after is not None and rss_before is not None else None,
+        }
+        self._models[key] = model
+        print(f"[ModelRegistry] Whisper {model_size} loaded in {load_s:.2f} seconds (RSS: {self._stats[key]['rss_mb']} MB)")
+        return model
+
+    def warm_up(self, model_size, device, compute_type):
+        """Lance le chargement en arrière-plan (retourne tout de suite)."""
+        key = self._key(model_size, device, compute_type)
+        with self._lock:
+            thread = self._warmups.get(key)
+            if thread is not None:
+                return thread
+
+            def load():
+                try:
+                    self.get(*key)
+                except Exception as e:
+                    self._stats[key] = {"error": str(e)}
+                    print(f"[ModelRegistry] Error while loading Whisper {model_size}: {e}")
+
+            thread = threading.Thread(target=load, daemon=True)
+            self._warmups[key] = thread
+        thread.start()
+        return thread
+
+    def is_ready(self, model_size, device, compute_type):
+        return self._key(model_size, device, compute_type) in self._models
+
+    def status(self):
+        models = {}
+        for key in set(self._warmups) | set(self._models) | set(self._stats):
+            models["/".join(key)] = {
+                "ready": key in self._models,
+                **self._stats.get(key, {}),
+            }
+        return {"models": models, "rss_mb": resident_memory_mb()}
+
+
+whisper_registry = WhisperModelRegistry()
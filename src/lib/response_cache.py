@@ -0,0 +1,219 @@
+import hashlib
+import json
+import math
+import re
+import shutil
+import threading
+import time
+import unicodedata
+import wave
+from collections import OrderedDict
+from pathlib import Path
+
+from lib import file_manager
+
+cache_dir = file_manager.project_root_dir / "synthetiser" / "response_cache"
+
+MAX_ENTRIES = 500
+TTL_S = 24 * 60 * 60
+# Similarité minimale (embeddings) pour réutiliser la réponse d'une question proche (même contexte de cours)
+SIMILARITY_THRESHOLD = 0.85
+# Questions proches seulement avec les embeddings sentence-transformers : sur trigrammes de caractères,
+# "2 plus 3" et "2 plus 4" se ressemblent à 0.9, donc sans embeddings seule la question exacte est servie
+USE_EMBEDDINGS = True
+EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def normalize_question(text):
+    """Minuscules, sans accents ni ponctuation, espaces normalisés."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"['’]", "", text)
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return text.strip()
+
+
+def _numbers(text):
+    """Nombres de la question : deux questions proches avec des nombres différents ne sont pas équivalentes."""
+    return re.findall(r"\d+", text)
+
+
+def context_hash(context):
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """
+    Cache des réponses aux questions : texte + WAV, clé = question normalisée + hash du contexte
+    (prompt systeme avec le résumé du cours). Avec les embeddings, une question proche dans le même
+    contexte et avec les mêmes nombres réutilise la réponse ; sans, seule la question normalisée exacte
+    est servie. Eviction LRU + TTL, index persistant sur disque.
+    """
+
+    def __init__(self, directory=cache_dir, max_entries=MAX_ENTRIES, ttl_s=TTL_S, threshold=SIMILARITY_THRESHOLD):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._vectors = {}
+        self._lock = threading.Lock()
+        self._encoder = None
+        self._encoder_checked = False
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0}
+        self._load_index()
+
+    # --- index ---
+
+    def _index_path(self):
+        return self.directory / "index.json"
+
+    def _load_index(self):
+        path = self._index_path()
+        if not path.exists():
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for entry in json.load(f):
+                    if Path(entry["wav"]).exists():
+                        self._entries[entry["key"]] = entry
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[ResponseCache] Index illisible, cache vidé : {e}")
+            self._entries.clear()
+
+    def _save_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._index_path().with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self._entries.values()), f, ensure_ascii=False)
+        tmp_path.replace(self._index_path())
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        self._vectors.pop(key, None)
+        if entry is not None:
+            Path(entry["wav"]).unlink(missing_ok=True)
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if now - e["created_at"] > self.ttl_s]:
+            self._remove(key)
+
+    # --- similarité ---
+
+    def _get_encoder(self):
+        if not self._encoder_checked:
+            self._encoder_checked = True
+            if USE_EMBEDDINGS:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._encoder = SentenceTransformer(EMBEDDING_MODEL)
+                except Exception as e:
+                    print(f"[ResponseCache] Embeddings indisponibles ({e}), questions exactes seulement")
+        return self._encoder
+
+    def _vector(self, normalized):
+        return [float(x) for x in self._get_encoder().encode(normalized)]
+
+    def _entry_vector(self, key):
+        vector = self._vectors.get(key)
+        if vector is None:
+            vector = self._vector(self._entries[key]["question"])
+            self._vectors[key] = vector
+        return vector
+
+    # --- API ---
+
+    def get(self, question, context):
+        """Retourne l'entrée {question, text, wav, ...} pour cette question (ou une très proche), sinon None."""
+        normalized = normalize_question(question)
+        ctx = context_hash(context)
+        key = hashlib.sha1(f"{ctx}:{normalized}".encode("utf-8")).hexdigest()
+
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return dict(entry, similarity=1.0)
+
+            best_key, best_score = None, 0.0
+            numbers = _numbers(normalized)
+            candidates = [
+                k for k, e in self._entries.items()
+                if e["context"] == ctx and _numbers(e["question"]) == numbers
+            ]
+            if candidates and normalized and self._get_encoder() is not None:
+                vector = self._vector(normalized)
+                for candidate in candidates:
+                    score = _cosine(vector, self._entry_vector(candidate))
+                    if score > best_score:
+                        best_key, best_score = candidate, score
+
+            if best_key is not None and best_score >= self.threshold:
+                self._entries.move_to_end(best_key)
+                self.stats["near_hits"] += 1
+                return dict(self._entries[best_key], similarity=round(best_score, 3))
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, question, context, text, wav_paths):
+        """Enregistre la réponse (les WAV d'une réponse en streaming sont concaténés en un seul fichier)."""
+        if not text or not wav_paths:
+            return None
+        normalized = normalize_question(question)
+        ctx = context_hash(context)
+        key = hashlib.sha1(f"{ctx}:{normalized}".encode("utf-8")).hexdigest()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        wav_path = self.directory / f"{key}.wav"
+        if len(wav_paths) == 1:
+            shutil.copy2(wav_paths[0], wav_path)
+        else:
+            with wave.open(str(wav_path), "wb") as out:
+                for i, path in enumerate(wav_paths):
+                    with wave.open(str(path), "rb") as src:
+                        if i == 0:
+                            out.setparams(src.getparams())
+                        out.writeframes(src.readframes(src.getnframes()))
+
+        entry = {
+            "key": key,
+            "question": normalized,
+            "context": ctx,
+            "text": text,
+            "wav": str(wav_path),
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._vectors.pop(key, None)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+            self._save_index()
+        return entry
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._save_index()
+
+    def get_stats(self):
+        stats = dict(self.stats, entries=len(self._entries))
+        lookups = stats["hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["near_hits"]) / lookups if lookups else None
+        return stats
+
+
+myResponseCache = ResponseCache()
@@ -0,0 +1,199 @@
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from lib import file_manager
+
+TOP_K = 4
+PASSAGE_CHARS = 600
+# Portée des documents communs à toutes les sessions (infos ECE, anciens cours)
+GLOBAL_SCOPE = None
+
+STOPWORDS = set("""
+a au aux avec c ce ces cet cette d dans de des du elle en et eux il ils je j l la le les leur leurs lui m ma mais me
+meme mes moi mon n ne nos notre nous on ou par pas pour qu que qui s sa se ses son sur t ta te tes toi ton tu un une
+vos votre vous y est sont etre ai as avons avez ont c est quoi quel quelle quels quelles comment ca cest peux veux
+""".split())
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in re.findall(r"[a-z0-9]+", text) if len(t) > 1 and t not in STOPWORDS]
+
+
+def chunk_text(text, max_chars=PASSAGE_CHARS):
+    """Découpe un texte en passages d'au plus max_chars caractères (paragraphes, puis phrases)."""
+    passages = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph] if len(paragraph) <= max_chars else re.split(r"(?<=[.!?])\s+", paragraph)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > max_chars:
+                passages.append(current)
+                current = ""
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+def chunk_sections(text, max_chars=PASSAGE_CHARS):
+    """Découpe un texte markdown par section ###, le titre étant répété dans chaque passage."""
+    passages = []
+    for section in re.split(r"\n(?=#{2,3} )", text):
+        lines = section.strip().split("\n", 1)
+        if not lines[0]:
+            continue
+        title = lines[0].strip("# ").strip().rstrip(":").strip() if lines[0].startswith("#") else ""
+        body = lines[1] if title and len(lines) > 1 else section
+        for passage in chunk_text(body, max_chars):
+            passages.append(f"{title} : {passage}" if title else passage)
+    return passages
+
+
+class RetrievalIndex:
+    """
+    Index BM25 en mémoire, mis à jour incrémentalement (ajout / suppression de passages).
+    Chaque passage a une portée : GLOBAL_SCOPE (infos ECE, anciens cours) ou l'id d'une session ;
+    une recherche porte sur les passages globaux + ceux de la session.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs = {}
+        self._postings = defaultdict(set)
+        self._df = Counter()
+        self._total_len = 0
+        self._lock = threading.RLock()
+        self._tails = {}
+        self._next_id = 0
+        self._backups_loaded = False
+        self.stats = {"searches": 0, "last_search_ms": 0.0}
+
+    # --- mise à jour ---
+
+    def add(self, text, scope=GLOBAL_SCOPE, source=""):
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        with self._lock:
+            doc_id = self._next_id
+            self._next_id += 1
+            tf = Counter(tokens)
+            self._docs[doc_id] = {"text": text, "scope": scope, "source": source, "tf": tf, "len": len(tokens)}
+            for term in tf:
+                self._postings[term].add(doc_id)
+                self._df[term] += 1
+            self._total_len += len(tokens)
+            return doc_id
+
+    def remove(self, doc_id):
+        with self._lock:
+            doc = self._docs.pop(doc_id, None)
+            if doc is None:
+                return
+            for term in doc["tf"]:
+                self._postings[term].discard(doc_id)
+                self._df[term] -= 1
+                if self._df[term] <= 0:
+                    del self._df[term]
+                    del self._postings[term]
+            self._total_len -= doc["len"]
+
+    def add_document(self, text, scope=GLOBAL_SCOPE, source="", sections=False):
+        """Découpe et indexe un document ; les passages d'une même (scope, source) sont remplacés."""
+        with self._lock:
+            for doc_id in [d for d, doc in self._docs.items() if doc["scope"] == scope and doc["source"] == source]:
+                self.remove(doc_id)
+            passages = chunk_sections(text) if sections else chunk_text(text)
+            return [self.add(passage, scope, source) for passage in passages]
+
+    def add_segments(self, scope, segments):
+        """
+        Ajoute des segments (start, end, text) du transcript en cours. Le dernier passage de la session
+        est complété puis réindexé jusqu'à atteindre PASSAGE_CHARS : tout est cherchable immédiatement.
+        """
+        lines = [f"[{start:.0f}s] {text.strip()}" for start, end, text in segments if text.strip()]
+        if not lines:
+            return
+        with self._lock:
+            tail_id, tail_text = self._tails.get(scope, (None, ""))
+            for line in lines:
+                if tail_text and len(tail_text) + len(line) + 1 > PASSAGE_CHARS:
+                    self._tails.pop(scope, None)
+                    tail_id, tail_text = None, ""
+                if tail_id is not None:
+                    self.remove(tail_id)
+                tail_text = f"{tail_text}\n{line}" if tail_text else line
+                tail_id = self.add(tail_text, scope, "transcript")
+                self._tails[scope] = (tail_id, tail_text)
+
+    def reset_scope(self, scope):
+        with self._lock:
+            for doc_id in [d for d, doc in self._docs.items() if doc["scope"] == scope]:
+                self.remove(doc_id)
+            self._tails.pop(scope, None)
+
+    def load_backups(self):
+        """Indexe les transcripts des cours précédents (backup_transcripts), une seule fois."""
+        with self._lock:
+            if self._backups_loaded:
+                return
+            self._backups_loaded = True
+            if not file_manager.backup_transcript.exists():
+                return
+            for path in sorted(file_manager.backup_transcript.rglob("*.txt")):
+                try:
+                    text = path.read_text(encoding="utf-8")
+                except OSError:
+                    continue
+                text = re.sub(r"^\s*\[[\d.]+\s*-\s*[\d.]+\]\s*", "", text, flags=re.MULTILINE)
+                self.add_document(text, GLOBAL_SCOPE, f"backup:{path.relative_to(file_manager.backup_transcript)}")
+
+    # --- recherche ---
+
+    def search(self, query, k=TOP_K, scope=GLOBAL_SCOPE):
+        """Les k passages les plus pertinents (BM25) parmi les passages globaux et ceux de scope."""
+        self.load_backups()
+        start = time.perf_counter()
+        terms = tokenize(query)
+        with self._lock:
+            n_docs = len(self._docs)
+            if not terms or not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+            scores = Counter()
+            for term in set(terms):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - self._df[term] + 0.5) / (self._df[term] + 0.5))
+                for doc_id in postings:
+                    doc = self._docs[doc_id]
+                    if doc["scope"] is not GLOBAL_SCOPE and doc["scope"] != scope:
+                        continue
+                    tf = doc["tf"][term]
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc["len"] / avg_len))
+
+            results = [
+                {"text": self._docs[doc_id]["text"], "source": self._docs[doc_id]["source"], "score": round(score, 3)}
+                for doc_id, score in scores.most_common(k)
+            ]
+
+        self.stats["searches"] += 1
+        self.stats["last_search_ms"] = (time.perf_counter() - start) * 1000
+        return results
+
+    def get_stats(self):
+        return dict(self.stats, passages=len(self._docs), terms=len(self._df))
+
+
+myRetriever = RetrievalIndex()
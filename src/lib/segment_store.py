@@ -0,0 +1,158 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from pathlib import Path
+
+# Segment stocké : timestamps globaux + position de l'enregistrement dans le fichier
+StoredSegment = namedtuple("StoredSegment", ["start", "end", "text", "offset"])
+
+MAGIC = b"MILOSEG1"
+# Entête d'un enregistrement : taille du texte, crc32 (timestamps + texte), start, end
+HEADER = struct.Struct("<IIdd")
+
+
+def _crc(start, end, payload):
+    return zlib.crc32(struct.pack("<dd", start, end) + payload)
+
+
+def _scan(buffer, offset):
+    """Lit les enregistrements valides à partir de offset ; retourne (segments, offset de fin valide)."""
+    segments = []
+    size = len(buffer)
+    while offset + HEADER.size <= size:
+        length, crc, start, end = HEADER.unpack_from(buffer, offset)
+        payload_end = offset + HEADER.size + length
+        if payload_end > size:
+            break
+        payload = bytes(buffer[offset + HEADER.size:payload_end])
+        if _crc(start, end, payload) != crc:
+            break
+        segments.append(StoredSegment(start, end, payload.decode("utf-8"), offset))
+        offset = payload_end
+    return segments, offset
+
+
+class SegmentStore:
+    """
+    Transcript d'un cours en journal append-only (un enregistrement binaire par segment, avec crc),
+    gardé aussi en mémoire. Permet :
+    - les lectures incrémentales (read_from(offset) : segments ajoutés depuis une position)
+    - les requêtes par intervalle de temps (range)
+    - la reprise après crash : à l'ouverture le fichier est relu (mmap) et tronqué après le dernier
+      enregistrement complet
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = Path(path)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._segments = []
+        self._starts = []
+        self._offsets = []
+        self._end_offset = len(MAGIC)
+        self._recover()
+
+    def _recover(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.path.exists() or self.path.stat().st_size < len(MAGIC):
+            with open(self.path, "wb") as f:
+                f.write(MAGIC)
+            return
+
+        with open(self.path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f"{self.path} is not a segment store")
+                segments, end_offset = _scan(mm, len(MAGIC))
+            if end_offset < size:
+                # Dernier enregistrement incomplet ou corrompu (écriture interrompue)
+                f.truncate(end_offset)
+                print(f"[SegmentStore] {self.path.name} : {size - end_offset} octets invalides tronqués")
+
+        for segment in segments:
+            self._index(segment)
+        self._end_offset = end_offset
+        if segments:
+            print(f"[SegmentStore] {self.path.name} : {len(segments)} segments récupérés")
+
+    def _index(self, segment):
+        self._segments.append(segment)
+        self._starts.append(segment.start)
+        self._offsets.append(segment.offset)
+
+    def append(self, segments):
+        """Ajoute des segments (start, end, text) à la fin du journal ; retourne les segments stockés."""
+        stored = []
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = self._end_offset
+                for start, end, text in segments:
+                    payload = text.strip().encode("utf-8")
+                    f.write(HEADER.pack(len(payload), _crc(start, end, payload), start, end) + payload)
+                    stored.append(StoredSegment(start, end, text.strip(), offset))
+                    offset += HEADER.size + len(payload)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            for segment in stored:
+                self._index(segment)
+            self._end_offset = offset
+        return stored
+
+    def __len__(self):
+        return len(self._segments)
+
+    @property
+    def end_offset(self):
+        return self._end_offset
+
+    def segments(self):
+        return list(self._segments)
+
+    def read_from(self, offset=0):
+        """Segments ajoutés à partir de la position offset (0 = début) et la position suivante."""
+        with self._lock:
+            index = bisect.bisect_left(self._offsets, offset)
+            return self._segments[index:], self._end_offset
+
+    def read_disk_from(self, offset=0):
+        """Comme read_from, mais relu sur disque (mmap) : pour un lecteur d'un autre process."""
+        offset = max(offset, len(MAGIC))
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= offset:
+                return [], offset
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _scan(mm, offset)
+
+    def range(self, start_s, end_s):
+        """Segments qui recouvrent l'intervalle [start_s, end_s] (secondes)."""
+        with self._lock:
+            stop = bisect.bisect_right(self._starts, end_s)
+            return [segment for segment in self._segments[:stop] if segment.end >= start_s]
+
+    def duration(self):
+        return self._segments[-1].end if self._segments else 0.0
+
+    def text(self, timestamps=True, segments=None):
+        segments = self._segments if segments is None else segments
+        if timestamps:
+            return "".join(f"[{s.start:.2f} - {s.end:.2f}] {s.text}\n" for s in segments)
+        return " ".join(s.text for s in segments)
+
+    def export_text(self, path):
+        """Ecrit la version texte lisible (format de transcript_final.txt)."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.text())
+        return path
+
+    def reset(self):
+        with self._lock:
+            with open(self.path, "wb") as f:
+                f.write(MAGIC)
+            self._segments, self._starts, self._offsets = [], [], []
+            self._end_offset = len(MAGIC)
@@ -0,0 +1,215 @@
+import threading
+import time
+
+from lib.batch_scheduler import sampling_logits, sampling_params
+
+# Tokens proposés au modèle principal à chaque pas de vérification
+NUM_DRAFT_TOKENS = 5
+# Prompt lookup : n-grammes cherchés dans le contexte, du plus long au plus court
+MAX_NGRAM = 3
+MIN_NGRAM = 1
+
+
+def _crop(cache, length):
+    """Ramène le cache KV à length tokens (crop négatif : compatible transformers 4.x et 5.x)."""
+    remove = cache.get_seq_length() - length
+    if remove > 0:
+        cache.crop(-remove)
+
+
+class PromptLookupDrafter:
+    """
+    Propositions sans modèle : le dernier n-gramme du contexte est cherché plus tôt dans le contexte
+    (prompt systeme avec résumé du cours et extraits, question, début de réponse) et les tokens qui
+    le suivaient sont proposés. Efficace quand la réponse reprend le cours mot pour mot.
+    """
+
+    def __init__(self, max_ngram=MAX_NGRAM, min_ngram=MIN_NGRAM):
+        self.ngrams = range(max_ngram, min_ngram - 1, -1)
+        # n -> {n-gramme: position du token qui le suit (occurrence la plus récente)}
+        self._index = {n: {} for n in self.ngrams}
+        self._indexed = 0
+
+    def _extend(self, ids):
+        # Seuls les n-grammes suivis d'au moins un token sont indexés
+        for end in range(max(self._indexed, 1), len(ids)):
+            for n in self.ngrams:
+                if end >= n:
+                    self._index[n][tuple(ids[end - n:end])] = end
+        self._indexed = len(ids)
+
+    def propose(self, ids, k):
+        self._extend(ids)
+        for n in self.ngrams:
+            position = self._index[n].get(tuple(ids[-n:])) if len(ids) > n else None
+            if position is not None:
+                return ids[position:position + k]
+        return []
+
+
+class DraftModelDrafter:
+    """Petit modèle (même tokenizer que le modèle principal) : k tokens proposés en greedy, avec son propre cache KV."""
+
+    def __init__(self, model):
+        from transformers import DynamicCache
+
+        self.model = model
+        self._cache = DynamicCache()
+        self._cached = []
+
+    def propose(self, ids, k):
+        import torch
+
+        # Le cache garde le plus long préfixe commun avec le contexte (les propositions rejetées sont retirées)
+        common = 0
+        limit = min(len(self._cached), len(ids) - 1)
+        while common < limit and self._cached[common] == ids[common]:
+            common += 1
+        _crop(self._cache, common)
+        self._cached = self._cached[:common]
+
+        draft = []
+        pending = ids[common:]
+        with torch.no_grad():
+            for _ in range(k):
+                outputs = self.model(
+                    input_ids=torch.tensor([pending], device=self.model.device),
+                    past_key_values=self._cache,
+                    use_cache=True,
+                )
+                self._cached += pending
+                token_id = int(outputs.logits[0, -1].argmax())
+                draft.append(token_id)
+                pending = [token_id]
+        return draft
+
+
+class SpeculativeDecoder:
+    """
+    Décodage spéculatif pour le provider transformers : un drafter propose quelques tokens, le modèle
+    principal les vérifie tous en une seule passe et garde le plus long préfixe accepté, plus un token
+    à lui (correction ou bonus). En greedy la sortie est celle de generate() ; en sampling, chaque
+    proposition x est acceptée avec la probabilité p(x) du modèle principal, sinon le token est tiré
+    dans p privé de x, ce qui garde exactement la distribution du sampling normal.
+    """
+
+    def __init__(self, model, mode="prompt_lookup", draft_model=None, num_draft_tokens=NUM_DRAFT_TOKENS):
+        if mode == "draft" and draft_model is None:
+            raise ValueError("Speculative mode 'draft' needs a draft model")
+        self.model = model
+        self.mode = mode
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "steps": 0, "drafted": 0, "accepted": 0, "tokens": 0, "seconds": 0.0}
+
+    def _make_drafter(self):
+        if self.mode == "draft":
+            return DraftModelDrafter(self.draft_model)
+        return PromptLookupDrafter()
+
+    def generate(self, input_ids, past_key_values=None, stop_ids=(), max_new_tokens=256,
+                 temperature=0.3, top_p=0.85, top_k=40, do_sample=None):
+        """
+        Produit les nouveaux token ids par paquets (un paquet par passe du modèle principal).
+        input_ids : prompt complet (1, T) ; past_key_values : cache KV d'un préfixe du prompt ou None.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        # Même règle que generate() via SubSynthesizer._generation_kwargs et que le batching
+        sample, temperature, top_p, top_k = sampling_params(self.model, do_sample, temperature, top_p, top_k)
+        sample = sample and temperature > 0
+        device = input_ids.device
+        ids = input_ids[0].tolist()
+        cache = past_key_values if past_key_values is not None else DynamicCache()
+        drafter = self._make_drafter()
+        stop_ids = set(stop_ids)
+
+        def probs(logits):
+            return torch.softmax(sampling_logits(logits, temperature, top_k, top_p), dim=-1)
+
+        def pick(logits):
+            if not sample:
+                return int(torch.argmax(logits))
+            return int(torch.multinomial(probs(logits), 1))
+
+        def verify(logits, proposed):
+            """(token retenu, proposition acceptée ?)"""
+            if not sample:
+                token_id = int(torch.argmax(logits))
+                return token_id, token_id == proposed
+            p = probs(logits)
+            if torch.rand(()) < p[proposed]:
+                return proposed, True
+            p[proposed] = 0.0
+            return int(torch.multinomial(p / p.sum(), 1)), False
+
+        start = time.perf_counter()
+        steps = drafted = accepted_drafts = 0
+        generated = []
+        try:
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=torch.tensor([ids[cache.get_seq_length():]], device=device),
+                    past_key_values=cache,
+                    use_cache=True,
+                )
+            token_id = pick(outputs.logits[0, -1])
+            generated.append(token_id)
+            yield [token_id]
+
+            while token_id not in stop_ids and len(generated) < max_new_tokens:
+                context = ids + generated
+                # k propositions + le token du modèle principal ne dépassent pas max_new_tokens
+                k = min(self.num_draft_tokens, max_new_tokens - len(generated) - 1)
+                draft = drafter.propose(context, k) if k > 0 else []
+
+                with torch.no_grad():
+                    outputs = self.model(
+                        input_ids=torch.tensor([[context[-1]] + draft], device=device),
+                        past_key_values=cache,
+                        use_cache=True,
+                    )
+                logits = outputs.logits[0]
+                steps += 1
+                drafted += len(draft)
+
+                new_tokens = []
+                for i, proposed in enumerate(draft):
+                    token_id, ok = verify(logits[i], proposed)
+                    new_tokens.append(token_id)
+                    if not ok or token_id in stop_ids:
+                        break
+                    accepted_drafts += 1
+                else:
+                    new_tokens.append(pick(logits[len(draft)]))
+
+                # Le cache garde le contexte et les propositions acceptées (pas le dernier token retenu)
+                _crop(cache, len(context) + len(new_tokens) - 1)
+                token_id = new_tokens[-1]
+                generated += new_tokens
+                yield new_tokens
+        finally:
+            with self._lock:
+                self.stats["requests"] += 1
+                self.stats["steps"] += steps
+                self.stats["drafted"] += drafted
+                self.stats["accepted"] += accepted_drafts
+                self.stats["tokens"] += len(generated)
+                self.stats["seconds"] += time.perf_counter() - start
+
+    def get_stats(self, baseline_tokens_per_s=None):
+        """Taux d'acceptation, tokens par passe du modèle principal et gain par rapport au décodage normal."""
+        with self._lock:
+            stats = dict(self.stats)
+        stats["mode"] = self.mode
+        stats["acceptance_rate"] = stats["accepted"] / stats["drafted"] if stats["drafted"] else None
+        passes = stats["steps"] + stats["requests"]
+        stats["tokens_per_pass"] = stats["tokens"] / passes if passes else None
+        stats["tokens_per_s"] = stats["tokens"] / stats["seconds"] if stats["seconds"] else None
+        stats["speedup"] = (
+            stats["tokens_per_s"] / baseline_tokens_per_s
+            if stats["tokens_per_s"] and baseline_tokens_per_s else None
+        )
+        return stats
@@ -0,0 +1,179 @@
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+from lib import file_manager
+
+# Intermédiaires (chunks webm, WAV de conversion, audio des questions) supprimés dès que l'étape
+# qui les consomme les a traités (False = tout garder jusqu'au prochain /start-recording, pour débugger)
+DELETE_ACKED = True
+# Archives compressées par cours gardées par session (les plus anciennes sont supprimées)
+ARCHIVES_PER_SESSION = 20
+# Quota disque pour sessions/ et backup_transcripts/ ; au-delà, éviction jusqu'à QUOTA_LOW_WATERMARK
+DISK_QUOTA_MB = int(os.environ.get("MILO_DISK_QUOTA_MB", "2048"))
+QUOTA_LOW_WATERMARK = 0.9
+QUOTA_CHECK_INTERVAL_S = 60
+# Audio envoyé au front : pas évincé avant que le navigateur ait pu le télécharger
+MIN_AUDIO_AGE_S = 5 * 60
+# Intermédiaires jamais acquittés (crash en cours de traitement) : évictables après ce délai
+STALE_INTERMEDIATE_S = 60 * 60
+
+# Dossiers d'une session par catégorie (premier niveau sous sessions/<id>/)
+INTERMEDIATE_DIRS = {"recorder", "milo_question"}
+SERVED_AUDIO_DIRS = {"milo_audio", "milo_response"}
+
+
+def _walk(root):
+    """(chemin, taille, mtime) de tous les fichiers sous root (os.scandir : pas de stat en double)."""
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield Path(entry.path), stat.st_size, stat.st_mtime
+
+
+class StorageManager:
+    """
+    Empreinte disque bornée, par-dessus file_manager :
+    - ack() supprime un intermédiaire dès que l'étape suivante l'a consommé (les dossiers restent petits)
+    - archive_lecture() range transcript, journal et résumés d'un cours dans une archive .tar.gz
+      horodatée par session (pas d'écrasement par nom de fichier)
+    - enforce_quota() supprime les fichiers évictables les plus anciens quand le quota est dépassé :
+      intermédiaires orphelins, puis audio déjà servi, puis archives. Les transcripts et résumés
+      des sessions actives ne sont jamais évincés.
+    """
+
+    def __init__(self, quota_mb=DISK_QUOTA_MB, roots=None):
+        self.quota_bytes = quota_mb * 1024 * 1024
+        self.roots = roots or [file_manager.sessions_dir, file_manager.backup_transcript]
+        self._lock = threading.Lock()
+        self.stats = {
+            "acked_files": 0,
+            "acked_bytes": 0,
+            "archives": 0,
+            "evicted_files": 0,
+            "evicted_bytes": 0,
+            "usage_bytes": None,
+            "last_check": None,
+        }
+
+    # --- intermédiaires ---
+
+    def ack(self, *paths):
+        """L'étape suivante a consommé ces fichiers : ils sont supprimés (les absents sont ignorés)."""
+        if not DELETE_ACKED:
+            return
+        for path in paths:
+            path = Path(path)
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"[Storage] Suppression impossible de {path} : {e}")
+                continue
+            with self._lock:
+                self.stats["acked_files"] += 1
+                self.stats["acked_bytes"] += size
+
+    # --- archives ---
+
+    def archive_lecture(self, workspace):
+        """Archive .tar.gz horodatée du cours (transcripts, journal des segments, résumés) ; retourne son chemin."""
+        archive_dir = workspace.backup_transcript
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        archive = archive_dir / f"{stamp}.tar.gz"
+        suffix = 1
+        while archive.exists():
+            archive = archive_dir / f"{stamp}-{suffix}.tar.gz"
+            suffix += 1
+
+        # Ecrit à côté puis renommé : une archive présente est toujours complète
+        partial = archive.with_name(archive.name + ".part")
+        with tarfile.open(partial, "w:gz") as tar:
+            for src_dir in [workspace.transcript_dir, workspace.sub_resume_dir]:
+                if not src_dir.exists():
+                    continue
+                for item in sorted(src_dir.iterdir()):
+                    if item.is_file():
+                        tar.add(item, arcname=f"{src_dir.name}/{item.name}")
+        os.replace(partial, archive)
+
+        archives = sorted(archive_dir.glob("*.tar.gz"), key=lambda p: p.stat().st_mtime)
+        for old in archives[:-ARCHIVES_PER_SESSION]:
+            old.unlink(missing_ok=True)
+        with self._lock:
+            self.stats["archives"] += 1
+        print(f"[Storage] Cours archivé : {archive} ({archive.stat().st_size / 1024:.0f} Ko)")
+        return archive
+
+    # --- quota ---
+
+    def _eviction_rank(self, path, mtime, now):
+        """Ordre d'éviction (0 = en premier), None si le fichier n'est pas évictable."""
+        sessions_dir = file_manager.sessions_dir
+        if path.is_relative_to(file_manager.backup_transcript):
+            return 2
+        if not path.is_relative_to(sessions_dir):
+            return None
+        parts = path.relative_to(sessions_dir).parts
+        category = parts[1] if len(parts) > 2 else None
+        if category in INTERMEDIATE_DIRS and now - mtime > STALE_INTERMEDIATE_S:
+            return 0
+        if category in SERVED_AUDIO_DIRS and now - mtime > MIN_AUDIO_AGE_S:
+            return 1
+        return None
+
+    def enforce_quota(self):
+        """Supprime les fichiers évictables les plus anciens tant que le quota est dépassé ; retourne l'usage."""
+        now = time.time()
+        files = [f for root in self.roots for f in _walk(Path(root))]
+        usage = sum(size for _, size, _ in files)
+
+        evicted_files = evicted_bytes = 0
+        if usage > self.quota_bytes:
+            target = self.quota_bytes * QUOTA_LOW_WATERMARK
+            candidates = []
+            for path, size, mtime in files:
+                rank = self._eviction_rank(path, mtime, now)
+                if rank is not None:
+                    candidates.append((rank, mtime, path, size))
+            for _, _, path, size in sorted(candidates):
+                if usage <= target:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                usage -= size
+                evicted_files += 1
+                evicted_bytes += size
+            print(f"[Storage] Quota dépassé : {evicted_files} fichiers évincés ({evicted_bytes / 1024 / 1024:.1f} Mo), "
+                  f"usage {usage / 1024 / 1024:.1f} Mo / {self.quota_bytes / 1024 / 1024:.0f} Mo")
+
+        with self._lock:
+            self.stats["evicted_files"] += evicted_files
+            self.stats["evicted_bytes"] += evicted_bytes
+            self.stats["usage_bytes"] = usage
+            self.stats["last_check"] = now
+        return usage
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["quota_bytes"] = self.quota_bytes
+        return stats
+
+
+myStorage = StorageManager()
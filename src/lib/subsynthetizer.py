@@ -1,9 +1,22 @@
 from pathlib import Path
+import copy
+import hashlib
+import queue
 import re
+import threading
+import time
 from typing import Optional
 
+from lib.tracing import myTracer
+
 # Lazy imports inside methods to avoid forcing unused providers at runtime
 
+# Fin de phrase pour le streaming : ponctuation forte suivie d'un blanc, ou saut de ligne
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+MIN_SENTENCE_CHARS = 12
+# Attente maximale d'un morceau de texte en streaming (prefill compris) avant d'abandonner la génération
+STREAM_TIMEOUT_S = 120
+
 rag_info="""
 ### 🤔 Bases
 Tu es Milo, étudiante en première année à l’E C E Paris. Tu fais partie du BDE et de l’Intelligence Lab. Tu n’es pas une assistante virtuelle : tu es une camarade sympa qui aime aider les autres, en gardant le sourire (et parfois un petit smiley). Tu es une intelligence artificielle qui se présente et s’exprime au féminin.
@@ -178,6 +191,12 @@ Gestion de projet d'affaires internationales, Management de projets digitaux, Ma
 
 """
 
+# Avec la recherche de passages, seul le persona reste dans le prompt systeme (stable, donc en cache KV) ;
+# les infos ECE, les transcripts et le résumé du cours sont indexés et injectés selon la question
+RAG_FACTS_HEADER = "## 📚 INFORMATIONS ECE"
+rag_persona = rag_info[:rag_info.index(RAG_FACTS_HEADER)]
+rag_facts = rag_info[rag_info.index(RAG_FACTS_HEADER):]
+
 resume_prompt="""
 
 Tu es Milo élève en première année d'école d'ingénieur à l'ECE Paris. Tu fais partie du BDE et de l'Intelligence Lab.
@@ -198,6 +217,50 @@ Tu es une assistante spécialisée dans la synthèse de contenu oral. Ton rôle
 - **Retiens toujours les informations pratiques données par le professeur (examens, DS, dates, exercices, consignes)**
 """
 
+partial_resume_prompt="""
+
+Tu es Milo élève en première année d'école d'ingénieur à l'ECE Paris.
+Tu reçois un EXTRAIT d'un cours transcrit en texte horodaté en secondes. Le cours continue avant et après cet extrait.
+
+## RÈGLES ULTRA-STRICTES
+
+- **IMPÉRATIF ABSOLU : Résume uniquement cet extrait en quelques phrases courtes et factuelles, sans introduction ni conclusion**
+- **IMPÉRATIF ABSOLU : N'invente jamais d'informations**
+- **IMPÉRATIF ABSOLU : Garde toujours les informations pratiques données par le professeur (examens, DS, dates, exercices, consignes, références)**
+- **IMPÉRATIF ABSOLU : Rédige ta réponse uniquement avec des caractères alphanumériques et de la ponctuation**
+"""
+
+merge_resume_prompt="""
+
+Tu es Milo élève en première année d'école d'ingénieur à l'ECE Paris.
+Tu reçois plusieurs résumés partiels successifs d'un même cours, dans l'ordre chronologique.
+
+## RÈGLES ULTRA-STRICTES
+
+- **IMPÉRATIF ABSOLU : Fusionne-les en un seul résumé clair et structuré, sans répétitions**
+- **IMPÉRATIF ABSOLU : N'invente jamais d'informations**
+- **IMPÉRATIF ABSOLU : Ne perds aucune information pratique (examens, DS, dates, exercices, consignes, références)**
+- **IMPÉRATIF ABSOLU : Rédige ta réponse uniquement avec des caractères alphanumériques et de la ponctuation**
+"""
+
+class _FirstTokenTimer:
+    """Logits processor neutre : mesure le temps jusqu'au premier token (= durée du prefill) et compte les tokens."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._first = None
+        self.tokens = 0
+
+    def __call__(self, input_ids, scores):
+        if self._first is None:
+            self._first = time.perf_counter()
+        self.tokens += 1
+        return scores
+
+    def elapsed(self) -> float:
+        return (self._first or time.perf_counter()) - self._start
+
+
 class SubSynthesizer:
     def __init__(self, model: str = "nchapman/ministral-8b-instruct-2410:8b", system_prompt: Optional[str] = None, provider: str = "ollama"):
         self.transcripts_dir = Path(__file__).resolve().parent.parent.parent / "synthetiser" / "transcripts"
@@ -211,23 +274,65 @@ class SubSynthesizer:
         self._hf_tokenizer = None
         self._hf_model = None
 
+        # Cache du contexte (résumé du cours) par session, relu seulement si le fichier change
+        self._context_cache = {}
+
+        # Runtime CPU retenu au chargement (voir lib/cpu_runtime.py) et débit de génération mesuré
+        self.runtime_report = None
+        self.generation_stats = {"tokens": 0, "seconds": 0.0}
+        self._generation_stats_lock = threading.Lock()
+
+        # Passages pertinents (infos ECE, transcripts, résumé) injectés à la place de rag_info complet
+        self.use_retrieval = True
+        self.retrieval_k = 4
+        self._facts_indexed = False
+
+        # Génération partagée par batch (voir lib/batch_scheduler.py) : les appels concurrents
+        # de run_transformers / stream_transformers passent par un seul moteur
+        self.batching = False
+        self._scheduler = None
+
+        # Décodage spéculatif hors batching (voir lib/speculative.py) : None, "prompt_lookup"
+        # (propositions tirées du prompt : résumé, extraits) ou "draft" (petit modèle draft_model)
+        self.speculative = None
+        self.draft_model = None
+        self.num_draft_tokens = 5
+        self._hf_draft_model = None
+        self._speculative_decoder = None
+        # Débit du décodage normal mesuré par measure_speculative_baseline (référence du speedup)
+        self.speculative_baseline = None
+
+        # Cache KV du prompt systeme : un segment par type de prompt ("question" / "resume")
+        self.use_prefix_cache = True
+        self.max_prefix_entries = 8
+        self._prefix_cache = {}
+        self._prefix_lock = threading.Lock()
+        self.prefix_cache_stats = {
+            "hits": 0,
+            "misses": 0,
+            "prefix_tokens": 0,
+            "prefix_build_s": 0.0,
+            "prefill_s_hit": 0.0,
+            "prefill_s_miss": 0.0,
+            "last_prefill_s": 0.0,
+        }
+
     def default_prompt(self):
         return resume_prompt
 
-    def question_prompt(self):
+    def question_prompt(self, workspace=None):
+        if self.use_retrieval:
+            return rag_persona + """
+Des extraits utiles (informations ECE, passages du cours, résumé) peuvent accompagner la question :
+utilise-les seulement s'ils sont pertinents, sans inventer au-delà.
+"""
+
         base_prompt = rag_info
 
         try:
-            from lib import file_manager
-
-            final_resume_path = file_manager.sub_resume_dir / "transcript_final_resume.txt"
-            transcript_final_path = file_manager.transcript_dir / "transcript_final.txt"
-
-            if final_resume_path.exists() and transcript_final_path.exists():
+            transcript_final = self._load_context(workspace)
+            if transcript_final is not None:
                 print("CONTEXTE_EXISTE")
-                with open(final_resume_path, "r", encoding="utf-8") as f:
-                    transcript_final = f.read()
-
                 base_prompt += f"""
 Contexte additionnel :
 **IMPORTANT PRENDS LE TRANSCRIPT SUIVANT EN COMPTE DANS TES REPONSE**
@@ -244,14 +349,60 @@ si la question porte sur ce contenu) :
 
         return base_prompt
 
+    def context_fingerprint(self, workspace=None, question: Optional[str] = None) -> str:
+        """
+        Ce dont dépend une réponse en plus de la question : prompt systeme, résumé du cours et, avec la
+        recherche, la session et les passages retrouvés pour la question (ils changent pendant le cours).
+        """
+        fingerprint = self.question_prompt(workspace) + (self._load_context(workspace) or "")
+        if self.use_retrieval and question is not None:
+            passages = self.retrieve(question, workspace)
+            fingerprint += f"\n[session:{getattr(workspace, 'session_id', None)}]\n"
+            fingerprint += "\n".join(p["text"] for p in passages)
+        return fingerprint
+
+    def retrieve(self, question: str, workspace=None) -> list:
+        """Passages les plus pertinents pour la question (infos ECE, anciens cours, cours de la session)."""
+        from lib.retrieval import myRetriever
+
+        if not self._facts_indexed:
+            myRetriever.add_document(rag_facts, source="rag_info", sections=True)
+            self._facts_indexed = True
+        scope = getattr(workspace, "session_id", None)
+        return myRetriever.search(question, self.retrieval_k, scope)
+
+    def _load_context(self, workspace=None):
+        """
+        Retourne le résumé du cours de la session (dossiers globaux si workspace est None),
+        relu sur disque seulement quand il a changé (None si absent).
+        """
+        from lib import file_manager
+
+        workspace = workspace or file_manager
+        final_resume_path = workspace.sub_resume_dir / "transcript_final_resume.txt"
+        transcript_final_path = workspace.transcript_dir / "transcript_final.txt"
+
+        if not (final_resume_path.exists() and transcript_final_path.exists()):
+            self._context_cache.pop(final_resume_path, None)
+            return None
+
+        stat = final_resume_path.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._context_cache.get(final_resume_path)
+        if cached is None or cached[0] != key:
+            with open(final_resume_path, "r", encoding="utf-8") as f:
+                cached = (key, f.read())
+            self._context_cache[final_resume_path] = cached
+        return cached[1]
+
     def clean_text_for_tts(self, text: str) -> str:
 
         return re.sub(r"[^a-zA-Z0-9éèêëàâîïôùûçÉÈÊËÀÂÎÏÔÙÛÇ.,;:!?' \n\-+=*/%]","",text)
 
-    def run_ollama(self, prompt: str, isQuestion: bool = False) -> str:
+    def run_ollama(self, prompt: str, isQuestion: bool = False, system_prompt: Optional[str] = None) -> str:
         import ollama
 
-        effective_system_prompt = self.question_prompt() if isQuestion else self.default_prompt()
+        effective_system_prompt = system_prompt or (self.question_prompt() if isQuestion else self.default_prompt())
         print(effective_system_prompt)
         print(prompt)
         response = ollama.chat(
@@ -264,6 +415,24 @@ si la question porte sur ce contenu) :
         raw_text = response["message"]["content"]
         return self.clean_text_for_tts(raw_text)
 
+    def stream_ollama(self, prompt: str, isQuestion: bool = False, system_prompt: Optional[str] = None):
+        """Version streaming de run_ollama : produit le texte brut au fil de la génération."""
+        import ollama
+
+        effective_system_prompt = system_prompt or (self.question_prompt() if isQuestion else self.default_prompt())
+        stream = ollama.chat(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": effective_system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+        for chunk in stream:
+            piece = chunk["message"]["content"]
+            if piece:
+                yield piece
+
     def _ensure_hf_model_loaded(self):
         if self._hf_model is not None and self._hf_tokenizer is not None:
             return
@@ -283,9 +452,222 @@ si la question porte sur ce contenu) :
             self._hf_tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
             self._hf_model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True)
 
-        # Move to GPU if available
+        # Move to GPU if available, sinon runtime CPU optimisé (int8 / bf16 / threads)
         if torch.cuda.is_available():
             self._hf_model = self._hf_model.to("cuda")
+            self.runtime_report = {"runtime": "cuda"}
+        else:
+            from lib.cpu_runtime import select_runtime
+            self._hf_model, self.runtime_report = select_runtime(self._hf_model, self._hf_tokenizer)
+
+        # Pré-calcule le cache du prompt systeme des questions (persona + résumé du cours)
+        if self.use_prefix_cache:
+            try:
+                self._get_prefix_cache("question", self.question_prompt())
+            except Exception as e:
+                print(f"[PREFIX CACHE] Pré-calcul impossible : {e}")
+
+    def _render_chat(self, system_prompt: str, prompt: Optional[str] = None) -> str:
+        """Applique le chat template. Sans prompt utilisateur, ne rend que le segment systeme."""
+        messages = [{"role": "system", "content": system_prompt}]
+        if prompt is not None:
+            messages.append({"role": "user", "content": prompt})
+
+        # Utiliser le chat template du tokenizer si disponible
+        if hasattr(self._hf_tokenizer, 'apply_chat_template'):
+            return self._hf_tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=prompt is not None
+            )
+
+        # Fallback si pas de chat template
+        text = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
+        if prompt is not None:
+            text += f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
+        return text
+
+    def _get_prefix_cache(self, kind: str, system_prompt: str) -> dict:
+        """
+        Retourne le cache KV (past_key_values) du segment systeme pour ce type de prompt.
+        Il n'est recalculé que si le prompt systeme a changé (ex: nouveau transcript_final_resume.txt).
+        """
+        import torch
+
+        prompt_hash = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+        with self._prefix_lock:
+            entry = self._prefix_cache.get(kind)
+            if entry is not None and entry["hash"] == prompt_hash:
+                return entry
+
+            prefix_ids = self._hf_tokenizer(self._render_chat(system_prompt), return_tensors="pt")["input_ids"]
+            prefix_ids = prefix_ids.to(self._hf_model.device)
+
+            start = time.perf_counter()
+            with torch.no_grad():
+                outputs = self._hf_model(input_ids=prefix_ids, use_cache=True)
+            delta = time.perf_counter() - start
+
+            entry = {"hash": prompt_hash, "ids": prefix_ids, "past": outputs.past_key_values}
+            self._prefix_cache.pop(kind, None)
+            self._prefix_cache[kind] = entry
+            # Un segment par prompt de session : on borne la mémoire en oubliant les plus anciens
+            while len(self._prefix_cache) > self.max_prefix_entries:
+                oldest = next(k for k in self._prefix_cache if k != kind)
+                del self._prefix_cache[oldest]
+            self.prefix_cache_stats["prefix_tokens"] = prefix_ids.shape[1]
+            self.prefix_cache_stats["prefix_build_s"] = delta
+            print(f"[PREFIX CACHE] Segment '{kind}' calculé : {prefix_ids.shape[1]} tokens en {delta:.2f}s")
+            return entry
+
+    def _prepare_transformers_inputs(self, prompt: str, isQuestion: bool, system_prompt: Optional[str] = None):
+        """Tokenise le prompt complet et branche le cache KV du prompt systeme quand il correspond."""
+        import torch
+
+        if system_prompt is not None:
+            effective_system_prompt = system_prompt
+            prompt_hash = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+            # Même prompt que le segment "question" pré-calculé au chargement : on le réutilise
+            question_entry = self._prefix_cache.get("question")
+            if isQuestion and question_entry is not None and question_entry["hash"] == prompt_hash:
+                kind = "question"
+            else:
+                kind = "custom-" + prompt_hash[:8]
+        else:
+            effective_system_prompt = self.question_prompt() if isQuestion else self.default_prompt()
+            kind = "question" if isQuestion else "resume"
+        full_prompt = self._render_chat(effective_system_prompt, prompt)
+
+        inputs = self._hf_tokenizer(full_prompt, return_tensors="pt")
+        inputs = {k: v.to(self._hf_model.device) for k, v in inputs.items()}
+
+        past_key_values = None
+        if self.use_prefix_cache:
+            entry = self._get_prefix_cache(kind, effective_system_prompt)
+            prefix_len = entry["ids"].shape[1]
+            input_ids = inputs["input_ids"][0]
+            # Le segment systeme doit être un préfixe strict (au moins un token utilisateur à préremplir)
+            if input_ids.shape[0] > prefix_len and torch.equal(input_ids[:prefix_len], entry["ids"][0]):
+                past_key_values = copy.deepcopy(entry["past"])
+
+        if past_key_values is not None:
+            self.prefix_cache_stats["hits"] += 1
+        else:
+            self.prefix_cache_stats["misses"] += 1
+
+        return inputs, past_key_values
+
+    def _record_prefill(self, prefill_s: float, hit: bool):
+        self.prefix_cache_stats["last_prefill_s"] = prefill_s
+        self.prefix_cache_stats["prefill_s_hit" if hit else "prefill_s_miss"] += prefill_s
+
+    def get_prefix_cache_stats(self) -> dict:
+        """Compteurs hit/miss et temps de prefill moyens, pour vérifier le gain du cache."""
+        stats = dict(self.prefix_cache_stats)
+        stats["avg_prefill_s_hit"] = stats["prefill_s_hit"] / stats["hits"] if stats["hits"] else 0.0
+        stats["avg_prefill_s_miss"] = stats["prefill_s_miss"] / stats["misses"] if stats["misses"] else 0.0
+        return stats
+
+    def _record_generation(self, tokens: int, seconds: float):
+        """Débit de génération (tous chemins : generate(), streaming, batching, spéculatif) pour /inference-metrics."""
+        with self._generation_stats_lock:
+            self.generation_stats["tokens"] += tokens
+            self.generation_stats["seconds"] += seconds
+
+    def get_runtime_stats(self) -> dict:
+        """Runtime retenu (mesures au chargement) et débit moyen des générations depuis le démarrage."""
+        stats = dict(self.runtime_report or {})
+        seconds = self.generation_stats["seconds"]
+        stats["generated_tokens"] = self.generation_stats["tokens"]
+        stats["avg_tokens_per_s"] = self.generation_stats["tokens"] / seconds if seconds else None
+        return stats
+
+    def get_speculative_decoder(self):
+        """Décodeur spéculatif du mode courant (le modèle draft est chargé au premier usage)."""
+        decoder = self._speculative_decoder
+        if decoder is not None and decoder.mode == self.speculative and decoder.num_draft_tokens == self.num_draft_tokens:
+            return decoder
+
+        from lib.speculative import SpeculativeDecoder
+        draft = None
+        if self.speculative == "draft":
+            if self._hf_draft_model is None:
+                from transformers import AutoModelForCausalLM
+                self._hf_draft_model = AutoModelForCausalLM.from_pretrained(self.draft_model).to(self._hf_model.device).eval()
+                print(f"[SPECULATIVE] Modèle draft chargé : {self.draft_model}")
+            draft = self._hf_draft_model
+        self._speculative_decoder = SpeculativeDecoder(self._hf_model, self.speculative, draft, self.num_draft_tokens)
+        return self._speculative_decoder
+
+    def get_speculative_stats(self) -> Optional[dict]:
+        if self._speculative_decoder is None:
+            return None
+        stats = self._speculative_decoder.get_stats(self.speculative_baseline)
+        stats["baseline_tokens_per_s"] = self.speculative_baseline
+        return stats
+
+    def measure_speculative_baseline(self, prompts, isQuestion: bool = True, **gen_params) -> Optional[float]:
+        """
+        Débit (tokens/s) du décodage normal sur ces prompts, spéculatif et batching suspendus le temps
+        de la mesure (outil de benchmark, pas pendant le service) : référence du speedup rapporté.
+        """
+        speculative, batching = self.speculative, self.batching
+        self.speculative, self.batching = None, False
+        tokens, seconds = self.generation_stats["tokens"], self.generation_stats["seconds"]
+        try:
+            for prompt in prompts:
+                self.run_transformers(prompt, isQuestion, **gen_params)
+        finally:
+            self.speculative, self.batching = speculative, batching
+        tokens = self.generation_stats["tokens"] - tokens
+        seconds = self.generation_stats["seconds"] - seconds
+        self.speculative_baseline = tokens / seconds if seconds else None
+        return self.speculative_baseline
+
+    def _speculative_tokens(self, inputs, past_key_values, temperature, top_p, top_k, do_sample, max_new_tokens):
+        """Token ids générés par le décodeur spéculatif, par paquets (même contrat que generate())."""
+        stop_ids = {self._hf_tokenizer.eos_token_id}
+        eos = self._hf_model.generation_config.eos_token_id
+        stop_ids.update(eos if isinstance(eos, (list, tuple)) else [eos])
+        stop_ids.discard(None)
+
+        start = time.perf_counter()
+        tokens = self.get_speculative_decoder().generate(
+            inputs["input_ids"], past_key_values, stop_ids, max_new_tokens,
+            temperature=temperature, top_p=top_p, top_k=top_k, do_sample=do_sample,
+        )
+        count = 0
+        for i, new_tokens in enumerate(tokens):
+            if i == 0:
+                # Le premier paquet est le token du prefill
+                self._record_prefill(time.perf_counter() - start, past_key_values is not None)
+            count += len(new_tokens)
+            yield new_tokens
+        self._record_generation(count, time.perf_counter() - start)
+
+    def get_scheduler(self):
+        if self._scheduler is None:
+            from lib.batch_scheduler import BatchScheduler
+            self._scheduler = BatchScheduler(self)
+        return self._scheduler
+
+    def _use_scheduler(self) -> bool:
+        return self.batching and not self.get_scheduler().in_scheduler_thread()
+
+    def _generation_kwargs(self, temperature, top_p, top_k, do_sample, max_new_tokens) -> dict:
+        from lib.batch_scheduler import sampling_params
+
+        # do_sample=None résolu ici (même règle que le batching) : le traitement de None par generate() varie selon les versions
+        do_sample, temperature, top_p, top_k = sampling_params(self._hf_model, do_sample, temperature, top_p, top_k)
+        return {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "pad_token_id": self._hf_tokenizer.pad_token_id,
+            "eos_token_id": self._hf_tokenizer.eos_token_id,
+        }
 
     def run_transformers(
         self, 
@@ -295,7 +677,8 @@ si la question porte sur ce contenu) :
         top_p: float = 0.85,
         top_k: int = 40,
         do_sample: bool = None,
-        max_new_tokens: int = 256
+        max_new_tokens: int = 256,
+        system_prompt: Optional[str] = None
     ) -> str:
         """
         Génère une réponse avec le modèle Transformers
@@ -308,48 +691,43 @@ si la question porte sur ce contenu) :
             top_k: Limite le nombre de tokens considérés
             do_sample: Si True, active le sampling aléatoire (IMPORTANT pour variabilité)
             max_new_tokens: Nombre maximum de tokens à générer
+            system_prompt: Remplace le prompt systeme (ex: résumés partiels), sinon choisi via isQuestion
         """
+        if self._use_scheduler():
+            return self.get_scheduler().generate(
+                prompt, isQuestion, system_prompt=system_prompt, temperature=temperature, top_p=top_p,
+                top_k=top_k, do_sample=do_sample, max_new_tokens=max_new_tokens
+            )
+
         self._ensure_hf_model_loaded()
         import torch
+        from transformers import LogitsProcessorList
 
-        effective_system_prompt = self.question_prompt() if isQuestion else self.default_prompt()
-
-        # Format pour Qwen3 chat template
-        messages = [
-            {"role": "system", "content": effective_system_prompt},
-            {"role": "user", "content": prompt}
-        ]
-
-        # Utiliser le chat template du tokenizer si disponible
-        if hasattr(self._hf_tokenizer, 'apply_chat_template'):
-            full_prompt = self._hf_tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
-        else:
-            # Fallback si pas de chat template
-            full_prompt = f"<|im_start|>system\n{effective_system_prompt}<|im_end|>\n<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
+        inputs, past_key_values = self._prepare_transformers_inputs(prompt, isQuestion, system_prompt)
+        if self.speculative:
+            tokens = self._speculative_tokens(inputs, past_key_values, temperature, top_p, top_k, do_sample, max_new_tokens)
+            generated = self._hf_tokenizer.decode([t for new_tokens in tokens for t in new_tokens], skip_special_tokens=True)
+            return self.clean_text_for_tts(generated)
 
-        inputs = self._hf_tokenizer(full_prompt, return_tensors="pt")
-        if next(self._hf_model.parameters()).is_cuda:
-            inputs = {k: v.to("cuda") for k, v in inputs.items()}
+        first_token_timer = _FirstTokenTimer()
+        start_time = time.perf_counter()
 
         with torch.no_grad():
             output_ids = self._hf_model.generate(
                 **inputs,
-                max_new_tokens=max_new_tokens,
-                do_sample=do_sample,
-                temperature=temperature if do_sample else 1.0,
-                top_p=top_p if do_sample else 1.0,
-                top_k=top_k if do_sample else 50,
-                pad_token_id=self._hf_tokenizer.pad_token_id,
-                eos_token_id=self._hf_tokenizer.eos_token_id,
+                past_key_values=past_key_values,
+                logits_processor=LogitsProcessorList([first_token_timer]),
+                **self._generation_kwargs(temperature, top_p, top_k, do_sample, max_new_tokens)
             )
 
+        prefill_s = first_token_timer.elapsed()
+        self._record_prefill(prefill_s, past_key_values is not None)
+        print(f"[PREFIX CACHE] {'hit' if past_key_values is not None else 'miss'} - prefill {prefill_s:.2f}s")
+
         # Décoder seulement les nouveaux tokens générés
         input_length = inputs["input_ids"].shape[1]
         generated_tokens = output_ids[0][input_length:]
+        self._record_generation(len(generated_tokens), time.perf_counter() - start_time)
         generated = self._hf_tokenizer.decode(generated_tokens, skip_special_tokens=True)
 
         print(f"[DEBUG] Raw generated text (before cleaning): '{generated}'")
@@ -360,16 +738,109 @@ si la question porte sur ce contenu) :
 
         return cleaned
 
-    def generate_from_file(self, transcript_path: Path, isQuestion: bool = False, output_dir: Path = None):
-        transcript_path = Path(transcript_path)
-        print(f"Synthesys of : {transcript_path.name}")
+    def stream_transformers(
+        self,
+        prompt: str,
+        isQuestion: bool = False,
+        temperature: float = 0.3,
+        top_p: float = 0.85,
+        top_k: int = 40,
+        do_sample: bool = None,
+        max_new_tokens: int = 256,
+        system_prompt: Optional[str] = None
+    ):
+        """
+        Version streaming de run_transformers : la génération tourne dans un thread
+        et les morceaux de texte (bruts, non nettoyés) sont produits au fil des tokens.
+        """
+        if self._use_scheduler():
+            yield from self.get_scheduler().stream(
+                prompt, isQuestion, system_prompt=system_prompt, temperature=temperature, top_p=top_p,
+                top_k=top_k, do_sample=do_sample, max_new_tokens=max_new_tokens
+            )
+            return
+
+        self._ensure_hf_model_loaded()
+        import torch
+        from transformers import LogitsProcessorList, TextIteratorStreamer
+
+        inputs, past_key_values = self._prepare_transformers_inputs(prompt, isQuestion, system_prompt)
+        if self.speculative:
+            from lib.batch_scheduler import incremental_text
+            tokens = self._speculative_tokens(inputs, past_key_values, temperature, top_p, top_k, do_sample, max_new_tokens)
+            yield from incremental_text(self._hf_tokenizer, (t for new_tokens in tokens for t in new_tokens))
+            return
+
+        first_token_timer = _FirstTokenTimer()
+        start_time = time.perf_counter()
+        streamer = TextIteratorStreamer(
+            self._hf_tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT_S
+        )
+        errors = []
+
+        def generate():
+            try:
+                with torch.no_grad():
+                    self._hf_model.generate(
+                        **inputs,
+                        past_key_values=past_key_values,
+                        logits_processor=LogitsProcessorList([first_token_timer]),
+                        streamer=streamer,
+                        **self._generation_kwargs(temperature, top_p, top_k, do_sample, max_new_tokens)
+                    )
+            except Exception as e:
+                # Sans end(), le lecteur du streamer attendrait indéfiniment
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            for piece in streamer:
+                if piece:
+                    yield piece
+        except queue.Empty:
+            raise TimeoutError(f"No token generated in {STREAM_TIMEOUT_S}s") from (errors[0] if errors else None)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+        self._record_prefill(first_token_timer.elapsed(), past_key_values is not None)
+        self._record_generation(first_token_timer.tokens, time.perf_counter() - start_time)
+
+    def stream_sentences(self, prompt: str, isQuestion: bool = False, system_prompt: Optional[str] = None):
+        """
+        Découpe le flux de tokens du provider en phrases nettoyées pour le TTS.
+        Les fragments trop courts sont regroupés avec la phrase suivante.
+        """
+        if self.provider == "transformers":
+            pieces = self.stream_transformers(prompt, isQuestion, system_prompt=system_prompt)
+        else:
+            pieces = self.stream_ollama(prompt, isQuestion, system_prompt)
+
+        buffer = ""
+        for piece in pieces:
+            buffer += piece
+            while True:
+                match = SENTENCE_END.search(buffer, MIN_SENTENCE_CHARS)
+                if match is None:
+                    break
+                sentence = self.clean_text_for_tts(buffer[:match.start()]).strip()
+                buffer = buffer[match.end():]
+                if sentence:
+                    yield sentence
+
+        sentence = self.clean_text_for_tts(buffer).strip()
+        if sentence:
+            yield sentence
+
+    def _read_transcript(self, transcript_path: Path, isQuestion: bool) -> str:
         with open(transcript_path, "r", encoding="utf-8") as f:
             transcript = f.read()
 
         # Pour les questions, on retire les timestamps pour faciliter la compréhension du LLM
         if isQuestion:
             # Retire les timestamps [0.00 - 2.00] pour avoir juste le texte
-            import re
             lines = transcript.split('\n')
             clean_lines = []
             for line in lines:
@@ -378,38 +849,41 @@ si la question porte sur ce contenu) :
                 if clean_line.strip():
                     clean_lines.append(clean_line.strip())
             transcript = ' '.join(clean_lines)
+        return transcript
 
+    def _build_prompt(self, transcript_path: Path, isQuestion: bool, workspace=None):
+        return self._prompt_from_transcript(self._read_transcript(transcript_path, isQuestion), isQuestion, workspace)
+
+    def _prompt_from_transcript(self, transcript: str, isQuestion: bool, workspace=None):
         effective_prompt=""
         if(isQuestion):
             effective_prompt = f"""Reponds a cette question de maniere concise et precise:
             {transcript}
             """
+            if self.use_retrieval:
+                passages = self.retrieve(transcript, workspace)
+                if passages:
+                    extracts = "\n".join(f"- {p['text']}" for p in passages)
+                    effective_prompt = f"""Extraits utiles :
+{extracts}
+
+""" + effective_prompt
         else:
             effective_prompt = f"""Voici le transcript horodaté:
             {transcript}
             """
+        return transcript, effective_prompt
 
-        if self.provider == "transformers":
-            result = self.run_transformers(effective_prompt, isQuestion)
-        else:
-            result = self.run_ollama(effective_prompt, isQuestion)
+    def question_text(self, transcript_path: Path) -> str:
+        """Texte de la question transcrite, sans les timestamps."""
+        return self._read_transcript(Path(transcript_path), True)
 
+    def _save_result(self, transcript_path: Path, transcript: str, result: str, isQuestion: bool, output_dir: Path = None, system_prompt: Optional[str] = None):
         # Si la réponse est vide, logger une erreur mais retourner quand même
         if not result or len(result.strip()) < 1:
             print(f"[ERROR] Le modele a genere une reponse vide!")
             result = ""
 
-        # Evaluation par l'IA Juge (ChatGPT) - uniquement pour les questions
-        if isQuestion and result:
-            try:
-                from api.judge import evaluate_and_print
-                system_prompt = self.question_prompt()
-                evaluate_and_print(system_prompt, transcript, result)
-            except ImportError:
-                print("[JUDGE] Module d'evaluation non disponible (pip install openai)")
-            except Exception as e:
-                print(f"[JUDGE] Erreur lors de l'evaluation: {e}")
-
         target_dir = Path(output_dir) if output_dir else self.output_dir
         target_dir.mkdir(exist_ok=True, parents=True)
 
@@ -419,8 +893,76 @@ si la question porte sur ce contenu) :
         with open(output_path, "w", encoding="utf-8") as out:
             out.write(result)
         print(f"Saved to : {output_path}")
+
+        # Evaluation par l'IA Juge (ChatGPT) - uniquement pour les questions
+        # Mise en file (hors du chemin de reponse) : le resultat s'affiche quand il arrive
+        if isQuestion and result:
+            try:
+                from api.judge import submit_evaluation
+                submit_evaluation(system_prompt or self.question_prompt(), transcript, result)
+            except ImportError:
+                print("[JUDGE] Module d'evaluation non disponible")
+            except Exception as e:
+                print(f"[JUDGE] Erreur lors de l'evaluation: {e}")
+
         return (transcript_path.stem + suffix)
 
+    def _session_prompt(self, isQuestion: bool, workspace=None) -> Optional[str]:
+        """Prompt systeme des questions avec le résumé du cours de la session (None = prompt par défaut)."""
+        if isQuestion and workspace is not None:
+            return self.question_prompt(workspace)
+        return None
+
+    def generate_from_file(self, transcript_path: Path, isQuestion: bool = False, output_dir: Path = None, workspace=None):
+        transcript_path = Path(transcript_path)
+        print(f"Synthesys of : {transcript_path.name}")
+        transcript, effective_prompt = self._build_prompt(transcript_path, isQuestion, workspace)
+        return self._generate(transcript_path, transcript, effective_prompt, isQuestion, output_dir, workspace)
+
+    def generate_from_text(self, transcript: str, transcript_path: Path, isQuestion: bool = False, output_dir: Path = None, workspace=None):
+        """Comme generate_from_file, avec un transcript déjà en mémoire (transcript_path sert à nommer le résultat)."""
+        transcript_path = Path(transcript_path)
+        print(f"Synthesys of : {transcript_path.name} (in memory)")
+        transcript, effective_prompt = self._prompt_from_transcript(transcript, isQuestion, workspace)
+        return self._generate(transcript_path, transcript, effective_prompt, isQuestion, output_dir, workspace)
+
+    @myTracer.traced("generate")
+    def _generate(self, transcript_path: Path, transcript: str, effective_prompt: str, isQuestion: bool, output_dir: Path = None, workspace=None):
+        system_prompt = self._session_prompt(isQuestion, workspace)
+
+        if self.provider == "transformers":
+            result = self.run_transformers(effective_prompt, isQuestion, system_prompt=system_prompt)
+        else:
+            result = self.run_ollama(effective_prompt, isQuestion, system_prompt)
+
+        return self._save_result(transcript_path, transcript, result, isQuestion, output_dir, system_prompt)
+
+    def stream_from_file(self, transcript_path: Path, isQuestion: bool = False, output_dir: Path = None, workspace=None):
+        """
+        Comme generate_from_file, mais produit la réponse phrase par phrase dès qu'elle est générée.
+        Le fichier de réponse complet est écrit une fois le flux terminé.
+        """
+        transcript_path = Path(transcript_path)
+        print(f"Streaming synthesys of : {transcript_path.name}")
+        transcript, effective_prompt = self._build_prompt(transcript_path, isQuestion, workspace)
+        system_prompt = self._session_prompt(isQuestion, workspace)
+
+        sentences = []
+        for sentence in self.stream_sentences(effective_prompt, isQuestion, system_prompt):
+            sentences.append(sentence)
+            yield sentence
+
+        self._save_result(transcript_path, transcript, " ".join(sentences), isQuestion, output_dir, system_prompt)
+
+    def summarize_text(self, text: str, system_prompt: str, max_new_tokens: int = 256) -> str:
+        """Résume un morceau de texte avec un prompt systeme donné (utilisé par IncrementalSummarizer)."""
+        prompt = f"""Voici le texte à traiter:
+            {text}
+            """
+        if self.provider == "transformers":
+            return self.run_transformers(prompt, max_new_tokens=max_new_tokens, system_prompt=system_prompt)
+        return self.run_ollama(prompt, system_prompt=system_prompt)
+
     def generate_all(self):
         for transcript_file in sorted(self.transcripts_dir.glob("*.txt")):
             self.generate_from_file(transcript_file)
@@ -442,9 +984,134 @@ si la question porte sur ce contenu) :
         print(f"{file_count} file deleted from {self.output_dir}")
 
 
+class IncrementalSummarizer:
+    """
+    Résumé map-reduce construit pendant le cours :
+    - les segments du transcript sont accumulés puis résumés par blocs de leaf_chars caractères (map)
+    - dès que fan_in résumés existent à un niveau, ils sont fusionnés au niveau supérieur (reduce)
+    Tout tourne en arrière-plan sur un seul worker (le modèle est partagé), la mémoire reste bornée
+    (au plus fan_in - 1 résumés par niveau) et finalize() n'a plus qu'à résumer le dernier bloc et fusionner.
+    """
+
+    def __init__(self, synthesizer, leaf_chars: int = 4000, fan_in: int = 4):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._synth = synthesizer
+        self._leaf_chars = leaf_chars
+        self._fan_in = fan_in
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._pending = []
+        self._pending_chars = 0
+        self._levels = []
+        self._segment_count = 0
+
+    def reset(self):
+        with self._lock:
+            # Les travaux déjà en file pour l'ancien enregistrement seront ignorés
+            self._generation += 1
+            self._pending = []
+            self._pending_chars = 0
+            self._levels = []
+            self._segment_count = 0
+
+    def has_content(self) -> bool:
+        return self._segment_count > 0
+
+    def add_segments(self, segments):
+        """Ajoute des segments (start, end, text) ; lance un résumé partiel quand le bloc est assez gros."""
+        with self._lock:
+            for start, end, text in segments:
+                line = f"[{start:.2f} - {end:.2f}] {text}"
+                self._pending.append(line)
+                self._pending_chars += len(line) + 1
+                self._segment_count += 1
+
+            if self._pending_chars >= self._leaf_chars:
+                self._submit_leaf()
+
+    def _submit_leaf(self):
+        text = "\n".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        self._executor.submit(self._summarize_leaf, text, self._generation)
+
+    def _summarize_leaf(self, text, generation):
+        try:
+            summary = self._synth.summarize_text(text, partial_resume_prompt)
+            self._push(0, summary, generation)
+        except Exception as e:
+            print(f"[IncrementalSummarizer] Erreur lors d'un résumé partiel : {e}")
+
+    def _push(self, level, summary, generation):
+        if generation != self._generation or not summary:
+            return
+        while len(self._levels) <= level:
+            self._levels.append([])
+        self._levels[level].append(summary)
+        print(f"[IncrementalSummarizer] Résumé niveau {level} ({len(self._levels[level])}/{self._fan_in})")
+
+        if len(self._levels[level]) >= self._fan_in:
+            merged = self._synth.summarize_text("\n\n".join(self._levels[level]), merge_resume_prompt)
+            self._levels[level] = []
+            self._push(level + 1, merged, generation)
+
+    def _final_summary(self, generation):
+        if generation != self._generation:
+            return ""
+
+        # Les niveaux hauts couvrent le début du cours : ordre chronologique = du plus haut au plus bas
+        summaries = [summary for level in reversed(self._levels) for summary in level]
+        if not summaries:
+            return ""
+        return self._synth.summarize_text("\n\n".join(summaries), self._synth.default_prompt(), max_new_tokens=512)
+
+    def close(self):
+        self.reset()
+        self._executor.shutdown(wait=False)
+
+    @myTracer.traced("summary_finalize")
+    def finalize(self, transcript_path: Path, timeout: Optional[float] = None, output_dir: Path = None):
+        """Termine le résumé et l'écrit comme generate_from_file (retourne le nom du fichier de résumé)."""
+        start_time = time.time()
+        with self._lock:
+            generation = self._generation
+            if self._pending:
+                self._submit_leaf()
+            future = self._executor.submit(self._final_summary, generation)
+
+        result = future.result(timeout=timeout)
+        print(f"[IncrementalSummarizer] Résumé final prêt en {time.time() - start_time:.2f} secondes")
+        return self._synth._save_result(Path(transcript_path), "", result, False, output_dir)
+
+
 _project_root = Path(__file__).resolve().parent.parent.parent
 # Use model from C:/Models to avoid Windows path issues with spaces
 _qwen_model = "C:/Models/Qwen3-0.6B"
 
 # To switch back to Ollama, set provider="ollama" and model to your ollama model name
-mySynthetizer = SubSynthesizer(model=_qwen_model, provider="transformers")
\ No newline at end of file
+mySynthetizer = SubSynthesizer(model=_qwen_model, provider="transformers")
+mySummarizer = IncrementalSummarizer(mySynthetizer)
+
+# Un résumé incrémental par session (le modèle reste partagé)
+_summarizers = {}
+_summarizers_lock = threading.Lock()
+
+
+def get_summarizer(session_id: Optional[str] = None) -> IncrementalSummarizer:
+    if session_id is None:
+        return mySummarizer
+    with _summarizers_lock:
+        summarizer = _summarizers.get(session_id)
+        if summarizer is None:
+            summarizer = IncrementalSummarizer(mySynthetizer)
+            _summarizers[session_id] = summarizer
+        return summarizer
+
+
+def drop_summarizer(session_id: str):
+    with _summarizers_lock:
+        summarizer = _summarizers.pop(session_id, None)
+    if summarizer is not None:
+        summarizer.close()
\ No newline at end of file
@@ -0,0 +1,188 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Traces gardées en mémoire pour /traces (les plus anciennes sont oubliées)
+MAX_TRACES = 200
+# Bornes des histogrammes de durée, en secondes (format Prometheus)
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Fichier JSONL où chaque trace terminée est ajoutée (vide = pas de dump)
+TRACE_DUMP_PATH = os.environ.get("MILO_TRACE_DUMP", "")
+
+# Trace en cours dans ce thread / cette tâche asyncio
+_current_trace = contextvars.ContextVar("milo_trace_id", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def prometheus_lines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def prometheus_gauge(name, help_text, label, values):
+    """Lignes Prometheus d'une gauge, une valeur par label (ex: {"Audio_topic": 3})."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{{label}="{key}"}} {value}' for key, value in values.items() if value is not None]
+    return lines
+
+
+class Tracer:
+    """
+    Traces de bout en bout du pipeline : une trace par chunk ou par question, faite de spans
+    (décodage, transcription, génération, TTS, emit...). Chaque étape alimente aussi un histogramme
+    de durée exporté sur /metrics ; les traces récentes sont consultables en JSON sur /traces.
+    L'id de la trace suit les messages du bus (champ trace_id) et le contexte du thread courant.
+    """
+
+    def __init__(self, max_traces=MAX_TRACES, dump_path=TRACE_DUMP_PATH):
+        self.max_traces = max_traces
+        self.dump_path = dump_path
+        self._traces = OrderedDict()
+        self._stages = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+
+    # --- traces ---
+
+    def start_trace(self, kind, session_id=None, trace_id=None):
+        trace_id = trace_id or uuid.uuid4().hex[:16]
+        with self._lock:
+            if trace_id not in self._traces:
+                self._traces[trace_id] = {
+                    "trace_id": trace_id,
+                    "kind": kind,
+                    "session_id": session_id,
+                    "start": time.time(),
+                    "duration_ms": None,
+                    "spans": [],
+                }
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+        return trace_id
+
+    def end_trace(self, trace_id=None, **attrs):
+        trace_id = trace_id or _current_trace.get()
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            if trace is None or trace["duration_ms"] is not None:
+                return
+            duration = time.time() - trace["start"]
+            trace["duration_ms"] = round(duration * 1000, 1)
+            trace.update(attrs)
+            self._totals.setdefault(trace["kind"], Histogram()).observe(duration)
+            snapshot = json.dumps(trace, ensure_ascii=False)
+
+        if self.dump_path:
+            with self._dump_lock, open(self.dump_path, "a", encoding="utf-8") as f:
+                f.write(snapshot + "\n")
+
+    @contextlib.contextmanager
+    def activate(self, trace_id):
+        """Rend trace_id courant pour le bloc (les spans sans trace_id explicite y sont rattachés)."""
+        token = _current_trace.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            _current_trace.reset(token)
+
+    def current(self):
+        return _current_trace.get()
+
+    # --- spans ---
+
+    def record(self, name, start, end, trace_id=None, **attrs):
+        """Enregistre un span déjà mesuré (start / end en time.time())."""
+        duration = max(0.0, end - start)
+        trace_id = trace_id or _current_trace.get()
+        with self._lock:
+            self._stages.setdefault(name, Histogram()).observe(duration)
+            trace = self._traces.get(trace_id) if trace_id else None
+            if trace is not None:
+                trace["spans"].append(dict(
+                    name=name,
+                    start_ms=round((start - trace["start"]) * 1000, 1),
+                    duration_ms=round(duration * 1000, 1),
+                    thread=threading.current_thread().name,
+                    **attrs,
+                ))
+
+    @contextlib.contextmanager
+    def span(self, name, trace_id=None, **attrs):
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            attrs["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, start, time.time(), trace_id, **attrs)
+
+    def traced(self, name):
+        """Décorateur : chaque appel de la fonction est un span name."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # --- export ---
+
+    def get_trace(self, trace_id):
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            return json.loads(json.dumps(trace)) if trace is not None else None
+
+    def list_traces(self, session_id=None, kind=None, limit=50):
+        """Traces les plus récentes d'abord."""
+        with self._lock:
+            traces = [
+                t for t in reversed(self._traces.values())
+                if (session_id is None or t["session_id"] == session_id) and (kind is None or t["kind"] == kind)
+            ][:limit]
+            return json.loads(json.dumps(traces))
+
+    def prometheus(self):
+        lines = [
+            "# HELP milo_stage_duration_seconds Durée des étapes du pipeline",
+            "# TYPE milo_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._stages.items()):
+                lines += histogram.prometheus_lines("milo_stage_duration_seconds", f'stage="{name}"')
+            lines += [
+                "# HELP milo_trace_duration_seconds Durée de bout en bout d'un chunk ou d'une question",
+                "# TYPE milo_trace_duration_seconds histogram",
+            ]
+            for kind, histogram in sorted(self._totals.items()):
+                lines += histogram.prometheus_lines("milo_trace_duration_seconds", f'kind="{kind}"')
+        return lines
+
+
+myTracer = Tracer()
@@ -0,0 +1,266 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+import wave
+from pathlib import Path
+
+# Process de transcodage persistants (python -m lib.transcoder) : libav (PyAV) n'est chargé qu'une
+# fois par worker, les jobs et le PCM leur arrivent par pipe (pas de lancement de ffmpeg par conversion)
+TRANSCODE_WORKERS = min(2, os.cpu_count() or 1)
+# Jobs en attente acceptés en plus des workers occupés ; au-delà, submit() attend qu'une place se libère
+MAX_QUEUED_JOBS = 8
+OPUS_BITRATE = 128000
+# Opus n'accepte que 8/12/16/24/48 kHz : le PCM est rééchantillonné
+OPUS_SAMPLE_RATE = 48000
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+
+def _ffmpeg_path():
+    from lib.webm_to_wav_converter import FFMPEG_PATH
+    return str(FFMPEG_PATH)
+
+
+# --- jobs (exécutés dans les workers) ---
+
+def _warm_worker():
+    try:
+        import av  # noqa: F401
+        import numpy  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _ping():
+    return os.getpid()
+
+
+def _encode_opus(pcm, sample_rate, output_path, bitrate):
+    """PCM 16 bits mono -> webm/opus."""
+    try:
+        import av
+        import numpy as np
+    except ImportError:
+        command = [
+            _ffmpeg_path(), "-y",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", str(bitrate),
+            output_path,
+        ]
+        subprocess.run(command, input=pcm, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return output_path
+
+    samples = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+    with av.open(output_path, "w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=OPUS_SAMPLE_RATE)
+        stream.layout = "mono"
+        stream.bit_rate = bitrate
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=OPUS_SAMPLE_RATE)
+
+        frame = av.AudioFrame.from_ndarray(samples, format="s16", layout="mono")
+        frame.sample_rate = sample_rate
+        frames = resampler.resample(frame) + resampler.resample(None)
+        for resampled in frames:
+            for packet in stream.encode(resampled):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return output_path
+
+
+def _transcode_to_wav(input_path, output_path, sample_rate, channels):
+    """Fichier audio quelconque -> WAV 16 bits."""
+    try:
+        import av
+    except ImportError:
+        command = [_ffmpeg_path(), "-y", "-i", input_path, "-ar", str(sample_rate), "-ac", str(channels), output_path]
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
+        return output_path
+
+    layout = "stereo" if channels == 2 else "mono"
+    with av.open(input_path) as container, wave.open(output_path, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        resampler = av.AudioResampler(format="s16", layout=layout, rate=sample_rate)
+        for frame in container.decode(container.streams.audio[0]):
+            frame.pts = None
+            for resampled in resampler.resample(frame):
+                wav_file.writeframes(resampled.to_ndarray().tobytes())
+        for resampled in resampler.resample(None):
+            wav_file.writeframes(resampled.to_ndarray().tobytes())
+    return output_path
+
+
+def _decode_pcm(input_path, sample_rate):
+    """Fichier audio quelconque -> PCM 16 bits mono (bytes), en mémoire."""
+    try:
+        import av
+    except ImportError:
+        command = [_ffmpeg_path(), "-i", input_path, "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+    pieces = []
+    with av.open(input_path) as container:
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+        for frame in container.decode(container.streams.audio[0]):
+            frame.pts = None
+            pieces += [resampled.to_ndarray().tobytes() for resampled in resampler.resample(frame)]
+        pieces += [resampled.to_ndarray().tobytes() for resampled in resampler.resample(None)]
+    return b"".join(pieces)
+
+
+def _file_to_opus(input_path, output_path, bitrate):
+    return _encode_opus(_decode_pcm(input_path, OPUS_SAMPLE_RATE), OPUS_SAMPLE_RATE, output_path, bitrate)
+
+
+# Jobs exécutables par un worker (nom envoyé sur le pipe)
+JOBS = {
+    "ping": _ping,
+    "encode_opus": _encode_opus,
+    "file_to_opus": _file_to_opus,
+    "to_wav": _transcode_to_wav,
+}
+
+
+def _serve():
+    """Boucle d'un worker : (nom du job, arguments) picklés sur stdin, (ok, résultat) sur stdout."""
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    # Un print égaré ne doit pas corrompre le pipe de résultats
+    sys.stdout = sys.stderr
+    _warm_worker()
+    while True:
+        try:
+            name, args = pickle.load(stdin)
+        except EOFError:
+            return
+        try:
+            payload = pickle.dumps((True, JOBS[name](*args)))
+        except Exception as e:
+            # Les exceptions de PyAV/ffmpeg ne sont pas forcément picklables : seul leur texte traverse le pipe
+            payload = pickle.dumps((False, f"{type(e).__name__}: {e}"))
+        stdout.write(payload)
+        stdout.flush()
+
+
+class _Worker:
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "lib.transcoder"],
+            cwd=str(SRC_DIR),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, name, args):
+        pickle.dump((name, args), self.process.stdin)
+        self.process.stdin.flush()
+        ok, result = pickle.load(self.process.stdout)
+        if not ok:
+            raise RuntimeError(f"Transcoder job {name} failed: {result}")
+        return result
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+
+
+class TranscoderPool:
+    """
+    Service de transcodage partagé : TRANSCODE_WORKERS process lancés une fois (au premier job ou par
+    warm_up), un job à la fois par worker, et MAX_QUEUED_JOBS jobs en attente au plus. Les appelants
+    au-delà sont bloqués jusqu'à ce qu'une place se libère (contre-pression plutôt qu'une file sans
+    limite). Un worker mort (crash de libav) est relancé au job suivant.
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS, max_queued=MAX_QUEUED_JOBS):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._idle = queue.Queue()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        self._stats_lock = threading.Lock()
+        self.stats = {"jobs": 0, "errors": 0, "restarts": 0, "in_flight": 0, "wait_s": 0.0, "job_s": 0.0}
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if not self._started:
+                for _ in range(self.workers):
+                    self._idle.put(_Worker())
+                self._started = True
+
+    def warm_up(self):
+        """Lance les workers (libav se charge pendant que le reste du backend démarre)."""
+        self._ensure_started()
+
+    def run(self, name, *args):
+        """Exécute le job name dans un worker libre et attend son résultat."""
+        self._ensure_started()
+        wait_start = time.perf_counter()
+        self._slots.acquire()
+        worker = self._idle.get()
+        start = time.perf_counter()
+        with self._stats_lock:
+            self.stats["in_flight"] += 1
+            self.stats["wait_s"] += start - wait_start
+        try:
+            if not worker.alive():
+                worker = _Worker()
+                with self._stats_lock:
+                    self.stats["restarts"] += 1
+            return worker.call(name, args)
+        except Exception:
+            with self._stats_lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            self._idle.put(worker)
+            self._slots.release()
+            with self._stats_lock:
+                self.stats["in_flight"] -= 1
+                self.stats["jobs"] += 1
+                self.stats["job_s"] += time.perf_counter() - start
+
+    def encode_pcm(self, pcm, sample_rate, output_path, bitrate=OPUS_BITRATE):
+        """PCM 16 bits mono (bytes) -> webm/opus, sans fichier intermédiaire."""
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        return self.run("encode_opus", bytes(pcm), sample_rate, str(output_path), bitrate)
+
+    def encode_file(self, input_path, output_path, bitrate=OPUS_BITRATE):
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        return self.run("file_to_opus", str(input_path), str(output_path), bitrate)
+
+    def to_wav(self, input_path, output_path, sample_rate=22050, channels=2):
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        return self.run("to_wav", str(input_path), str(output_path), sample_rate, channels)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["workers"] = self.workers
+        stats["started"] = self._started
+        stats["avg_job_s"] = stats["job_s"] / stats["jobs"] if stats["jobs"] else None
+        stats["avg_wait_s"] = stats["wait_s"] / stats["jobs"] if stats["jobs"] else None
+        return stats
+
+    def shutdown(self):
+        with self._start_lock:
+            while not self._idle.empty():
+                self._idle.get().close()
+            self._started = False
+
+
+myTranscoder = TranscoderPool()
+
+
+if __name__ == "__main__":
+    _serve()
@@ -1,10 +1,16 @@
-from faster_whisper import WhisperModel
+from collections import namedtuple
 from pathlib import Path
+import threading
 import time
 import os
 
 from lib import file_manager
 from lib import message_queue
+from lib.tracing import myTracer
+from lib.model_registry import whisper_registry
+
+# Segment de transcript avec des timestamps globaux (secondes depuis le début de l'enregistrement)
+TranscriptSegment = namedtuple("TranscriptSegment", ["start", "end", "text"])
 
 class Transcriber:
 
@@ -12,7 +18,7 @@ class Transcriber:
         self._model_size = model_size
         self._device = device
         self._compute_type = compute_type
-        self._model = WhisperModel(str(self._model_size), device=self._device, compute_type=self._compute_type)
+        # Le modèle n'est plus construit ici : il est chargé une seule fois (à la demande) par whisper_registry
 
         # GPU INT8
         # self._model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
@@ -25,6 +31,10 @@ class Transcriber:
         self._audio_dir = file_manager.wav_dir
         self._audio_dir.mkdir(exist_ok=True)
 
+    @property
+    def _model(self):
+        return whisper_registry.get(self._model_size, self._device, self._compute_type)
+
     def setModelSize(self, model_size):
         self._model_size = model_size
 
@@ -42,7 +52,15 @@ class Transcriber:
         self.setAudioFile(audio_dir)
 
     def load_model(self):
-        self._model = WhisperModel(str(self._model_size), device=self._device, compute_type=self._compute_type)
+        # Sans effet si le modèle est déjà chargé pour cette configuration
+        return self._model
+
+    def warm_up(self):
+        """Charge le modèle en arrière-plan, voir is_ready()."""
+        return whisper_registry.warm_up(self._model_size, self._device, self._compute_type)
+
+    def is_ready(self):
+        return whisper_registry.is_ready(self._model_size, self._device, self._compute_type)
 
     def clearTransciptDir(self):
         if not self._output_dir.exists():
@@ -72,7 +90,16 @@ class Transcriber:
 
     def transcribe_file(self, audio_path, output_dir=None):
         audio_path = Path(audio_path)
+        return self._transcribe(str(audio_path), audio_path.name, audio_path.stem, output_dir)
+
+    def transcribe_audio(self, audio, name, output_dir=None):
+        """
+        Transcrit un buffer déjà décodé (numpy float32, mono, 16 kHz) sans passer par un fichier audio.
+        name sert à nommer le transcript (name + ".txt").
+        """
+        return self._transcribe(audio, name, name, output_dir)
 
+    def _transcribe(self, audio, label, stem, output_dir=None):
         # Si output_dir est fourni, on l'utilise, sinon on garde self._output_dir
         if output_dir is not None:
             output_dir = Path(output_dir)
@@ -80,32 +107,164 @@ class Transcriber:
         else:
             output_dir = self._output_dir
 
-        output_path = output_dir / (audio_path.stem + ".txt")
+        output_path = output_dir / (stem + ".txt")
 
         if output_path.exists():
             print(f"{output_path.name} already exist, pass")
             return
 
-        print(f"Begin transcript of : {audio_path.name}")
+        segments = self.transcribe_segments(audio, label)
+
+        with open(output_path, "w", encoding="utf-8") as f:
+            for start, end, text in segments:
+                f.write(f"[{start:.2f} - {end:.2f}] {text}\n")
+
+        print(f"File saved to : {output_path}")
+        #message_queue.message_queue_handler.publish("Transcriber_topic", f"{output_path}")
+
+        return output_path.name
+
+    @myTracer.traced("transcribe")
+    def transcribe_segments(self, audio, label, offset=0.0):
+        """Transcrit audio (chemin ou buffer) et retourne les TranscriptSegment, décalés de offset secondes, sans rien écrire."""
+        print(f"Begin transcript of : {label}")
         start_time = time.time()
 
-        segments, info = self._model.transcribe(str(audio_path), beam_size=5)
+        segments, info = self._model.transcribe(audio, beam_size=5)
 
         print("Detected language '%s' with probability %f" % (info.language, info.language_probability))
 
-        with open(output_path, "w", encoding="utf-8") as f:
-            for segment in segments:
-                start = segment.start
-                end = segment.end
-                text = segment.text.strip()
-                f.write(f"[{start:.2f} - {end:.2f}] {text}\n")
+        result = [TranscriptSegment(offset + segment.start, offset + segment.end, segment.text.strip()) for segment in segments]
 
         delta = time.time() - start_time
-        print(f"File saved to : {output_path}")
-        #message_queue.message_queue_handler.publish("Transcriber_topic", f"{output_path}")
         print(f"Transcription completed in {delta:.2f} seconds")
+        return result
 
-        return output_path.name
+
+# Ecart (s) entre la fin du buffer et le début d'un chunk au-delà duquel on considère un trou
+GAP_TOLERANCE_S = 0.05
+
+
+class _StreamState:
+    def __init__(self):
+        self.buffer = None          # audio pas encore stabilisé (float32, 16 kHz)
+        self.buffer_offset = 0.0    # temps global du début du buffer
+        self.prompt = ""            # fin du texte déjà émis, redonnée à Whisper comme contexte
+        self.partial = []           # segments encore instables du buffer (hypothèse provisoire, sous-titres)
+        self.lock = threading.Lock()
+
+
+class StreamingTranscriber:
+    """
+    Transcription incrémentale d'un cours découpé en chunks.
+    Garde par session un buffer audio glissant et le texte précédent : la fin d'un chunk
+    (mot potentiellement coupé) est retranscrite avec le chunk suivant, et seuls les
+    segments stabilisés sont émis, avec des timestamps globaux. Le VAD de faster-whisper
+    saute les silences.
+    """
+
+    def __init__(self, transcriber, sample_rate=16000, holdback_s=2.0, max_buffer_s=30.0, prompt_chars=200, beam_size=5):
+        self._transcriber = transcriber
+        self._sample_rate = sample_rate
+        self._holdback_s = holdback_s
+        self._max_buffer_s = max_buffer_s
+        self._prompt_chars = prompt_chars
+        self._beam_size = beam_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _state(self, session_id):
+        with self._lock:
+            return self._sessions.setdefault(session_id, _StreamState())
+
+    def reset(self, session_id=None):
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
+
+    def partial(self, session_id):
+        """Segments provisoires (fin du buffer pas encore stabilisée), en temps global."""
+        with self._lock:
+            state = self._sessions.get(session_id)
+        return list(state.partial) if state is not None else []
+
+    @myTracer.traced("transcribe_stream")
+    def feed(self, session_id, audio, final=False, offset=None):
+        """
+        Ajoute un chunk audio (numpy float32 mono) à la session et retourne la liste
+        des nouveaux TranscriptSegment stabilisés. final=True vide tout le buffer.
+        offset : temps global du début de l'audio ; s'il laisse un trou après le buffer
+        (silence retiré par le VAD), le buffer est d'abord transcrit en entier.
+        """
+        import numpy as np
+
+        state = self._state(session_id)
+        with state.lock:
+            emitted = []
+            if offset is not None:
+                buffered = len(state.buffer) if state.buffer is not None else 0
+                if offset - (state.buffer_offset + buffered / self._sample_rate) > GAP_TOLERANCE_S:
+                    if buffered:
+                        emitted = self._transcribe_buffer(session_id, state, final=True)
+                    state.buffer = None
+                    state.buffer_offset = offset
+
+            audio = np.asarray(audio, dtype=np.float32)
+            state.buffer = audio if state.buffer is None else np.concatenate([state.buffer, audio])
+            return emitted + self._transcribe_buffer(session_id, state, final)
+
+    def _transcribe_buffer(self, session_id, state, final):
+        buffer_s = len(state.buffer) / self._sample_rate
+        if buffer_s == 0:
+            state.partial = []
+            return []
+
+        start_time = time.time()
+        segments, _ = self._transcriber._model.transcribe(
+            state.buffer,
+            beam_size=self._beam_size,
+            vad_filter=True,
+            initial_prompt=state.prompt or None,
+        )
+        segments = [seg for seg in segments if seg.text.strip()]
+
+        if final:
+            stable = segments
+            cut_s = buffer_s
+        else:
+            # Un segment qui finit près de la fin du buffer peut être coupé : on le garde pour le tour suivant
+            limit = buffer_s - self._holdback_s
+            stable = [seg for seg in segments if seg.end <= limit]
+            cut_s = stable[-1].end if stable else 0.0
+            if len(stable) == len(segments):
+                # Plus que du silence après le dernier segment : on ne garde que la fin du buffer
+                cut_s = max(cut_s, limit)
+
+            # Buffer borné : au-delà de max_buffer_s on valide tout sauf le dernier segment
+            if buffer_s - cut_s > self._max_buffer_s:
+                stable = segments[:-1] or segments
+                cut_s = stable[-1].end if len(stable) < len(segments) else buffer_s
+
+        emitted = [
+            TranscriptSegment(state.buffer_offset + seg.start, state.buffer_offset + seg.end, seg.text.strip())
+            for seg in stable
+        ]
+        state.partial = [
+            TranscriptSegment(state.buffer_offset + seg.start, state.buffer_offset + seg.end, seg.text.strip())
+            for seg in segments[len(stable):]
+        ]
+
+        cut_samples = int(cut_s * self._sample_rate)
+        state.buffer = state.buffer[cut_samples:]
+        state.buffer_offset += cut_samples / self._sample_rate
+        if emitted:
+            state.prompt = (state.prompt + " " + " ".join(seg.text for seg in emitted)).strip()[-self._prompt_chars:]
+
+        print(f"[StreamingTranscriber] {session_id}: {len(emitted)} new segments, {len(state.buffer) / self._sample_rate:.1f}s kept, {time.time() - start_time:.2f} seconds")
+        return emitted
 
 
-myTranscrib = Transcriber(device="cpu", compute_type="int8")
\ No newline at end of file
+myTranscrib = Transcriber(device="cpu", compute_type="int8")
+myStreamingTranscrib = StreamingTranscriber(myTranscrib)
\ No newline at end of file
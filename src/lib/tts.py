@@ -1,19 +1,53 @@
 import piper
 import os
+import re
 import wave
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from lib import file_manager
+from lib.tracing import myTracer
+
+# Synthèse phrase par phrase en parallèle (onnxruntime relâche le GIL pendant l'inférence)
+PARALLEL_SENTENCES = True
+TTS_WORKERS = min(4, os.cpu_count() or 1)
+
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?…])\s+|\n+')
+MIN_SENTENCE_CHARS = 12
+
+
+def split_sentences(txt):
+    """Découpe le texte en phrases (les fragments trop courts sont recollés à la phrase suivante)."""
+    sentences = []
+    pending = ""
+    for part in SENTENCE_SPLIT.split(txt):
+        part = part.strip()
+        if not part:
+            continue
+        pending = f"{pending} {part}" if pending else part
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ""
+    if pending:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
 
 class TextToSpeech:
-    def __init__(self, model_path=os.path.join(file_manager.tts_model_dir,"fr_FR-upmc-medium.onnx")):
+    def __init__(self, model_path=os.path.join(file_manager.tts_model_dir,"fr_FR-upmc-medium.onnx"), workers=TTS_WORKERS):
         self.model = piper.PiperVoice.load(model_path)
+        self.sample_rate = self.model.config.sample_rate
+        self.workers = workers
+        self._executor = None
 
+    @myTracer.traced("tts")
     def text_to_speech(self, txt_path, output_path=None):
         with open(txt_path, "r", encoding="utf-8") as f:
             txt = f.read()
 
-        start_time = time.time()
         timestamp = int(time.time() * 1000)
 
         if output_path is None:
@@ -22,6 +56,14 @@ class TextToSpeech:
             if os.path.isdir(output_path):
                 output_path = os.path.join(output_path, f"out_{timestamp}.wav")
 
+        if PARALLEL_SENTENCES and self.workers > 1:
+            return self.parallel_to_speech(txt, output_path)
+        return self.sentence_to_speech(txt, output_path)
+
+    @myTracer.traced("tts_sentence")
+    def sentence_to_speech(self, txt, output_path):
+        """Synthétise directement un texte (ex: une phrase du streaming) dans le fichier WAV output_path."""
+        start_time = time.time()
         output_path = str(output_path)
 
         with wave.open(output_path, "wb") as wav_file:
@@ -31,4 +73,73 @@ class TextToSpeech:
         print(f"TTS completed in {delta:.2f} seconds -> {output_path}")
         return output_path
 
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tts")
+        return self._executor
+
+    def _synthesize_pcm(self, sentence):
+        """PCM 16 bits mono d'une phrase."""
+        return b"".join(chunk.audio_int16_bytes for chunk in self.model.synthesize(sentence))
+
+    def stream_pcm(self, txt, stats=None):
+        """
+        Synthétise les phrases de txt en parallèle et rend leur PCM (16 bits mono, self.sample_rate)
+        dans l'ordre du texte, chacune dès qu'elle est prête. Les stats de cet appel sont ajoutées au dict
+        stats à la fin (pas d'état partagé : plusieurs sessions synthétisent en même temps).
+        """
+        start_time = time.time()
+        sentences = split_sentences(txt)
+        executor = self._get_executor()
+        futures = [executor.submit(self._synthesize_pcm, sentence) for sentence in sentences]
+
+        first_audio_s = None
+        total_bytes = 0
+        try:
+            for future in futures:
+                pcm = future.result()
+                if first_audio_s is None:
+                    first_audio_s = time.time() - start_time
+                total_bytes += len(pcm)
+                yield pcm
+        finally:
+            # Si le consommateur s'arrête en route, on n'attend pas les phrases restantes
+            for future in futures:
+                future.cancel()
+
+        if stats is None:
+            return
+        synth_s = time.time() - start_time
+        audio_s = total_bytes / (2 * self.sample_rate)
+        stats.update({
+            "sentences": len(sentences),
+            "first_audio_s": round(first_audio_s, 3) if first_audio_s is not None else None,
+            "synth_s": round(synth_s, 3),
+            "audio_s": round(audio_s, 3),
+            "rtf": round(synth_s / audio_s, 3) if audio_s else None,
+        })
+
+    @myTracer.traced("tts_pcm")
+    def synthesize_pcm(self, txt):
+        """PCM 16 bits mono (self.sample_rate) de tout le texte, sans fichier WAV (ex: pour pcm_to_webm)."""
+        if PARALLEL_SENTENCES and self.workers > 1:
+            return b"".join(self.stream_pcm(txt))
+        return self._synthesize_pcm(txt)
+
+    def parallel_to_speech(self, txt, output_path):
+        """Comme sentence_to_speech, mais phrase par phrase en parallèle, écrites dans l'ordre dès qu'elles sont prêtes."""
+        output_path = str(output_path)
+
+        stats = {}
+        with wave.open(output_path, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            for pcm in self.stream_pcm(txt, stats):
+                wav_file.writeframes(pcm)
+
+        print(f"TTS completed in {stats['synth_s']:.2f} seconds ({stats['sentences']} sentences, "
+              f"first audio {stats['first_audio_s']}s, RTF {stats['rtf']}) -> {output_path}")
+        return output_path
+
 myTTS = TextToSpeech()
@@ -0,0 +1,152 @@
+import threading
+from collections import namedtuple
+
+# Détection de parole avant Whisper : les chunks silencieux ne sont pas transcrits,
+# les silences des autres sont retirés (Whisper ne calcule que sur la parole)
+VAD_ENABLED = True
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+# Une trame est de la parole si son énergie dépasse le bruit de fond du chunk de ENERGY_MARGIN_DB...
+ENERGY_MARGIN_DB = 10.0
+# ... sans que le seuil sorte de [MIN_THRESHOLD_DB, MAX_THRESHOLD_DB] (dBFS)
+MIN_THRESHOLD_DB = -50.0
+MAX_THRESHOLD_DB = -30.0
+# En dessous de cet écart entre trames fortes et faibles (p90 - p10), le bruit de fond du chunk n'est
+# pas mesurable (bruit stationnaire seul, ou parole noyée dedans) : seul le seuil absolu
+# MIN_THRESHOLD_DB s'applique, le chunk n'est pas écarté sur ce seul critère
+MIN_DYNAMIC_RANGE_DB = 6.0
+# Lissage des zones de parole
+MIN_SPEECH_MS = 150
+MIN_SILENCE_MS = 600
+PAD_MS = 300
+# En dessous de cette proportion de parole, le chunk est jugé silencieux
+MIN_SPEECH_RATIO = 0.02
+# webrtcvad (si installé) confirme les trames détectées par l'énergie ; 0 = permissif, 3 = strict
+WEBRTC_MODE = 2
+
+VadResult = namedtuple("VadResult", ["duration", "regions", "speech_ratio", "backend"])
+
+
+def speech_duration(regions):
+    return sum(end - start for start, end in regions)
+
+
+def trim(audio, regions, sample_rate=SAMPLE_RATE):
+    """Audio réduit aux zones de parole (mises bout à bout)."""
+    import numpy as np
+
+    pieces = [audio[int(start * sample_rate):int(end * sample_rate)] for start, end in regions]
+    return np.concatenate(pieces) if pieces else audio[:0]
+
+
+def to_original(t, regions):
+    """Temps t dans l'audio trimé -> temps dans l'audio d'origine."""
+    elapsed = 0.0
+    for start, end in regions:
+        length = end - start
+        if t <= elapsed + length:
+            return start + (t - elapsed)
+        elapsed += length
+    return regions[-1][1] if regions else t
+
+
+class VoiceActivityDetector:
+    """
+    VAD CPU par trames de FRAME_MS : énergie au-dessus du bruit de fond du chunk, confirmée par
+    webrtcvad s'il est installé. Les zones de parole sont élargies de PAD_MS et les silences
+    plus courts que MIN_SILENCE_MS sont fusionnés (pas de mot coupé).
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self._webrtc = None
+        self._webrtc_checked = False
+        self._lock = threading.Lock()
+        self.stats = {"chunks": 0, "silent_chunks": 0, "audio_s": 0.0, "speech_s": 0.0}
+
+    def _get_webrtc(self):
+        if not self._webrtc_checked:
+            self._webrtc_checked = True
+            try:
+                import webrtcvad
+                self._webrtc = webrtcvad.Vad(WEBRTC_MODE)
+            except ImportError:
+                pass
+        return self._webrtc
+
+    def _frame_flags(self, audio):
+        import numpy as np
+
+        frame = int(self.sample_rate * self.frame_ms / 1000)
+        n_frames = len(audio) // frame
+        frames = audio[:n_frames * frame].reshape(n_frames, frame)
+        energy_db = 10 * np.log10(np.mean(frames.astype(np.float64) ** 2, axis=1) + 1e-10)
+
+        noise_floor, loud = np.percentile(energy_db, [10, 90])
+        if loud - noise_floor < MIN_DYNAMIC_RANGE_DB:
+            threshold = MIN_THRESHOLD_DB
+        else:
+            threshold = min(max(noise_floor + ENERGY_MARGIN_DB, MIN_THRESHOLD_DB), MAX_THRESHOLD_DB)
+        flags = energy_db > threshold
+
+        webrtc = self._get_webrtc()
+        if webrtc is not None:
+            pcm = (np.clip(frames, -1.0, 1.0) * 32767).astype("<i2")
+            flags &= np.array([webrtc.is_speech(row.tobytes(), self.sample_rate) for row in pcm], dtype=bool)
+        return flags
+
+    def _regions(self, flags, duration):
+        frame_s = self.frame_ms / 1000
+        runs = []
+        start = None
+        for i, speech in enumerate(list(flags) + [False]):
+            if speech and start is None:
+                start = i
+            elif not speech and start is not None:
+                if (i - start) * frame_s * 1000 >= MIN_SPEECH_MS:
+                    runs.append([start * frame_s, i * frame_s])
+                start = None
+
+        pad_s = PAD_MS / 1000
+        regions = []
+        for run_start, run_end in runs:
+            run_start, run_end = max(0.0, run_start - pad_s), min(duration, run_end + pad_s)
+            if regions and run_start - regions[-1][1] < MIN_SILENCE_MS / 1000:
+                regions[-1][1] = run_end
+            else:
+                regions.append([run_start, run_end])
+        return [(round(s, 3), round(e, 3)) for s, e in regions]
+
+    def analyze(self, audio):
+        """Zones de parole (secondes) et proportion de parole d'un chunk (numpy float32 mono, 16 kHz)."""
+        import numpy as np
+
+        audio = np.asarray(audio, dtype=np.float32)
+        duration = len(audio) / self.sample_rate
+        # Moins d'une trame : rien à analyser
+        if len(audio) < int(self.sample_rate * self.frame_ms / 1000):
+            return VadResult(duration, [], 0.0, "energy")
+
+        regions = self._regions(self._frame_flags(audio), duration)
+        speech_ratio = speech_duration(regions) / duration
+        if speech_ratio < MIN_SPEECH_RATIO:
+            regions, speech_ratio = [], 0.0
+        backend = "energy+webrtc" if self._webrtc is not None else "energy"
+        result = VadResult(duration, regions, round(speech_ratio, 3), backend)
+
+        with self._lock:
+            self.stats["chunks"] += 1
+            self.stats["silent_chunks"] += not regions
+            self.stats["audio_s"] += duration
+            self.stats["speech_s"] += speech_duration(regions)
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["speech_ratio"] = stats["speech_s"] / stats["audio_s"] if stats["audio_s"] else None
+        return stats
+
+
+myVad = VoiceActivityDetector()
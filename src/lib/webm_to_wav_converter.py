@@ -2,11 +2,20 @@ import os
 import subprocess
 from pathlib import Path
 
+from lib.tracing import myTracer
+from lib.transcoder import myTranscoder
+
 # Chemin absolu vers FFmpeg
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 FFMPEG_PATH = BASE_DIR / "ffmpeg-8.0-essentials_build" / "bin" / "ffmpeg.exe"
 
+# Décodage des chunks directement en mémoire (16 kHz mono float32, format attendu par Whisper).
+# False = ancien mode fichier (convert_to_wav puis relecture du WAV)
+DECODE_IN_MEMORY = True
+WHISPER_SAMPLE_RATE = 16000
+
 
+@myTracer.traced("convert_to_wav")
 def convert_to_wav(input_dir, output_dir, file_name):
     """
     Convertit un fichier .webm en .wav
@@ -26,18 +35,11 @@ def convert_to_wav(input_dir, output_dir, file_name):
     output_path = output_dir / f"{base_name}.wav"
 
     print(f"Conversion de {input_path} -> {output_path}")
-    command = [
-        str(FFMPEG_PATH),
-        "-i", str(input_path),
-        "-ar", "22050",  # fréquence d'échantillonnage
-        "-ac", "2",      # stéréo
-        str(output_path)
-    ]
-    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
-
-    return str(output_path)
+    # 22050 Hz stéréo, par un worker du pool de transcodage (voir lib/transcoder.py)
+    return myTranscoder.to_wav(input_path, output_path, sample_rate=22050, channels=2)
 
 
+@myTracer.traced("convert_to_webm")
 def convert_to_webm(input_file_path, output_dir):
     """
     Convertit un fichier audio en .webm (Opus)
@@ -55,18 +57,75 @@ def convert_to_webm(input_file_path, output_dir):
     output_path = output_dir / f"{input_path.stem}.webm"
 
     print(f"[convert_to_webm] Conversion de {input_path} -> {output_path}")
+    return myTranscoder.encode_file(input_path, output_path)
+
+
+@myTracer.traced("encode_webm")
+def pcm_to_webm(pcm, sample_rate, output_path):
+    """
+    Encode du PCM 16 bits mono (ex: sortie de Piper) en .webm (Opus), sans WAV intermédiaire
+    - pcm: bytes
+    - sample_rate: fréquence du PCM
+    - output_path: fichier .webm à écrire
+    """
+    print(f"[pcm_to_webm] {len(pcm) / (2 * sample_rate):.1f}s d'audio -> {output_path}")
+    return myTranscoder.encode_pcm(pcm, sample_rate, output_path)
+
+
+@myTracer.traced("decode")
+def decode_to_array(input_dir, file_name, sample_rate=WHISPER_SAMPLE_RATE):
+    """
+    Décode un fichier .webm (Opus) en mémoire, sans écrire de WAV
+    - input_dir: dossier contenant le fichier source
+    - file_name: nom du fichier webm
+    - sample_rate: fréquence de sortie (16 kHz pour Whisper)
+    Retourne un numpy.ndarray float32 mono
+    """
+    input_path = Path(input_dir) / file_name
+
+    if not input_path.is_file():
+        raise FileNotFoundError(f"Le fichier {input_path} n'existe pas.")
+
+    try:
+        return _decode_with_pyav(input_path, sample_rate)
+    except ImportError:
+        # PyAV absent : ffmpeg décode vers un pipe, toujours sans fichier intermédiaire
+        return _decode_with_ffmpeg_pipe(input_path, sample_rate)
+
+
+def _decode_with_pyav(input_path, sample_rate):
+    import av
+    import numpy as np
+
+    chunks = []
+    with av.open(str(input_path)) as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+
+        for frame in container.decode(stream):
+            frame.pts = None
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+
+        # Vide le buffer interne du resampler
+        for resampled in resampler.resample(None):
+            chunks.append(resampled.to_ndarray().reshape(-1))
+
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+
+def _decode_with_ffmpeg_pipe(input_path, sample_rate):
+    import numpy as np
 
     command = [
-        str(FFMPEG_PATH), "-y",
+        str(FFMPEG_PATH),
         "-i", str(input_path),
-        "-c:a", "libopus",
-        "-b:a", "128k",
-        str(output_path)
+        "-f", "f32le",
+        "-ac", "1",
+        "-ar", str(sample_rate),
+        "pipe:1"
     ]
-    result = subprocess.run(command, capture_output=True, text=True)
-
-    if result.returncode != 0:
-        print("[convert_to_webm] Erreur ffmpeg :", result.stderr)
-        raise RuntimeError(f"ffmpeg a échoué pour {input_path}")
-
-    return str(output_path)
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
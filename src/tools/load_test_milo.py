@@ -0,0 +1,598 @@
+"""
+Test de charge de Milo : rejoue des cours (séquences de chunks webm) et des questions (clips webm)
+contre /upload-audio et /upload-question avec N utilisateurs simultanés, écoute Socket.IO
+(new_audio, new_response_audio, new_response_segment...) et mesure débit, latences de bout en bout,
+retard des files du bus et taux d'erreurs.
+
+Mode hors-ligne : `serve` lance le backend avec des modèles factices (Whisper, LLM et TTS simulés,
+latences réglables) et le bus en mémoire, sans Redis ni modèles téléchargés.
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+import wave
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+RESPONSE_EVENTS = ("new_audio", "new_response_audio", "new_response_segment", "response_segments_end")
+
+STUB_ANSWER = (
+    "Alors, du coup, c'est une très bonne question. Franchement, le cours l'explique bien dans la première partie. "
+    "À ta place, je relirais les définitions avant le DS. Tu vois ?"
+)
+
+
+# ============================================================================
+# MODÈLES FACTICES (mode serve)
+# ============================================================================
+
+StubSegment = namedtuple("StubSegment", ["start", "end", "text"])
+
+
+def _audio_duration(audio):
+    if isinstance(audio, (str, Path)):
+        with wave.open(str(audio), "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    return len(audio) / 16000
+
+
+class StubWhisperModel:
+    """Remplace faster_whisper.WhisperModel : un segment toutes les 5 s, temps de calcul = durée x rtf."""
+
+    def __init__(self, rtf):
+        self.rtf = rtf
+
+    def transcribe(self, audio, **kwargs):
+        duration = _audio_duration(audio)
+        time.sleep(duration * self.rtf)
+        segments = [
+            StubSegment(float(start), float(min(start + 5, duration)), f"phrase de test numéro {i} sur le cours.")
+            for i, start in enumerate(range(0, math.ceil(duration), 5))
+        ]
+        info = types.SimpleNamespace(language="fr", language_probability=1.0)
+        return iter(segments), info
+
+
+class StubVoice:
+    """Remplace piper.PiperVoice : du silence, environ 60 ms par caractère, temps de calcul = durée x rtf."""
+
+    def __init__(self, rtf, sample_rate=22050):
+        self.rtf = rtf
+        self.config = types.SimpleNamespace(sample_rate=sample_rate)
+
+    def _pcm(self, text):
+        seconds = 0.06 * len(text)
+        time.sleep(seconds * self.rtf)
+        return b"\0\0" * int(seconds * self.config.sample_rate)
+
+    def synthesize_wav(self, text, wav_file):
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(self.config.sample_rate)
+        wav_file.writeframes(self._pcm(text))
+
+    def synthesize(self, text):
+        yield types.SimpleNamespace(audio_int16_bytes=self._pcm(text))
+
+
+def install_stub_models(whisper_rtf=0.05, tokens_per_s=40.0, tts_rtf=0.05):
+    """A appeler avant d'importer back_launcher : Whisper, Qwen, Piper et le juge distant sont simulés."""
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+    piper_stub = types.ModuleType("piper")
+    piper_stub.PiperVoice = types.SimpleNamespace(load=lambda *args, **kwargs: StubVoice(tts_rtf))
+    sys.modules["piper"] = piper_stub
+
+    from lib import model_registry, subsynthetizer
+    from api import judge
+
+    def load_whisper(self, key):
+        model = StubWhisperModel(whisper_rtf)
+        self._models[key] = model
+        return model
+
+    def run_transformers(self, prompt, isQuestion=False, *args, **kwargs):
+        time.sleep(len(STUB_ANSWER.split()) / tokens_per_s)
+        return STUB_ANSWER
+
+    def stream_transformers(self, prompt, isQuestion=False, *args, **kwargs):
+        for word in STUB_ANSWER.split(" "):
+            time.sleep(1 / tokens_per_s)
+            yield word + " "
+
+    model_registry.WhisperModelRegistry._load = load_whisper
+    subsynthetizer.SubSynthesizer._ensure_hf_model_loaded = lambda self: None
+    subsynthetizer.SubSynthesizer.run_transformers = run_transformers
+    subsynthetizer.SubSynthesizer.stream_transformers = stream_transformers
+    # Juge local (pas d'appel réseau)
+    judge._client_checked = True
+    judge._client = None
+
+
+def serve(args):
+    os.environ.setdefault("MILO_EVENT_BUS", "memory")
+    install_stub_models(args.whisper_rtf, args.tokens_per_s, args.tts_rtf)
+
+    import back_launcher
+    # Le moteur de batching a besoin du vrai modèle
+    back_launcher.BATCHED_INFERENCE = False
+    # Les questions rejouées (et le texte du Whisper factice, qui ne dépend que de la durée) se répètent :
+    # avec le cache des réponses, les latences mesureraient le cache et non le pipeline
+    back_launcher.RESPONSE_CACHE = args.response_cache
+    back_launcher.init_backend()
+    back_launcher.socketio.run(back_launcher.app, host=args.host, port=args.port, allow_unsafe_werkzeug=True)
+
+
+# ============================================================================
+# AUDIO DE TEST
+# ============================================================================
+
+def write_test_webm(path, seconds, frequency=220.0, sample_rate=48000):
+    """Clip webm/opus (sinusoïde modulée comme des syllabes, vue comme de la parole par le VAD)."""
+    import av
+    import numpy as np
+
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)
+    samples = (0.2 * envelope * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+    with av.open(str(path), "w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=sample_rate)
+        stream.layout = "mono"
+        for start in range(0, len(samples), 960):
+            frame = av.AudioFrame.from_ndarray(samples[start:start + 960].reshape(1, -1), format="flt", layout="mono")
+            frame.sample_rate = sample_rate
+            frame.pts = start
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return Path(path)
+
+
+def generate_test_audio(out_dir, chunks=3, chunk_s=10.0, questions=3, question_s=3.0):
+    out_dir = Path(out_dir)
+    lecture_dir = out_dir / "lecture"
+    question_dir = out_dir / "questions"
+    lecture_dir.mkdir(parents=True, exist_ok=True)
+    question_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(chunks):
+        write_test_webm(lecture_dir / f"chunk_{i:03d}.webm", chunk_s, 220.0 + 20 * i)
+    for i in range(questions):
+        write_test_webm(question_dir / f"question_{i:03d}.webm", question_s, 440.0 + 40 * i)
+    return lecture_dir, question_dir
+
+
+# ============================================================================
+# MESURES
+# ============================================================================
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoadRecorder:
+    """Latences (secondes) et compteurs partagés par les utilisateurs virtuels."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.counts = Counter()
+        self.lag_samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def sample_lag(self, metrics):
+        with self._lock:
+            for topic, stats in metrics.items():
+                self.lag_samples[topic].append((stats.get("pending") or 0) + (stats.get("lag") or 0))
+
+    def summary(self, elapsed_s):
+        with self._lock:
+            latencies = {
+                name: {
+                    "count": len(values),
+                    "p50_s": round(percentile(values, 50), 3),
+                    "p95_s": round(percentile(values, 95), 3),
+                    "p99_s": round(percentile(values, 99), 3),
+                    "max_s": round(max(values), 3),
+                }
+                for name, values in sorted(self.latencies.items()) if values
+            }
+            lag = {
+                topic: {"max": max(samples), "mean": round(sum(samples) / len(samples), 2)}
+                for topic, samples in sorted(self.lag_samples.items()) if samples
+            }
+            counts = dict(self.counts)
+
+        requests_sent = counts.get("requests", 0)
+        jobs = counts.get("questions", 0) + counts.get("lectures", 0)
+        return {
+            "elapsed_s": round(elapsed_s, 2),
+            "throughput": {
+                "questions_per_min": round(counts.get("questions_ok", 0) / elapsed_s * 60, 2) if elapsed_s else None,
+                "lectures_per_min": round(counts.get("lectures_ok", 0) / elapsed_s * 60, 2) if elapsed_s else None,
+                "chunks_per_s": round(counts.get("chunks", 0) / elapsed_s, 2) if elapsed_s else None,
+            },
+            "latency": latencies,
+            "queue_lag": lag,
+            "errors": {
+                "http_error_rate": round(counts.get("http_errors", 0) / requests_sent, 4) if requests_sent else None,
+                "rejected_503_rate": round(counts.get("rejected_503", 0) / requests_sent, 4) if requests_sent else None,
+                "timeout_rate": round(counts.get("timeouts", 0) / jobs, 4) if jobs else None,
+            },
+            "counts": counts,
+        }
+
+
+# ============================================================================
+# UTILISATEURS VIRTUELS
+# ============================================================================
+
+class VirtualUser:
+    """Un onglet Milo : sa session, sa connexion Socket.IO, et un job (cours ou question) à la fois."""
+
+    def __init__(self, base_url, index, recorder, timeout_s=300.0, max_retries=5):
+        import requests
+        import socketio
+
+        self.base_url = base_url.rstrip("/")
+        self.session_id = f"load{index}{uuid.uuid4().hex[:8]}"
+        self.recorder = recorder
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.http = requests.Session()
+        self.events = queue.Queue()
+        self.sio = socketio.Client(reconnection=False)
+        for event in RESPONSE_EVENTS:
+            self.sio.on(event, self._make_handler(event))
+        self._questions = 0
+
+    def _make_handler(self, event):
+        return lambda data=None: self.events.put((event, data or {}, time.time()))
+
+    def connect(self):
+        self.sio.connect(self.base_url, wait_timeout=10)
+        response = self.sio.call("join_session", {"session_id": self.session_id}, timeout=10)
+        if not response or response.get("status") != "ok":
+            raise RuntimeError(f"join_session refused: {response}")
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+    def post(self, path, data, file_path=None, filename=None):
+        """POST multipart ; un 503 est réessayé après Retry-After (compté dans rejected_503)."""
+        data = dict(data, session_id=self.session_id)
+        payload = Path(file_path).read_bytes() if file_path else None
+        for attempt in range(self.max_retries + 1):
+            files = {"file": (filename or Path(file_path).name, payload, "audio/webm")} if payload is not None else None
+            self.recorder.count("requests")
+            try:
+                response = self.http.post(f"{self.base_url}{path}", data=data, files=files, timeout=60)
+            except Exception as e:
+                self.recorder.count("http_errors")
+                raise RuntimeError(f"{path}: {e}")
+            if response.status_code == 503 and attempt < self.max_retries:
+                self.recorder.count("rejected_503")
+                time.sleep(float(response.headers.get("Retry-After", 2)))
+                continue
+            if response.status_code >= 400:
+                self.recorder.count("http_errors")
+                raise RuntimeError(f"{path}: HTTP {response.status_code}")
+            return response
+
+    def _drain(self):
+        while not self.events.empty():
+            self.events.get_nowait()
+
+    def wait_for(self, names, timeout_s):
+        deadline = time.time() + timeout_s
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                event = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if event[0] in names:
+                return event
+
+    def run_lecture(self, chunks, chunk_interval_s):
+        self._drain()
+        self.recorder.count("lectures")
+        self.post("/start-recording", {})
+        for i, chunk in enumerate(chunks):
+            last_chunk = i == len(chunks) - 1
+            start = time.time()
+            self.post("/upload-audio", {"last_chunk": str(last_chunk).lower(), "chunk_index": i}, chunk)
+            self.recorder.observe("chunk_upload", time.time() - start)
+            self.recorder.count("chunks")
+            if chunk_interval_s and not last_chunk:
+                time.sleep(chunk_interval_s)
+
+        last_upload = time.time()
+        event = self.wait_for({"new_audio"}, self.timeout_s)
+        if event is None:
+            self.recorder.count("timeouts")
+            return
+        self.recorder.observe("lecture_summary", event[2] - last_upload)
+        self.recorder.count("lectures_ok")
+
+    def run_question(self, clip):
+        self._drain()
+        self.recorder.count("questions")
+        self._questions += 1
+        start = time.time()
+        self.post("/upload-question", {}, clip, f"full_{self.session_id}_{self._questions:04d}.webm")
+
+        first = self.wait_for({"new_response_segment", "new_response_audio"}, self.timeout_s)
+        if first is None:
+            self.recorder.count("timeouts")
+            return
+        self.recorder.observe("question_first_audio", first[2] - start)
+
+        if first[0] == "new_response_segment":
+            end = self.wait_for({"response_segments_end"}, self.timeout_s)
+            if end is None:
+                self.recorder.count("timeouts")
+                return
+            self.recorder.observe("question_total", end[2] - start)
+        else:
+            self.recorder.observe("question_total", first[2] - start)
+        self.recorder.count("questions_ok")
+
+
+def monitor_bus(base_url, recorder, stop, interval_s=1.0):
+    import requests
+
+    while not stop.wait(interval_s):
+        try:
+            recorder.sample_lag(requests.get(f"{base_url}/bus-metrics", timeout=5).json())
+        except Exception:
+            recorder.count("metrics_errors")
+
+
+def response_cache_counts(base_url):
+    """Compteurs du cache des réponses du backend (None si indisponible)."""
+    import requests
+
+    try:
+        stats = requests.get(f"{base_url}/inference-metrics", timeout=5).json().get("response_cache") or {}
+    except Exception:
+        return None
+    return {key: stats.get(key) or 0 for key in ("hits", "near_hits", "misses")}
+
+
+def cache_hit_rate(before, after):
+    """Taux de réussite du cache des réponses pendant le test (None sans mesure ou sans recherche)."""
+    if before is None or after is None:
+        return None
+    delta = {key: after[key] - before[key] for key in after}
+    lookups = sum(delta.values())
+    return dict(delta, hit_rate=round((delta["hits"] + delta["near_hits"]) / lookups, 3) if lookups else None)
+
+
+def wait_ready(base_url, timeout_s=120.0):
+    import requests
+
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return True
+        except Exception:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def run_load(args):
+    base_url = args.url.rstrip("/")
+    workdir = None
+    server = None
+
+    lecture_dir, question_dir = args.lecture_dir, args.question_dir
+    if not lecture_dir or not question_dir:
+        workdir = tempfile.mkdtemp(prefix="milo_load_")
+        generated = generate_test_audio(workdir, args.chunks, args.chunk_seconds, 3, args.question_seconds)
+        lecture_dir, question_dir = lecture_dir or generated[0], question_dir or generated[1]
+    chunks = sorted(Path(lecture_dir).glob("*.webm"))
+    clips = sorted(Path(question_dir).glob("*.webm"))
+    if (args.lectures and not chunks) or (args.questions and not clips):
+        print("❌ Aucun fichier .webm à rejouer")
+        return None
+
+    if args.stub_server:
+        env = dict(os.environ, MILO_EVENT_BUS="memory")
+        port = base_url.rsplit(":", 1)[-1]
+        command = [sys.executable, str(Path(__file__).resolve()), "serve", "--port", port]
+        if args.response_cache:
+            command.append("--response-cache")
+        server = subprocess.Popen(command, env=env)
+
+    try:
+        if not wait_ready(base_url):
+            print(f"❌ Backend pas prêt : {base_url}/ready")
+            return None
+
+        jobs = queue.Queue()
+        mix = [("lecture", chunks)] * args.lectures + [("question", clips[i % len(clips)]) for i in range(args.questions)]
+        random.Random(args.seed).shuffle(mix)
+        for job in mix:
+            jobs.put(job)
+
+        recorder = LoadRecorder()
+        cache_before = response_cache_counts(base_url)
+        stop = threading.Event()
+        threading.Thread(target=monitor_bus, args=(base_url, recorder, stop), daemon=True).start()
+
+        def worker(index):
+            user = VirtualUser(base_url, index, recorder, args.timeout)
+            try:
+                user.connect()
+            except Exception as e:
+                print(f"[LOAD] Utilisateur {index} : connexion impossible ({e})")
+                recorder.count("connect_errors")
+                return
+            try:
+                while True:
+                    try:
+                        kind, payload = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if kind == "lecture":
+                            user.run_lecture(payload, args.chunk_interval)
+                        else:
+                            user.run_question(payload)
+                    except Exception as e:
+                        print(f"[LOAD] Utilisateur {index} : {kind} en erreur ({e})")
+                        recorder.count("job_errors")
+            finally:
+                user.close()
+
+        print(f"🚀 {len(mix)} jobs ({args.lectures} cours, {args.questions} questions), {args.concurrency} utilisateurs")
+        start = time.time()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stop.set()
+
+        report = recorder.summary(time.time() - start)
+        report.update(timestamp=datetime.now().isoformat(), url=base_url, concurrency=args.concurrency)
+        report["response_cache"] = cache_hit_rate(cache_before, response_cache_counts(base_url))
+        return report
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report):
+    print("\n" + "=" * 70)
+    print("📊 RÉSULTATS DU TEST DE CHARGE")
+    print("=" * 70)
+    print(f"\n⏱️  Durée : {report['elapsed_s']} s ({report['concurrency']} utilisateurs)")
+    throughput = report["throughput"]
+    print(f"🚀 Débit : {throughput['questions_per_min']} questions/min, {throughput['lectures_per_min']} cours/min, {throughput['chunks_per_s']} chunks/s")
+    print("\n📈 Latences (p50 / p95 / p99 / max) :")
+    for name, stats in report["latency"].items():
+        print(f"  • {name} ({stats['count']}) : {stats['p50_s']} / {stats['p95_s']} / {stats['p99_s']} / {stats['max_s']} s")
+    cache = report.get("response_cache")
+    if cache is None:
+        print("  • cache des réponses : non mesuré")
+    else:
+        hit_rate = f"{cache['hit_rate']:.0%}" if cache["hit_rate"] is not None else "n/a"
+        print(f"  • cache des réponses : {hit_rate} de réussite ({cache['hits']} exactes, {cache['near_hits']} proches, {cache['misses']} manquées)")
+    if report["queue_lag"]:
+        print("\n📬 Retard des files (messages en attente, max / moyenne) :")
+        for topic, stats in report["queue_lag"].items():
+            print(f"  • {topic} : {stats['max']} / {stats['mean']}")
+    errors = report["errors"]
+    print(f"\n❌ Erreurs HTTP : {errors['http_error_rate']}, 503 : {errors['rejected_503_rate']}, timeouts : {errors['timeout_rate']}")
+    print("\n" + "=" * 70 + "\n")
+
+
+# ============================================================================
+# INTERFACE LIGNE DE COMMANDE
+# ============================================================================
+
+def main():
+    if sys.platform == "win32":
+        try:
+            sys.stdout.reconfigure(encoding='utf-8')
+        except:
+            pass
+
+    parser = argparse.ArgumentParser(
+        description="Test de charge Milo - débit et latences du backend",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Exemples:
+  # Backend déjà lancé, enregistrements réels
+  python load_test_milo.py run --lecture-dir rec/cours1 --question-dir rec/questions --questions 40 --concurrency 8
+
+  # Hors-ligne : backend avec modèles factices lancé par l'outil, audio de test généré
+  python load_test_milo.py run --stub-server --lectures 2 --questions 20 --concurrency 4
+
+  # Backend factice seul (pour viser un autre client)
+  python load_test_milo.py serve --port 5055 --tokens-per-s 20
+        """
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Rejouer cours et questions contre le backend")
+    run.add_argument("--url", default="http://127.0.0.1:5055")
+    run.add_argument("--lecture-dir", help="Chunks .webm d'un cours (rejoués dans l'ordre des noms)")
+    run.add_argument("--question-dir", help="Clips .webm de questions")
+    run.add_argument("--lectures", type=int, default=1, help="Nombre de cours rejoués")
+    run.add_argument("--questions", type=int, default=10, help="Nombre de questions rejouées")
+    run.add_argument("--concurrency", type=int, default=4, help="Utilisateurs simultanés")
+    run.add_argument("--chunk-interval", type=float, default=0.0, help="Pause entre deux chunks (10 = temps réel)")
+    run.add_argument("--chunks", type=int, default=3, help="Chunks générés par cours (sans --lecture-dir)")
+    run.add_argument("--chunk-seconds", type=float, default=10.0)
+    run.add_argument("--question-seconds", type=float, default=3.0)
+    run.add_argument("--timeout", type=float, default=300.0, help="Attente max d'une réponse (s)")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--stub-server", action="store_true", help="Lancer le backend factice sur le port de --url")
+    run.add_argument("--output", type=str, help="Fichier JSON des résultats")
+    run.add_argument("--response-cache", action="store_true", help="Garder le cache des réponses du backend factice (--stub-server)")
+
+    serve_parser = commands.add_parser("serve", help="Backend avec modèles factices, bus en mémoire")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=5055)
+    serve_parser.add_argument("--whisper-rtf", type=float, default=0.05, help="Temps de transcription / durée audio")
+    serve_parser.add_argument("--tokens-per-s", type=float, default=40.0, help="Débit du LLM simulé")
+    serve_parser.add_argument("--tts-rtf", type=float, default=0.05, help="Temps de synthèse / durée audio")
+    serve_parser.add_argument("--response-cache", action="store_true", help="Garder le cache des réponses (désactivé par défaut)")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+
+    report = run_load(args)
+    if report is None:
+        sys.exit(1)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Résultats sauvegardés: {args.output}")
+
+
+if __name__ == "__main__":
+    main()